@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+import os
+import sys
+import random
+import logging
+from timeit import timeit
+from datetime import datetime, timedelta, timezone
+import click
+import pytz
+from dateutil import parser
+
+
+logging.disable(logging.CRITICAL)
+
+PATH_LIBS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(PATH_LIBS)
+
+from crawler import dates
+
+
+def old_date_to_epoch(s, tzname=None):
+    """How GenericCrawler.date_to_epoch used to parse dates"""
+    date = parser.parse(s, ignoretz=True)
+    tz = pytz.timezone(tzname if tzname else 'Europe/Stockholm')
+    date = tz.localize(date)
+    return int((date - datetime(1970, 1, 1, tzinfo=timezone.utc)) / timedelta(seconds=1))
+
+
+def old_parse_ended(s):
+    """How TraderaCrawler used to parse end dates"""
+    s = '%s %s' % (datetime.now().year, s)
+    s = s.replace('maj', 'may').replace('okt', 'oct')
+    return parser.parse(s, ignoretz=True)
+
+
+def gen_page(count, spread):
+    """Generate the publication and end dates of a page of announces,
+    published within 'spread' minutes"""
+    published, ended = [], []
+    months = ['jan', 'feb', 'mar', 'apr', 'maj', 'jun', 'jul', 'aug', 'sep', 'okt', 'nov', 'dec']
+    for i in range(count):
+        d = datetime(2019, 5, 16, 10, 29) - timedelta(minutes=random.randint(0, spread))
+        published.append(d.strftime('%Y-%m-%d %H:%M'))
+        ended.append('\t%s %s %s' % (d.day, months[d.month - 1], d.strftime('%H:%M')))
+    return published, ended
+
+
+@click.command()
+@click.option('--count', required=False, metavar='N', default=50, help="Number of announces per page", show_default=True)
+@click.option('--spread', required=False, metavar='MIN', default=120, help="Announces are published within that many minutes", show_default=True)
+@click.option('--repeat', required=False, metavar='N', default=50, help="Parse the page that many times", show_default=True)
+def main(count, spread, repeat):
+    """Compare the cost of parsing a page of dates before and after
+    crawler.dates"""
+
+    published, ended = gen_page(count, spread)
+
+    for s in published:
+        assert dates.date_to_epoch(s) == old_date_to_epoch(s)
+    for s in ended:
+        assert dates.parse_date(s) == old_parse_ended(s)
+
+    def old():
+        [old_date_to_epoch(s) for s in published]
+        [old_parse_ended(s) for s in ended]
+
+    def new(cold=False):
+        if cold:
+            dates.date_to_epoch.cache_clear()
+            dates.parse_date_in_year.cache_clear()
+            dates.get_utc_offset.cache_clear()
+        [dates.date_to_epoch(s) for s in published]
+        [dates.parse_date(s) for s in ended]
+
+    t_old = timeit(old, number=repeat) / repeat
+    t_cold = timeit(lambda: new(cold=True), number=repeat) / repeat
+    t_warm = timeit(new, number=repeat) / repeat
+
+    print("Page of %s announces (%s dates) published within %s minutes:" % (count, 2 * count, spread))
+    print("  dateutil + pytz:           %7.2fms" % (t_old * 1000))
+    print("  crawler.dates, cold cache: %7.2fms  (x%.0f)" % (t_cold * 1000, t_old / t_cold))
+    print("  crawler.dates, warm cache: %7.2fms  (x%.0f)" % (t_warm * 1000, t_old / t_warm))
+
+
+if __name__ == "__main__":
+    main()
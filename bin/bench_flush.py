@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import re
+import sys
+import json
+import logging
+import tracemalloc
+from timeit import timeit
+import click
+
+
+logging.disable(logging.CRITICAL)
+
+PATH_LIBS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(PATH_LIBS)
+
+from pymacaron_core.swagger.apipool import ApiPool
+from crawler.formats import get_custom_formats
+from crawler.io.bdl import validate_scraped_objects
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+
+
+def load_apis():
+    path_apis = os.path.join(PATH_LIBS, 'apis')
+    ApiPool.add('crawler', yaml_path=os.path.join(path_apis, 'crawler.yaml'), formats=get_custom_formats())
+
+    # We only need the BDL api's models: neutralize its server bindings
+    with open(os.path.join(path_apis, 'api.yaml')) as f:
+        s = f.read()
+    s = re.sub(r'\n\s*x-persist:.*', '', s)
+    s = re.sub(r'x-bind-server:.*', 'x-bind-server: crawler.formats.get_custom_formats', s)
+    ApiPool.add('api', yaml_str=s, formats=get_custom_formats())
+
+
+def gen_objects(count, records=True):
+    """Generate scraped objects, as records or as swagger models"""
+    ScrapedObject, ScrapedBDLItem = ScrapedRecord, BDLItemRecord
+    if not records:
+        ScrapedObject, ScrapedBDLItem = ApiPool.crawler.model.ScrapedObject, ApiPool.crawler.model.ScrapedBDLItem
+    return [
+        ScrapedObject(
+            is_complete=True,
+            native_url='https://www.tradera.com/item/2305/%s/lars-lerin-affisch' % (351972834 + i),
+            bdlitem=ScrapedBDLItem(
+                title='Lars Lerin affisch %s' % i,
+                price=150 + i,
+                price_is_fixed=False,
+                currency='SEK',
+                country='SE',
+                language='sv',
+                has_ended=False,
+                native_picture_url='https://img.tradera.net/images/946/310361946_5c073647.jpg',
+                description='Lila mini Kånken från Fjällräven. Väl använd. Se bilderna.\n' * 5,
+                epoch_published=1557079800 + i,
+                native_doc_id=str(351972834 + i),
+                native_seller_is_shop=False,
+                native_seller_name='Martin Eddy',
+            )
+        ) for i in range(count)
+    ]
+
+
+def via_client(objects):
+    """What ItemConsumer used to do with swagger models, plus the generated
+    client's serialization"""
+    data = ApiPool.api.model.ScrapedObjects(
+        index='BDL',
+        source='TRADERA',
+        real=True,
+        objects=[
+            ApiPool.api.json_to_model(
+                'ScrapedObject',
+                ApiPool.crawler.model_to_json(o),
+            ) for o in objects
+        ],
+    )
+    return json.dumps(ApiPool.api.model_to_json(data))
+
+
+def fast_path(objects, rate):
+    """What ItemConsumer.send_objects does with flush_fast_path on"""
+    j = [o.to_json() for o in objects]
+    validate_scraped_objects(j, rate=rate)
+    return json.dumps({
+        'index': 'BDL',
+        'source': 'TRADERA',
+        'real': True,
+        'objects': j,
+    })
+
+
+@click.command()
+@click.option('--count', required=False, metavar='N', help="Serialize batches of N objects", default=1000)
+@click.option('--repeat', required=False, metavar='N', help="Repeat each measure N times", default=5)
+def main(count, repeat):
+    """Compare the cost of serializing scraped objects for the BDL api, via
+    the generated client versus via ItemConsumer's fast path, and the cost
+    of building scraped objects as swagger models versus records.
+
+    python bin/bench_flush.py --count 1000
+
+    """
+
+    load_apis()
+    models = gen_objects(count, records=False)
+    records = gen_objects(count)
+
+    results = [
+        ('via client', timeit(lambda: via_client(models), number=repeat) / repeat),
+        ('fast path, validate all', timeit(lambda: fast_path(records, 1.0), number=repeat) / repeat),
+        ('fast path, validate 1%', timeit(lambda: fast_path(records, 0.01), number=repeat) / repeat),
+        ('fast path, no validation', timeit(lambda: fast_path(records, 0), number=repeat) / repeat),
+    ]
+
+    t0 = results[0][1]
+    for name, t in results:
+        print("%-26s %8.1f ms per %s objects  (x%.1f)" % (name, t * 1000, count, t0 / t))
+
+    # Cost of building and buffering the objects in the first place
+    print("")
+    for name, records in (('swagger models', False), ('records', True)):
+        t = timeit(lambda: gen_objects(count, records=records), number=repeat) / repeat
+        tracemalloc.start()
+        objects = gen_objects(count, records=records)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del objects
+        print("build %-20s %8.1f ms, %6.0f KB held, %6.0f KB peak per %s objects" % (name, t * 1000, size / 1024, peak / 1024, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import os
+import sys
+import logging
+from timeit import timeit
+import click
+
+
+logging.disable(logging.CRITICAL)
+
+PATH_LIBS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(PATH_LIBS)
+
+from crawler.consumer import ItemConsumer
+from crawler.sources.tradera import TraderaCrawler
+
+
+PATH_DATA = os.path.join(PATH_LIBS, 'testaccept', 'data')
+
+
+def parse(html, parse_only):
+    """Parse a detail page the way TraderaCrawler.fetch_item does"""
+    c = TraderaCrawler(source='TRADERA', consumer=ItemConsumer('TRADERA'))
+    c.html = html
+    soup = c.get_soup(parse_only)
+    soup.find(class_='view-item-ended-summary-label')
+    soup.find(class_='view-item')
+    return soup
+
+
+@click.command()
+@click.option('--repeat', required=False, metavar='N', default=20, help="Parse each page that many times", show_default=True)
+def main(repeat):
+    """Compare parsing whole pages with parsing only the parts the tradera
+    crawler reads, on the pages in testaccept/data/"""
+
+    total_full = total_targeted = 0
+    for name in sorted(os.listdir(PATH_DATA)):
+        with open(os.path.join(PATH_DATA, name)) as f:
+            html = f.read()
+
+        full = timeit(lambda: parse(html, None), number=repeat) / repeat
+        targeted = timeit(lambda: parse(html, TraderaCrawler.PARSE_ITEM), number=repeat) / repeat
+        total_full += full
+        total_targeted += targeted
+
+        print("%-40s %4dkB  full: %6.1fms  targeted: %6.1fms  (x%.1f)" % (
+            name, len(html) / 1024, full * 1000, targeted * 1000, full / targeted,
+        ))
+
+    print("%-40s         full: %6.1fms  targeted: %6.1fms  (x%.1f)" % (
+        'total', total_full * 1000, total_targeted * 1000, total_full / total_targeted,
+    ))
+
+
+if __name__ == "__main__":
+    main()
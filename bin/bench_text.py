@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+import os
+import sys
+import logging
+from timeit import timeit
+import click
+from bs4 import BeautifulSoup
+
+
+logging.disable(logging.CRITICAL)
+
+PATH_LIBS = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(PATH_LIBS)
+
+from crawler.text import html_to_text
+from crawler.text import html2text_to_text
+
+
+PATH_DATA = os.path.join(PATH_LIBS, 'testaccept', 'data')
+
+
+def load_fragments():
+    """Return the fragments of the pages in testaccept/data/ that the tradera
+    crawler converts to text, by kind"""
+    fragments = {
+        'description': [],
+        'published': [],
+        'itemid': [],
+    }
+    for name in sorted(os.listdir(PATH_DATA)):
+        with open(os.path.join(PATH_DATA, name)) as f:
+            soup = BeautifulSoup(f.read(), 'lxml')
+        for tag in soup.find_all(class_='content-text'):
+            fragments['description'].append(tag)
+        for tag in soup.find_all(class_='view-item-footer-information-details-published'):
+            fragments['published'].append(tag.text)
+        for tag in soup.find_all(class_='view-item-footer-information-details-itemid'):
+            fragments['itemid'].append(tag)
+    return fragments
+
+
+@click.command()
+@click.option('--repeat', required=False, metavar='N', default=200, help="Convert each fragment that many times", show_default=True)
+def main(repeat):
+    """Compare html2text with crawler.text on the fragments of the pages in
+    testaccept/data/, and check that they return the same text"""
+
+    for kind, fragments in load_fragments().items():
+        for f in fragments:
+            assert html_to_text(f) == html2text_to_text(f), "Texts differ for %s" % f
+
+        count = len(fragments) * repeat
+        old = timeit(lambda: [html2text_to_text(f) for f in fragments], number=repeat) / count
+        new = timeit(lambda: [html_to_text(f) for f in fragments], number=repeat) / count
+
+        print("%-12s %3d fragments  html2text: %7.1fus  crawler.text: %7.1fus  (x%.1f)" % (
+            kind, len(fragments), old * 1000000, new * 1000000, old / new,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,61 @@
 import logging
 import urllib.parse
+from flask import Response
 from pymacaron_core.swagger.apipool import ApiPool
 from pymacaron.utils import to_epoch, timenow
 from pymacaron_async import asynctask
+from pymacaron.config import get_config
 from crawler.crawler import get_crawler
 from crawler.exceptions import ConsumerLimitReachedError
 from crawler.exceptions import ConsumerEpochReachedError
 from crawler.exceptions import InternalServerError
+from crawler.exceptions import JobNotFoundError
+from crawler.exceptions import ProfileNotFoundError
+from crawler.io.slack import slack_info
+from crawler.io.jobs import get_job_registry
+from crawler.io.jobs import run_job
+from crawler.io.jobs import dispatch_job
+from crawler.autoscan import load_state
+from crawler.autoscan import get_autoscan_path
+from crawler.io.metrics import render_metrics
+from crawler.io.profiler import profiling
+from crawler.io.profiler import get_profile_ring
+from crawler.stream import stream_objects
 
 
 log = logging.getLogger(__name__)
 
 
-def empty_response(source, **whatever):
+# Default number of pages scraped concurrently in a batch
+DEFAULT_SCRAPE_BATCH_WORKERS = 8
+
+
+def empty_response(source, job_id=None, **whatever):
     return ApiPool.crawler.model.ScrapedObjects(
         index='BDL',
         source=source.upper(),
         real=True,
         objects=[],
+        job_id=job_id,
     )
 
 
+def submit_job(kind, source, **args):
+    """Register an asynchronous job and return (job_id, True), or the id of
+    the identical job already queued or running and False. Return (None,
+    True) if the job registry is disabled"""
+    registry = get_job_registry()
+    if not registry:
+        return None, True
+    return registry.submit(kind, source, **args)
+
+
+def stream_response(consumer, crawl):
+    """Return a response streaming the objects found by crawl() as
+    newline-delimited json, followed by a summary line"""
+    return Response(stream_objects(consumer, crawl), mimetype='application/x-ndjson')
+
+
 #
 # SCAN
 #
@@ -38,16 +73,38 @@ def do_scan_source(data):
         'limit_sec': data.limit_sec if data.limit_sec else None,
         'limit_count': data.limit_count if data.limit_count else None,
         'pre_loaded_html': data.html,
+        'scrape_workers': data.scrape_workers,
+        'use_cache': data.use_cache is not False,
+        'skip_seen': data.skip_seen is not False,
     }
 
+    profile = data.profile is True
+
     log.debug("Scan settings are: %s" % settings)
+    if data.synchronous and data.stream:
+        c = get_crawler(source, allow_flush=False, **settings)
+
+        def crawl():
+            with profiling('scan', source, enabled=profile):
+                c.scan()
+
+        return stream_response(c.consumer, crawl)
+
     if data.synchronous:
-        crawler = scan(source, allow_flush=False, **settings)
+        crawler = scan(source, allow_flush=False, profile=profile, **settings)
         return crawler.consumer.get_scraped_objects()
 
-    # Execute asynchronously
-    async_scan(source, **settings)
-    return empty_response(source, **settings)
+    # Execute asynchronously, unless the same scan is already on its way
+    job_id, is_new = submit_job(
+        'scan',
+        source,
+        epoch_oldest=settings['epoch_oldest'],
+        epoch_youngest=settings['epoch_youngest'],
+        settings=dict({k: v for k, v in settings.items() if not k.startswith('epoch_')}, profile=profile),
+    )
+    if is_new:
+        dispatch_job(async_scan, source, job_id=job_id, profile=profile, **settings)
+    return empty_response(source, job_id=job_id, **settings)
 
 
 @asynctask()
@@ -55,19 +112,24 @@ def async_scan(*args, **kwargs):
     scan(*args, **kwargs)
 
 
-def scan(source, **kwargs):
-    c = get_crawler(source, **kwargs)
+def scan(source, job_id=None, profile=False, **kwargs):
+    # Profiled where the scan runs, which is a celery worker if asynchronous
+    with run_job(job_id) as job, profiling('scan', source, enabled=profile):
+        # Identical scans submitted while queued may have widened its window
+        kwargs['epoch_oldest'], kwargs['epoch_youngest'] = job.window(kwargs.get('epoch_oldest'), kwargs.get('epoch_youngest'))
+        c = get_crawler(source, **kwargs)
+        job.counter = lambda: c.consumer.count_items
 
-    # Scan and catch limit reached exceptions
-    try:
-        c.scan()
-    except ConsumerLimitReachedError as e:
-        log.info(str(e))
-    except ConsumerEpochReachedError as e:
-        log.info(str(e))
+        # Scan and catch limit reached exceptions
+        try:
+            c.scan()
+        except ConsumerLimitReachedError as e:
+            log.info(str(e))
+        except ConsumerEpochReachedError as e:
+            log.info(str(e))
 
-    # Empty the buffer of scraped objects
-    c.consumer.flush()
+        # Empty the buffer of scraped objects
+        c.consumer.flush()
 
     return c
 
@@ -85,14 +147,20 @@ def do_scrape_source(data):
         'pre_loaded_html': data.html if data.html else None,
         'native_url': data.native_url,
         'scraper_data': data.scraper_data,
+        'use_cache': data.use_cache is not False,
     }
 
+    profile = data.profile is True
+
     if data.synchronous:
-        crawler = scrape(source, allow_flush=False, **settings)
+        # Callers wait for that scrape: hedge slow renders
+        crawler = scrape(source, allow_flush=False, hedge=True, profile=profile, **settings)
         return crawler.consumer.get_scraped_objects()
 
-    async_scrape(source, **settings)
-    return empty_response(source, **settings)
+    job_id, is_new = submit_job('scrape', source, native_url=data.native_url, settings=dict(settings, profile=profile))
+    if is_new:
+        dispatch_job(async_scrape, source, job_id=job_id, profile=profile, **settings)
+    return empty_response(source, job_id=job_id, **settings)
 
 
 @asynctask()
@@ -100,16 +168,88 @@ def async_scrape(*args, **kwargs):
     scrape(*args, **kwargs)
 
 
-def scrape(source, pre_loaded_html=None, native_url=None, scraper_data=None, allow_flush=True):
-    c = get_crawler(source, pre_loaded_html=pre_loaded_html, allow_flush=allow_flush)
-    c.scrape(
-        native_url,
-        scraper_data,
-    )
-    c.consumer.flush()
+def scrape(source, pre_loaded_html=None, native_url=None, scraper_data=None, use_cache=True, hedge=False, allow_flush=True, job_id=None, profile=False):
+    with run_job(job_id) as job, profiling('scrape', source, url=native_url, enabled=profile):
+        c = get_crawler(source, pre_loaded_html=pre_loaded_html, use_cache=use_cache, hedge=hedge, allow_flush=allow_flush)
+        job.counter = lambda: c.consumer.count_items
+        c.scrape(
+            native_url,
+            scraper_data,
+        )
+        c.consumer.flush()
     return c
 
 
+#
+# SCRAPE BATCH
+#
+
+def do_scrape_batch(data):
+    source = data.source.upper()
+    if data.synchronous not in (False, True):
+        data.synchronous = False
+
+    settings = {
+        # Scrape each url once, in the given order
+        'native_urls': list(dict.fromkeys(data.native_urls)),
+        'scrape_workers': data.scrape_workers,
+        'use_cache': data.use_cache is not False,
+    }
+
+    if data.synchronous:
+        crawler, errors = scrape_batch(source, allow_flush=False, hedge=True, **settings)
+        return scraped_batch(source, crawler.consumer.objects, errors)
+
+    job_id, is_new = submit_job('scrape_batch', source, settings=settings)
+    if is_new:
+        dispatch_job(async_scrape_batch, source, job_id=job_id, **settings)
+    return scraped_batch(source, [], [], job_id=job_id)
+
+
+@asynctask()
+def async_scrape_batch(*args, **kwargs):
+    scrape_batch(*args, **kwargs)
+
+
+def scrape_batch(source, native_urls=None, scrape_workers=None, use_cache=True, hedge=False, allow_flush=True, job_id=None):
+    if not scrape_workers:
+        scrape_workers = getattr(get_config(), 'scrape_batch_workers', DEFAULT_SCRAPE_BATCH_WORKERS)
+
+    with run_job(job_id) as job:
+        c = get_crawler(source, scrape_workers=scrape_workers, use_cache=use_cache, hedge=hedge, allow_flush=allow_flush)
+        job.counter = lambda: c.consumer.count_items
+        errors = c.scrape_batch(native_urls)
+        c.consumer.flush()
+
+    if errors and allow_flush:
+        slack_info(source, "Failed to scrape %s of %s urls in batch (1st one: %s | %s)" % (
+            len(errors),
+            len(native_urls),
+            errors[0][0],
+            str(errors[0][1])[0:100],
+        ))
+
+    return c, errors
+
+
+def scraped_batch(source, objects, errors, job_id=None):
+    """Return a ScrapedBatch of those scraped objects and (native_url,
+    exception) errors"""
+    model = ApiPool.crawler.model
+    return model.ScrapedBatch(
+        source=source,
+        job_id=job_id,
+        objects=[o.to_model() for o in objects],
+        errors=[
+            model.ScrapeError(
+                native_url=native_url,
+                error=getattr(e, 'code', 'INTERNAL_SERVER_ERROR'),
+                error_description=str(e),
+            ) for native_url, e in errors
+        ],
+    )
+
+
 #
 # SEARCH
 #
@@ -123,10 +263,98 @@ def do_search_source(data):
 
     query = urllib.parse.quote(data.query)
 
-    c = get_crawler(source, allow_flush=False, limit_count=data.limit_count)
+    c = get_crawler(
+        source,
+        allow_flush=False,
+        limit_count=data.limit_count,
+        scrape_workers=data.scrape_workers,
+        use_cache=data.use_cache is not False,
+        hedge=True,
+    )
+
+    def search():
+        with profiling('search', source, url=data.query, enabled=data.profile is True):
+            c.search(query, scraper_data=data.scraper_data)
+
+    if data.stream:
+        return stream_response(c.consumer, search)
+
     try:
-        c.search(query, scraper_data=data.scraper_data)
+        search()
     except ConsumerLimitReachedError:
         log.info("Consumer reached item limit")
 
     return c.consumer.get_scraped_objects()
+
+
+#
+# JOBS
+#
+
+def do_get_job(job_id):
+    registry = get_job_registry()
+    job = registry.get(job_id) if registry else None
+    if not job:
+        raise JobNotFoundError("No job %s" % job_id)
+    return ApiPool.crawler.model.Job(**{k: v for k, v in job.items() if v is not None})
+
+
+#
+# AUTOSCAN
+#
+
+def do_get_autoscan():
+    model = ApiPool.crawler.model
+    state = load_state(get_autoscan_path())
+    categories = []
+    for s in state.get('categories', []):
+        categories.append(model.AutoscanCategory(
+            source=s['source'],
+            category=s['category'],
+            rate_per_hour=s['rate'] * 3600 if s.get('rate') is not None else None,
+            interval=s.get('interval'),
+            epoch_last_scan=s.get('epoch_last_scan'),
+            epoch_next_run=s.get('epoch_next_run'),
+            last_count=s.get('last_count'),
+            last_pages=s.get('last_pages'),
+            last_error=s.get('last_error'),
+            count_runs=s.get('count_runs', 0),
+            count_errors=s.get('count_errors', 0),
+        ))
+
+    return model.AutoscanState(
+        enabled=bool(getattr(get_config(), 'autoscan', False)),
+        budget_per_hour=state.get('budget_per_hour'),
+        planned_per_hour=state.get('planned_per_hour'),
+        epoch_saved=state.get('epoch_saved'),
+        categories=categories,
+    )
+
+
+#
+# METRICS
+#
+
+def do_get_metrics():
+    # Declared as text/html in the spec, the only other format that pymacaron
+    # supports, but served with the content type of Prometheus' text format
+    return render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+#
+# PROFILES
+#
+
+def do_list_profiles():
+    model = ApiPool.crawler.model
+    profiles = [model.ProfileSummary(**{k: v for k, v in p.items() if v is not None}) for p in get_profile_ring().list()]
+    return model.Profiles(profiles=profiles)
+
+
+def do_get_profile(profile_id):
+    model = ApiPool.crawler.model
+    p = get_profile_ring().get(profile_id)
+    if not p:
+        raise ProfileNotFoundError("No profile %s" % profile_id)
+    p['functions'] = [model.ProfileFunction(**f) for f in p['functions']]
+    return model.Profile(**{k: v for k, v in p.items() if v is not None})
@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+from pymacaron.config import get_config
+from pymacaron.auth import generate_token
+from pymacaron.exceptions import PyMacaronException
+from crawler.exceptions import ConsumerLimitReachedError
+from crawler.exceptions import ConsumerEpochReachedError
+from crawler.io.jobs import get_job_registry
+from crawler.io.jobs import run_job
+
+
+log = logging.getLogger(__name__)
+
+
+# How many listing pages all scheduled scans may fetch per hour
+DEFAULT_BUDGET_PER_HOUR = 600
+
+# Bounds of the interval between two scans of a category, and how many new
+# items a scan should find at best (about one listing page)
+DEFAULT_MIN_INTERVAL = 300
+DEFAULT_MAX_INTERVAL = 6 * 3600
+DEFAULT_TARGET_ITEMS = 50
+ITEMS_PER_PAGE = 50
+
+# Scans go back to where the previous one started, minus that overlap, and
+# at most that far back
+DEFAULT_OVERLAP = 900
+DEFAULT_MAX_WINDOW = 86400
+
+# Weight of the latest scan in a category's arrival rate
+RATE_ALPHA = 0.3
+
+# How often the scheduler wakes up at least, as when waiting for the lock
+TICK_SEC = 60
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-autoscan.json')
+
+# Scheduled scans send their items to BDL as that user, with tokens valid
+# that long
+DEFAULT_USER_ID = 'bdl-crawler-autoscan'
+TOKEN_TTL = 86400
+
+
+class CategoryState():
+    """What the scheduler learnt about a category, and when to scan it next"""
+
+    FIELDS = (
+        'source',
+        'category',
+        'rate',
+        'interval',
+        'epoch_last_scan',
+        'epoch_next_run',
+        'last_count',
+        'last_pages',
+        'last_error',
+        'count_runs',
+        'count_errors',
+    )
+
+    def __init__(self, source, category, **kwargs):
+        self.source = source
+        self.category = category
+
+        # New items per second, or None until the first scan
+        self.rate = None
+        self.interval = None
+
+        # When the last successful scan started, which is where the next one
+        # picks up, and when the next one is due
+        self.epoch_last_scan = None
+        self.epoch_next_run = 0
+
+        self.last_count = None
+        self.last_pages = None
+        self.last_error = None
+        self.count_runs = 0
+        self.count_errors = 0
+
+        for k, v in kwargs.items():
+            if k in self.FIELDS:
+                setattr(self, k, v)
+
+
+    def to_json(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+
+class ScanScheduler():
+    """Scan each category of a source periodically, as often as its rate of
+    new items requires, within a budget of listing pages per hour.
+
+    Each scan measures how many new items arrived in a category since the
+    previous one, which updates the category's arrival rate. A category is
+    scanned every target_items / rate seconds, within [min_interval,
+    max_interval]. If all categories together would need more listing pages
+    per hour than the budget, the intervals of all categories are stretched
+    alike. Each scan covers the window since the previous one started.
+
+    scan(category, epoch_oldest, epoch_youngest) must scan a category and
+    return how many new items and listing pages it found, or None if it
+    could not scan it now.
+
+    """
+
+    def __init__(self, source, categories, scan, budget_per_hour=DEFAULT_BUDGET_PER_HOUR, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, target_items=DEFAULT_TARGET_ITEMS, overlap=DEFAULT_OVERLAP, max_window=DEFAULT_MAX_WINDOW, path=None, clock=time.time):
+        self.source = source
+        self.scan = scan
+        self.budget_per_hour = budget_per_hour
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.overlap = overlap
+        self.max_window = max_window
+        self.path = path
+        self.clock = clock
+        self.planned_per_hour = 0
+        self.lock = threading.Lock()
+
+        saved = load_state(path).get('categories', []) if path else []
+        saved = {s['category']: s for s in saved if s.get('source') == source}
+        self.categories = []
+        for c in categories:
+            fields = {k: v for k, v in saved.get(c, {}).items() if k not in ('source', 'category')}
+            self.categories.append(CategoryState(source, c, **fields))
+        self.plan()
+
+
+    def get_pages_per_hour(self, rate, interval):
+        """Return how many listing pages per hour scanning a category with
+        that rate at that interval takes: at least one page per scan, plus
+        one per page of new items"""
+        return 3600 / interval + 3600 * (rate or 0) / ITEMS_PER_PAGE
+
+
+    def plan(self):
+        """Set the interval and next run of each category"""
+        with self.lock:
+            for s in self.categories:
+                if s.rate is None:
+                    s.interval = self.min_interval
+                elif s.rate <= 0:
+                    s.interval = self.max_interval
+                else:
+                    s.interval = min(self.max_interval, max(self.min_interval, self.target_items / s.rate))
+
+            # Pages needed to keep up with new items are the same whatever the
+            # intervals, so stretch the intervals until the first page of
+            # each scan fits in what remains of the budget. Categories already
+            # at max_interval can't stretch further
+            floor = sum(3600 * (s.rate or 0) / ITEMS_PER_PAGE for s in self.categories)
+            for i in range(len(self.categories)):
+                flexible = [s for s in self.categories if s.interval < self.max_interval]
+                spare = self.budget_per_hour - floor - sum(3600 / s.interval for s in self.categories if s not in flexible)
+                overhead = sum(3600 / s.interval for s in flexible)
+                if overhead <= spare or not flexible:
+                    break
+                if spare <= 0:
+                    log.warning("Scans of %s categories need more than the budget of %s pages per hour" % (self.source, self.budget_per_hour))
+                for s in flexible:
+                    s.interval = self.max_interval if spare <= 0 else min(self.max_interval, s.interval * overhead / spare)
+
+            self.planned_per_hour = sum(self.get_pages_per_hour(s.rate, s.interval) for s in self.categories)
+            for s in self.categories:
+                if s.epoch_last_scan is not None and not s.last_error:
+                    s.epoch_next_run = s.epoch_last_scan + s.interval
+
+
+    def get_due(self):
+        """Return the categories due for a scan, most overdue first"""
+        now = self.clock()
+        with self.lock:
+            due = [s for s in self.categories if s.epoch_next_run <= now]
+        return sorted(due, key=lambda s: s.epoch_next_run)
+
+
+    def get_window(self, state, now):
+        """Return the (epoch_oldest, epoch_youngest) a scan of that category
+        starting now should cover"""
+        oldest = now - self.max_window
+        if state.epoch_last_scan is not None:
+            oldest = max(oldest, state.epoch_last_scan - self.overlap)
+        return oldest, now
+
+
+    def record(self, state, epoch_oldest, epoch_youngest, count, pages, error=None):
+        """Learn from a scan of that category, and plan the next ones"""
+        with self.lock:
+            state.count_runs += 1
+            state.last_pages = pages
+            state.last_error = error
+            if error:
+                state.count_errors += 1
+                state.epoch_next_run = self.clock() + (state.interval or self.min_interval)
+            else:
+                state.last_count = count
+                # The overlap with the previous scan holds no new items
+                span = epoch_youngest - max(epoch_oldest, (state.epoch_last_scan or epoch_oldest))
+                if span > 0:
+                    rate = count / span
+                    state.rate = rate if state.rate is None else state.rate + RATE_ALPHA * (rate - state.rate)
+                state.epoch_last_scan = epoch_youngest
+        self.plan()
+
+
+    def run_due(self):
+        """Scan the categories that are due, and return how many were"""
+        due = self.get_due()
+        for state in due:
+            epoch_oldest, epoch_youngest = self.get_window(state, self.clock())
+            log.info("Scanning %s category %s over the last %.0f sec" % (self.source, state.category, epoch_youngest - epoch_oldest))
+            try:
+                result = self.scan(state.category, epoch_oldest, epoch_youngest)
+                if result is None:
+                    with self.lock:
+                        state.epoch_next_run = self.clock() + self.min_interval
+                    continue
+                self.record(state, epoch_oldest, epoch_youngest, *result)
+            except (Exception, PyMacaronException) as e:
+                log.exception("Scheduled scan of %s category %s failed" % (self.source, state.category))
+                self.record(state, epoch_oldest, epoch_youngest, 0, None, error='%s: %s' % (type(e).__name__, str(e)))
+            self.save()
+        return len(due)
+
+
+    def get_next_run(self):
+        with self.lock:
+            return min([s.epoch_next_run for s in self.categories] or [self.clock() + TICK_SEC])
+
+
+    def get_state(self):
+        with self.lock:
+            return {
+                'source': self.source,
+                'budget_per_hour': self.budget_per_hour,
+                'planned_per_hour': self.planned_per_hour,
+                'categories': [s.to_json() for s in self.categories],
+            }
+
+
+    def save(self):
+        """Write the scheduler's state to its file, for the state endpoint and
+        the next start of the service"""
+        if not self.path:
+            return
+        state = self.get_state()
+        state['epoch_saved'] = self.clock()
+        tmp = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+
+    def loop(self, stopped):
+        """Run due scans until the 'stopped' event is set. Only the process
+        holding the lock next to the state file runs scans, so that several
+        workers of the service don't scan the same categories"""
+        lock = open('%s.lock' % self.path, 'w') if self.path else None
+        has_lock = lock is None
+        while not stopped.is_set():
+            if not has_lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    has_lock = True
+                    log.info("Starting scheduled scans of %s" % self.source)
+                except OSError:
+                    stopped.wait(TICK_SEC)
+                    continue
+
+            self.run_due()
+            stopped.wait(min(TICK_SEC, max(1, self.get_next_run() - self.clock())))
+
+
+def load_state(path):
+    """Return the state saved by a scheduler, or an empty dict"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_service_token():
+    """Return a token for scheduled scans to send items to BDL with, since
+    they run outside of any request and its token"""
+    return generate_token(
+        getattr(get_config(), 'autoscan_user_id', None) or DEFAULT_USER_ID,
+        data={},
+        expire_in=TOKEN_TTL,
+    )
+
+
+def scan_category(source, category, epoch_oldest, epoch_youngest):
+    """Scan one category of a source over that window, send its new items to
+    BDL, and return how many items and listing pages it found, or None if
+    it is already being scanned"""
+    from crawler.crawler import get_crawler
+
+    job_id = None
+    registry = get_job_registry()
+    if registry:
+        job_id, is_new = registry.submit('autoscan', source, native_url=category, epoch_oldest=epoch_oldest, epoch_youngest=epoch_youngest)
+        if not is_new:
+            log.info("Category %s of %s is already being scanned" % (category, source))
+            return None
+
+    with run_job(job_id) as job:
+        epoch_oldest, epoch_youngest = job.window(epoch_oldest, epoch_youngest)
+        c = get_crawler(source, epoch_oldest=epoch_oldest, epoch_youngest=epoch_youngest, skip_seen=True, token=get_service_token())
+        job.counter = lambda: c.consumer.count_items
+        try:
+            c.scan_category(category)
+        except ConsumerLimitReachedError as e:
+            log.info(str(e))
+        except ConsumerEpochReachedError as e:
+            log.info(str(e))
+        c.consumer.flush()
+
+    return c.consumer.count_items, c.count_page
+
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def get_autoscan_path():
+    return getattr(get_config(), 'autoscan_state_path', None) or DEFAULT_PATH
+
+
+def start_autoscan():
+    """Start scanning Tradera's categories in a background thread, if enabled
+    in config. Return the scheduler, or None"""
+    global scheduler
+    from crawler.sources.tradera import TRADERA_CATEGORIES
+
+    conf = get_config()
+    if not getattr(conf, 'autoscan', False):
+        return None
+
+    with scheduler_lock:
+        if not scheduler:
+            scheduler = ScanScheduler(
+                'TRADERA',
+                TRADERA_CATEGORIES,
+                lambda category, oldest, youngest: scan_category('TRADERA', category, oldest, youngest),
+                budget_per_hour=float(getattr(conf, 'autoscan_budget_per_hour', DEFAULT_BUDGET_PER_HOUR)),
+                min_interval=float(getattr(conf, 'autoscan_min_interval', DEFAULT_MIN_INTERVAL)),
+                max_interval=float(getattr(conf, 'autoscan_max_interval', DEFAULT_MAX_INTERVAL)),
+                target_items=float(getattr(conf, 'autoscan_target_items', DEFAULT_TARGET_ITEMS)),
+                max_window=float(getattr(conf, 'autoscan_max_window', DEFAULT_MAX_WINDOW)),
+                path=get_autoscan_path(),
+            )
+            t = threading.Thread(target=scheduler.loop, args=(threading.Event(), ), name='autoscan', daemon=True)
+            t.start()
+    return scheduler
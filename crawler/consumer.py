@@ -1,18 +1,29 @@
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pymacaron.utils import to_epoch, timenow
 from pymacaron.exceptions import is_error
+from pymacaron.config import get_config
+from pymacaron.auth import get_user_token
 from pymacaron_core.swagger.apipool import ApiPool
 from crawler.exceptions import ConsumerLimitReachedError
 from crawler.exceptions import ConsumerEpochReachedError
 from crawler.exceptions import ApiCallError
 from crawler.io.slack import slack_info
+from crawler.io.bdl import post_scraped_objects
+from crawler.io.bdl import validate_scraped_objects
+from crawler.io.bdl import auth_token
+from crawler.io.seen import get_seen_index
+from crawler.io.metrics import get_metrics
+from crawler.io.profiler import propagate
 
 log = logging.getLogger(__name__)
 
 
 class ItemConsumer():
 
-    def __init__(self, source, epoch_youngest=None, epoch_oldest=None, limit_count=None, limit_sec=None, allow_flush=True):
+    def __init__(self, source, epoch_youngest=None, epoch_oldest=None, limit_count=None, limit_sec=None, allow_flush=True, skip_seen=False, on_object=None, token=None):
         assert source
         self.source = source
         self.epoch_youngest = epoch_youngest
@@ -24,49 +35,122 @@ class ItemConsumer():
         self.last_scraped_object = None
         self.objects = []
 
+        # If set, accepted objects are passed to on_object(object) as soon as
+        # they are processed, instead of being buffered in self.objects
+        self.on_object = on_object
+
+        # Set once a limit is reached, so that all crawler threads sharing this
+        # consumer stop at their next object
+        self.limit_reached = None
+
+        # Crawlers may process objects from several threads concurrently
+        self.lock = threading.RLock()
+
         # Allow flushing/emptying buffer or not
         self.allow_flush = allow_flush
 
         # Auto-flush once the processed items buffer reached that many items
         self.flush_count = 50
 
+        # Batches are sent to the BDL api in the background, with at most
+        # that many batches queued or being sent at once
+        self.max_pending_flushes = 2
+
+        # Auth token to send batches with, by default that of the request
+        # creating the consumer: batches may be flushed from threads outside
+        # its context, like the crawler's workers
+        self.token = token or get_user_token()
+        self.pending_flushes = deque()
+        self.sender = None
+
+        # Index of the items already sent to BDL, if enabled in config. Items
+        # sent are added to it, and with skip_seen, items already in it are
+        # not sent again
+        self.seen = get_seen_index() if allow_flush else None
+        self.skip_seen = bool(skip_seen and self.seen)
+        self.count_skipped = 0
+
         log.info("Initialized consumer: allow_flush=%s limit_sec=%s limit_count=%s" % (allow_flush, limit_sec, limit_count))
         log.info("Initialized consumer: epoch_oldest=%s epoch_youngest=%s" % (epoch_oldest, epoch_youngest))
 
 
-    def process(self, object):
+    def process(self, object, seen=None):
         """Swallow a scraped object and return True if the crawler should proceed
         scraping and sending the next object, or False if the crawler should
         stop.
 
+        Optionally take whether the object was already sent to BDL, if the
+        crawler already looked it up along with others.
+
         """
 
-        if self.limit_sec and to_epoch(timenow()) - self.time_start > self.limit_sec:
-            raise ConsumerLimitReachedError("The time limit of %s sec has passed - Stopping now." % self.limit_sec)
+        with get_metrics().time('consume', self.source), self.lock:
+            # Report errors from batches sent in the background
+            self.check_pending_flushes()
 
-        if self.epoch_oldest and hasattr(object, 'bdlitem') and object.bdlitem and object.bdlitem.epoch_published:
-            if object.bdlitem.epoch_published < self.epoch_oldest:
-                raise ConsumerEpochReachedError("Parsed an item whose epoch_oldest %s is older than the limit %s" % (object.bdlitem.epoch_published, self.epoch_oldest))
+            if self.limit_reached:
+                raise ConsumerLimitReachedError(self.limit_reached)
 
-        self.objects.append(object)
-        self.count_items = self.count_items + 1
-        log.info("Scanned %s objects so far (Count limit is %s)" % (self.count_items, self.limit_count))
+            if self.limit_sec and to_epoch(timenow()) - self.time_start > self.limit_sec:
+                self.limit_reached = "The time limit of %s sec has passed - Stopping now." % self.limit_sec
+                raise ConsumerLimitReachedError(self.limit_reached)
 
-        # Do we keep processing?
-        if self.limit_count and self.count_items >= self.limit_count:
-            raise ConsumerLimitReachedError("The limit count of %s items have been fetched - Stopping now." % self.limit_count)
+            if self.epoch_oldest and hasattr(object, 'bdlitem') and object.bdlitem and object.bdlitem.epoch_published:
+                if object.bdlitem.epoch_published < self.epoch_oldest:
+                    raise ConsumerEpochReachedError("Parsed an item whose epoch_oldest %s is older than the limit %s" % (object.bdlitem.epoch_published, self.epoch_oldest))
 
-        # Do we flush?
-        if self.allow_flush and len(self.objects) > self.flush_count:
-            log.info("Reached %s items - Calling flush" % len(self.objects))
-            self.flush()
+            if self.skip_seen and (self.is_seen(object) if seen is None else seen):
+                self.count_skipped = self.count_skipped + 1
+                get_metrics().inc('crawler_items_skipped_total', source=self.source)
+                log.debug("Skipping already sent object %s" % object.native_url)
+                return object
+
+            if self.on_object:
+                self.on_object(object)
+            else:
+                self.objects.append(object)
+            self.count_items = self.count_items + 1
+            get_metrics().inc('crawler_items_total', source=self.source)
+            log.info("Scanned %s objects so far (Count limit is %s)" % (self.count_items, self.limit_count))
+
+            # Do we keep processing?
+            if self.limit_count and self.count_items >= self.limit_count:
+                self.limit_reached = "The limit count of %s items have been fetched - Stopping now." % self.limit_count
+                raise ConsumerLimitReachedError(self.limit_reached)
+
+            # Do we flush?
+            if self.allow_flush and len(self.objects) > self.flush_count:
+                log.info("Reached %s items - Sending them in the background" % len(self.objects))
+                self.flush_async()
 
         return object
 
 
+    def is_seen(self, object):
+        """Return True if that object was already sent to BDL"""
+        native_url = getattr(object, 'native_url', None)
+        return bool(native_url) and self.seen.is_seen(self.source, native_url)
+
+
+    def get_seen(self, native_urls):
+        """Return the set of those native urls already sent to BDL, or an empty
+        set unless skipping seen items"""
+        if not self.skip_seen:
+            return set()
+        return self.seen.get_seen(self.source, native_urls)
+
+
+    def stop(self, reason):
+        """Make all subsequent calls to process() raise a limit error"""
+        with self.lock:
+            if not self.limit_reached:
+                self.limit_reached = reason
+
+
     def flush(self):
         """If allow_flush is on, send all scanned objects so far to the BDL api and reset
-        the list of scanned objects.
+        the list of scanned objects. Wait until all batches sent in the
+        background are delivered, and raise the first error any of them met.
 
         """
 
@@ -74,17 +158,95 @@ class ItemConsumer():
             log.info("Flush: allow_flush=False - Not sending objects to BDL api")
             return
 
-        log.debug("Flush: sending %s scanned objects to BDL api" % len(self.objects))
+        if self.count_skipped:
+            log.info("Flush: skipped %s objects already sent to BDL" % self.count_skipped)
+
+        with self.lock, get_metrics().time('flush', self.source):
+            self.flush_async()
+            try:
+                while self.pending_flushes:
+                    self.pending_flushes.popleft().result()
+            finally:
+                self.pending_flushes.clear()
+                self.sender.shutdown(wait=False)
+                self.sender = None
+
+
+    def flush_async(self):
+        """Hand the buffered objects to the background sender and reset the
+        buffer. Block while too many batches are already pending"""
+
+        with self.lock:
+            self.check_pending_flushes()
+
+            while len(self.pending_flushes) >= self.max_pending_flushes:
+                log.info("Flush: %s batches pending - Waiting for the oldest one" % len(self.pending_flushes))
+                self.pending_flushes.popleft().result()
+
+            if not self.sender:
+                self.sender = ThreadPoolExecutor(max_workers=1)
+
+            objects, self.objects = self.objects, []
+            self.pending_flushes.append(self.sender.submit(propagate(self.deliver_objects), objects, self.token))
+
+
+    def check_pending_flushes(self):
+        """Forget batches already delivered, and raise the error of the first
+        one that failed"""
+        while self.pending_flushes and self.pending_flushes[0].done():
+            self.pending_flushes.popleft().result()
+
+
+    def deliver_objects(self, objects, token):
+        """Send a batch of scanned objects to the BDL api with that auth token,
+        and remember them as sent"""
+        with get_metrics().time('send', self.source):
+            self.send_objects(objects, token)
+        get_metrics().inc('crawler_items_flushed_total', len(objects), source=self.source)
+        if self.seen:
+            self.seen.add(self.source, objects)
+
+
+    def send_objects(self, objects, token):
+        """Send a batch of scanned objects to the BDL api with that auth
+        token"""
+
+        log.debug("Flush: sending %s scanned objects to BDL api" % len(objects))
+
+        conf = get_config()
+        if getattr(conf, 'flush_fast_path', True):
+            # Serialize objects once, straight into the request's payload, and
+            # validate only a sample of them
+            j = [o.to_json() for o in objects]
+            validate_scraped_objects(j, rate=getattr(conf, 'flush_validate_rate', 0.01))
+            post_scraped_objects(self.source, j, token)
+        else:
+            # The generated client reads the token from the flask context
+            with auth_token(token):
+                self.send_objects_via_client(objects)
+
+        slack_info(
+            self.source,
+            "Flushed %s items %s" % (
+                len(objects),
+                '' if len(objects) == 0 else '(1st one: %s | %s)' % (
+                    objects[0].native_url,
+                    'complete' if objects[0].is_complete else 'incomplete',
+                ),
+            )
+        )
+
+
+    def send_objects_via_client(self, objects):
+        """Send a batch of scanned objects to the BDL api through the generated
+        client, fully validating them on the way"""
 
         data = ApiPool.api.model.ScrapedObjects(
             index='BDL',
             source=self.source.upper(),
             real=True,
             objects=[
-                ApiPool.api.json_to_model(
-                    'ScrapedObject',
-                    ApiPool.crawler.model_to_json(o),
-                ) for o in self.objects
+                ApiPool.api.json_to_model('ScrapedObject', o.to_json()) for o in objects
             ],
         )
 
@@ -93,20 +255,6 @@ class ItemConsumer():
         if is_error(r):
             raise ApiCallError("Flush error: %s" % r.error_description)
 
-        slack_info(
-            self.source,
-            "Flushed %s items %s" % (
-                len(self.objects),
-                '' if len(self.objects) == 0 else '(1st one: %s | %s)' % (
-                    self.objects[0].native_url,
-                    'complete' if self.objects[0].is_complete else 'incomplete',
-                ),
-            )
-        )
-
-        # And empty the buffer
-        self.objects = []
-
 
     def get_scraped_objects(self):
         """Return a ScrapedObjects containing all scraped objects"""
@@ -115,5 +263,5 @@ class ItemConsumer():
             index='BDL',
             source=self.source.upper(),
             real=True,
-            objects=self.objects if self.objects else [],
+            objects=[o.to_model() for o in self.objects],
         )
@@ -1,48 +1,45 @@
+import copy
 import logging
-import re
-import os
-import subprocess
-from time import sleep
-from html.parser import HTMLParser
-from html2text import html2text
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import requests.exceptions
 import requests
-from dateutil import parser
-from datetime import datetime, timedelta, timezone
-import pytz
 from bs4 import BeautifulSoup
-from selenium import webdriver
+from bs4 import SoupStrainer
 from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.common.by import By
 from pymacaron.config import get_config
+from pymacaron.exceptions import PyMacaronException
 from crawler.consumer import ItemConsumer
 from crawler.exceptions import UnknownSourceError
-from crawler.io.slack import slack_info
+from crawler.exceptions import RenderServiceBusyError
+from crawler.io.slack import slack_fetched
+from crawler.io.webdriver import get_webdriver_pool
+from crawler.io.browserless import get_browserless_client
+from crawler.io.static import get_static_fetcher
+from crawler.io.static import has_class
+from crawler.io.pagecache import get_page_cache
+from crawler.io.scheduler import get_scheduler
+from crawler.io.hedge import get_hedger
+from crawler.io.singleflight import get_single_flight
+from crawler.io.singleflight import normalize_url
+from crawler.io.metrics import get_metrics
+from crawler.io.profiler import note_url
+from crawler.io.profiler import propagate
+from crawler import text
+from crawler import dates
+from crawler.numbers import parse_number
 
 
 log = logging.getLogger(__name__)
 
 
-htmlparser = HTMLParser()
+# Default number of detail pages scraped concurrently by a crawler
+DEFAULT_SCRAPE_WORKERS = 4
 
 
-# Try finding chromedriver if needed and return its path
-HERE = os.path.dirname(os.path.realpath(__file__))
-os.environ['PATH'] += ':%s/../lib/:/pym/lib' % HERE
-log.info("Searching for chromedriver in PATH=%s" % os.environ['PATH'])
-WEBDRIVER_PATH = os.popen('which chromedriver').read().strip()
-log.info("Found chromedriver at %s" % WEBDRIVER_PATH)
-
-CHROME_OPTIONS = webdriver.ChromeOptions()
-CHROME_OPTIONS.add_argument('--no-sandbox')
-CHROME_OPTIONS.add_argument('--window-size=1420,1080')
-CHROME_OPTIONS.add_argument('--headless')
-CHROME_OPTIONS.add_argument('--disable-gpu')
-CHROME_OPTIONS.add_argument('--disable-dev-shm-usage')
-CHROME_OPTIONS.add_argument('disable-infobars')
-CHROME_OPTIONS.add_argument('--disable-extensions')
-
-
-def get_crawler(source, pre_loaded_html=None, **args):
+def get_crawler(source, pre_loaded_html=None, scrape_workers=None, use_cache=True, hedge=False, **args):
     """Get a crawler for that source, properly initialized"""
 
     from crawler.sources.tradera import TraderaCrawler
@@ -63,28 +60,45 @@ def get_crawler(source, pre_loaded_html=None, **args):
         source=source,
         pre_loaded_html=pre_loaded_html,
         consumer=ItemConsumer(source, **args),
+        scrape_workers=scrape_workers,
+        use_cache=use_cache,
+        hedge=hedge,
     )
 
 
 class GenericCrawler():
     """Empty interface that all crawlers must implement"""
 
-    def __init__(self, source=None, consumer=None, pre_loaded_html=None):
+    # How to fetch each type of page of this source, as a dict of page type to
+    # {'marker': <css class present once the page's data is loaded>,
+    #  'static': <True if a plain http fetch may be enough>,
+    #  'cache_ttl': <seconds to keep the page in the page cache, if enabled>}
+    page_types = {}
+
+    def __init__(self, source=None, consumer=None, pre_loaded_html=None, scrape_workers=None, use_cache=True, hedge=False):
         assert source, "source must be set"
         assert consumer, "consumer must be set"
         self.source = source
         self.consumer = consumer
-        self.retry_delay = 1
 
-        self.has_webdriver = None
+        # How many detail pages to scrape concurrently
+        if not scrape_workers:
+            scrape_workers = getattr(get_config(), 'scrape_workers', DEFAULT_SCRAPE_WORKERS)
+        self.scrape_workers = int(scrape_workers)
 
-        # The soup
-        self.soup = None
+        # The current page, and the soups parsed from it so far
         self.html = None
+        self.soups = {}
 
         # Pre-load html, if available
         self.pre_loaded_html = pre_loaded_html
 
+        # Whether to read pages from the page cache, if enabled in config
+        self.use_cache = use_cache
+
+        # Whether to hedge slow renders, if enabled in config
+        self.hedge = hedge
+
 
     def scan(self):
         raise Exception("Not implemented")
@@ -98,132 +112,354 @@ class GenericCrawler():
         raise Exception("Not implemented")
 
 
-    def get_webdriver(self):
-        """Return webdriver if it is available on the host, else None"""
+    def fetch_item(self, native_url, scraper_data=None):
+        """Fetch and parse the page at native_url and return the scraped object,
+        without passing it to the consumer"""
+        raise Exception("Not implemented")
 
-        if self.has_webdriver is False:
-            return None
-        elif WEBDRIVER_PATH == '':
-            self.has_webdriver = False
-            return None
-        elif self.has_webdriver in (None, True):
-            # Test if chrome can be started
+
+    def fetch_item_once(self, native_url, scraper_data=None):
+        """Same as fetch_item, but concurrent fetches of the same page by any
+        crawler of this process share one fetch. Each gets its own copy of the
+        result, that its consumer may modify, with the url it asked for"""
+        flights = get_single_flight()
+        if not flights or self.pre_loaded_html:
+            return self.fetch_item(native_url, scraper_data=scraper_data)
+
+        key = (self.source, normalize_url(native_url), scraper_data, self.use_cache)
+        item = copy.deepcopy(flights.do(key, lambda: self.fetch_item(native_url, scraper_data=scraper_data)))
+        item.native_url = native_url
+        return item
+
+
+    def spawn(self):
+        """Return a new crawler for the same source and consumer, with its own
+        page state, for use in a worker thread"""
+        return self.__class__(
+            source=self.source,
+            consumer=self.consumer,
+            pre_loaded_html=self.pre_loaded_html,
+            scrape_workers=1,
+            use_cache=self.use_cache,
+            hedge=self.hedge,
+        )
+
+
+    def scrape_many(self, native_urls):
+        """Scrape the given urls concurrently with up to scrape_workers threads,
+        and pass the scraped objects to the consumer in the order of
+        native_urls. Pending scrapes are cancelled as soon as the consumer
+        raises an exception (typically a limit or epoch boundary).
+
+        """
+
+        if self.scrape_workers <= 1:
+            for native_url in native_urls:
+                self.scrape(native_url)
+            return
+
+        native_urls = iter(native_urls)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.scrape_workers)
+
+        def fill():
+            while len(pending) < self.scrape_workers:
+                native_url = next(native_urls, None)
+                if native_url is None:
+                    return
+                pending.append(executor.submit(propagate(self.spawn().fetch_item_once), native_url))
+
+        try:
+            fill()
+            while pending:
+                item = pending.popleft().result()
+                self.consumer.process(item)
+                fill()
+        finally:
+            if pending:
+                log.info("Cancelling %s in-flight scrapes" % len(pending))
+            for f in pending:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+
+    def scrape_batch(self, native_urls):
+        """Scrape the given urls concurrently with up to scrape_workers threads,
+        sharing this crawler's consumer, and pass the scraped objects to the
+        consumer in the order of native_urls. A url failing to scrape does
+        not stop the batch: return the list of (native_url, exception) of
+        all urls that failed.
+
+        """
+
+        # Iterated twice below
+        native_urls = list(native_urls)
+
+        def fetch(native_url):
             try:
-                driver = webdriver.Chrome(
-                    executable_path=WEBDRIVER_PATH,
-                    options=CHROME_OPTIONS,
-                )
-                self.has_webdriver = True
-                return driver
-            except Exception as e:
-                log.info("Chrome does not seem to be installed: %s" % str(e))
-                log.info("Will use browserless.io instead.")
-                self.has_webdriver = False
-                return None
-
-
-    def get_url(self, url, wait_condition=None):
+                return self.spawn().fetch_item_once(native_url), None
+            except (Exception, PyMacaronException) as e:
+                return None, e
+
+        errors = []
+        executor = ThreadPoolExecutor(max_workers=self.scrape_workers)
+        try:
+            for native_url, (item, e) in zip(native_urls, executor.map(propagate(fetch), native_urls)):
+                if e:
+                    log.info("Failed to scrape %s: %s: %s" % (native_url, type(e).__name__, str(e)))
+                    errors.append((native_url, e))
+                    continue
+                self.consumer.process(item)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return errors
+
+
+    def get_webdriver(self, blocking=True):
+        """Check out a warm webdriver from the process-wide pool if chrome is
+        available on the host, else return None. Unless blocking, also return
+        None if all drivers are busy. Drivers must be given back with
+        release_webdriver()"""
+        return get_webdriver_pool().checkout(blocking=blocking)
+
+
+    def release_webdriver(self, driver, broken=False):
+        """Give a webdriver back to the pool, which recycles it if broken"""
+        get_webdriver_pool().checkin(driver, broken=broken)
+
+
+    def get_url(self, url, wait_condition=None, page_type=None, use_cache=True):
         """Fetch a url. Retry up to 3 times. Optionally take a webdriver wait
         condition, as described at
         https://selenium-python.readthedocs.io/waits.html
 
+        Optionally take the type of page expected at url, or a tuple of
+        possible types, as declared in page_types. If the policy of one of
+        those types allows it, the page is first fetched over plain http,
+        and rendered in a browser only if its marker class is missing. The
+        wait condition defaults to the presence of the first type's marker.
+
+        Pages of a known type are read from and stored in the page cache, if
+        enabled in config, unless use_cache is False here or on the crawler.
+        Fetched pages are still stored in the cache when bypassing it.
+
         """
 
         self.html = None
+        self.soups = {}
 
         if self.pre_loaded_html:
             log.debug("Using pre-loaded html: %s.." % self.pre_loaded_html[0:50])
             self.html = self.pre_loaded_html
             self.pre_loaded_html = None
-        else:
-            log.debug("=> GET URL %s" % url)
-            retry = 4
-            while not self.html and retry:
-                retry = retry - 1
-
-                driver = self.get_webdriver()
-                if driver:
-                    try:
-                        log.info("Trying to fetch url %s" % url)
-                        # TODO: Use webdriver/selenium to fetch url
-                        driver.get(url)
-                        if wait_condition:
-                            WebDriverWait(driver, 10).until(wait_condition)
-                    except requests.exceptions.ConnectionError as e:
-                        if retry:
-                            log.warn("Got a ConnectionError. Sleeping %ssec and retrying..." % self.retry_delay)
-                            sleep(self.retry_delay)
-                        else:
-                            driver.close()
-                            raise e
-
-                    self.html = driver.page_source
-                    driver.close()
-
-                else:
-                    # Use browserless.io to fetch rendered pages
-
-                    # Huh? requests does not work against browserless??
-                    # r = requests.post(
-                    #     'https://chrome.browserless.io/content?token=%s' % get_config().browserless_api_key,
-                    #     data={
-                    #         'url': 'https://example.com/',
-                    #     },
-                    # )
-
-                    u = 'https://chrome.browserless.io/content?token=%s' % get_config().browserless_api_key
-                    data = '{"url": "%s"}' % url
-                    b = subprocess.check_output(['curl', '-X', 'POST', u, '-H', 'Cache-Control: no-cache', '-H', 'Content-Type: application/json', '-d', data])
-                    html = b.decode('utf-8')
-
-                    log.debug("Browserless replies: %s" % html[0:100])
-                    if '502 Bad Gateway' in html:
-                        if retry:
-                            log.debug("Bad gateway, duh. Sleep %ssec and retry" % self.retry_delay)
-                            sleep(self.retry_delay)
-                        else:
-                            raise Exception("Browserless: Bad gateway")
-                    else:
-                        self.html = html
+            return True
+
+        log.debug("=> GET URL %s" % url)
+        note_url(url)
+        page_types = self.get_page_types(page_type)
+        cache = get_page_cache() if page_types else None
+
+        if cache and use_cache and self.use_cache:
+            with get_metrics().time('cache', self.source):
+                self.html = cache.get(url)
+            if self.html:
+                log.debug("Got %s from page cache" % url)
+                self.count_fetched_page('cache')
+                return True
+
+        if page_types:
+            with get_metrics().time('static_fetch', self.source):
+                self.html = self.fetch_static(url, page_types)
+            if self.html:
+                self.count_fetched_page('static')
+            if not wait_condition:
+                wait_condition = EC.presence_of_element_located((By.CLASS_NAME, page_types[0]['marker']))
+
+        if not self.html:
+            with get_metrics().time('render', self.source):
+                self.html = self.render_url(url, wait_condition=wait_condition)
+            if self.html:
+                self.count_fetched_page('render')
 
         if not self.html:
             log.debug("Failed to get HTML from %s" % url)
             return False
 
-        self.soup = BeautifulSoup(self.html, 'lxml')
+        if cache:
+            self.cache_page(cache, url, page_types)
 
-        slack_info(
-            self.source.upper(),
-            "fetched %s" % url,
-            channel=get_config().slack_urls,
-        )
+        slack_fetched(self.source, url)
 
         return True
 
 
-    def get_soup(self):
-        """Return the beautifulsoup for the current page. None if no page loaded"""
-        return self.soup
+    def count_fetched_page(self, method):
+        """Count the current page as fetched that way"""
+        metrics = get_metrics()
+        metrics.inc('crawler_pages_total', source=self.source, method=method)
+        metrics.inc('crawler_bytes_total', len(self.html), source=self.source, method=method)
+
+
+    def cache_page(self, cache, url, page_types):
+        """Store the current page in the cache, with the ttl of the first of
+        page_types whose marker it contains. Pages matching none of them,
+        like error pages, are not cached"""
+        for t in page_types:
+            if t.get('cache_ttl') and has_class(self.html, t['marker']):
+                cache.put(url, self.html, t['cache_ttl'])
+                return
+
+
+    def get_page_types(self, page_type):
+        """Return the list of fetch policies for the given page type(s)"""
+        if not page_type:
+            return []
+        if type(page_type) is str:
+            page_type = (page_type, )
+        return [self.page_types[t] for t in page_type]
+
+
+    def fetch_static(self, url, page_types):
+        """Fetch url over plain http if one of page_types allows it, and return
+        its html if it contains the marker of one of those page types, else
+        None"""
+
+        if not getattr(get_config(), 'static_fetch', True):
+            return None
+
+        static_types = [t for t in page_types if t.get('static')]
+        if not static_types:
+            return None
+
+        log.info("Trying static fetch of url %s" % url)
+        with get_scheduler().slot(url) as slot:
+            slot.status, html = get_static_fetcher().fetch(url)
+            if slot.status is None:
+                slot.fail()
+        if not html:
+            return None
+
+        for t in static_types:
+            if has_class(html, t['marker']):
+                return html
+
+        log.info("Static fetch of %s lacks marker %s - Rendering it instead" % (url, ', '.join([t['marker'] for t in static_types])))
+        return None
+
+
+    def render_url(self, url, wait_condition=None):
+        """Render url in a browser, either a local chrome or browserless.io, and
+        return its html. Retry up to 3 times, waiting for the host scheduler
+        to let each attempt through"""
+
+        html = None
+        retry = 4
+        while not html and retry:
+            retry = retry - 1
+            try:
+                html = self.render_hedged(url, wait_condition=wait_condition)
+            except (requests.exceptions.ConnectionError, RenderServiceBusyError) as e:
+                if not retry:
+                    raise e
+                log.warn("%s: %s - Retrying..." % (type(e).__name__, str(e)))
+                get_metrics().inc('crawler_retries_total', source=self.source)
+
+        return html
+
+
+    def render_hedged(self, url, wait_condition=None):
+        """Render url once. If hedging, and the render takes longer than most
+        renders do, render it again in parallel on another idle browser or on
+        browserless.io, and return the first html rendered"""
+
+        hedger = get_hedger() if self.hedge else None
+        if not hedger:
+            return self.render_once(url, wait_condition=wait_condition)
+
+        return hedger.run(
+            lambda cancelled: self.render_once(url, wait_condition=wait_condition, cancelled=cancelled),
+            lambda cancelled: self.render_once(url, wait_condition=wait_condition, cancelled=cancelled, is_hedge=True),
+        )
+
+
+    def render_once(self, url, wait_condition=None, cancelled=None, is_hedge=False):
+        """Render url in a local chrome if available, or else on browserless.io.
+        Hedges use only an idle chrome, or else browserless.io. Stop waiting
+        for wait_condition once 'cancelled' is set"""
+
+        metrics = get_metrics()
+        with metrics.time('chrome_checkout', self.source):
+            driver = self.get_webdriver(blocking=not is_hedge)
+        if driver:
+            broken = False
+            try:
+                with get_scheduler().slot(url):
+                    log.info("Trying to fetch url %s" % url)
+                    with metrics.time('chrome_get', self.source):
+                        driver.get(url)
+                    if wait_condition:
+                        with metrics.time('webdriver_wait', self.source):
+                            WebDriverWait(driver, 10).until(lambda d: (cancelled and cancelled.is_set()) or wait_condition(d))
+                    if cancelled and cancelled.is_set():
+                        return None
+                    return driver.page_source
+            except requests.exceptions.ConnectionError:
+                broken = True
+                raise
+            finally:
+                self.release_webdriver(driver, broken=broken)
+
+        # Use browserless.io to fetch rendered pages. Its failures are its
+        # own, and only it backs off
+        client = get_browserless_client()
+        with get_scheduler().slot(url, backoff=False), get_scheduler().slot(client.base_url):
+            with metrics.time('browserless', self.source):
+                html = client.content(url)
+        log.debug("Browserless replies: %s" % html[0:100])
+        return html
+
+
+    def get_soup(self, parse_only=None):
+        """Return the beautifulsoup for the current page. None if no page loaded.
+
+        The page is parsed on the first call only. Optionally take a css class,
+        or a tuple of css classes, and parse only the elements having one of
+        those classes, along with their subtrees.
+
+        """
+
+        if self.html is None:
+            return None
+
+        if type(parse_only) is str:
+            parse_only = (parse_only, )
+
+        if parse_only not in self.soups:
+            strainer = None
+            if parse_only:
+                # Strainers may see the raw, unsplit class attribute
+                classes = set(parse_only)
+                strainer = SoupStrainer(class_=lambda c: c is not None and not classes.isdisjoint(c.split()))
+            with get_metrics().time('parse', self.source):
+                self.soups[parse_only] = BeautifulSoup(self.html, 'lxml', parse_only=strainer)
+
+        return self.soups[parse_only]
 
 
     def html_to_text(self, html):
-        """Take some html text and return a text string, cleaned up of all html and normalized"""
-        s = html2text(html)
-        s = htmlparser.unescape(s)
-        s = s.replace('\.', '.')
-        s = s.replace('\*', '*')
-        s = re.sub(re.compile('^[\s]+', re.MULTILINE), '', s)
-        s = re.sub(re.compile('[\s]+$', re.MULTILINE), '', s)
-        return s
+        """Take some html, as a string or a beautifulsoup element, and return a
+        text string, cleaned up of all html and normalized"""
+        with get_metrics().time('html_to_text', self.source):
+            return text.html_to_text(html)
 
 
     def find_number(self, html):
-        s = self.html_to_text(html)
-        s = re.sub(re.compile('[\r\n]+', re.MULTILINE), '', s)
-        s = re.sub(r'^[^\d]*', '', s)
-        s = re.sub(r'[^\d]*$', '', s)
-        s = s.replace(' ', '')
-        return int(s)
+        """Return the number found in some html, as a string or a beautifulsoup
+        element"""
+        if not isinstance(html, str) or '<' in html or '&' in html:
+            html = self.html_to_text(html)
+        return parse_number(html)
 
 
     def date_to_epoch(self, s, tzname=None):
@@ -231,19 +467,4 @@ class GenericCrawler():
         epoch, assuming Stockholm's timezone by default
 
         """
-
-        # Convert first to a naive date
-        date = parser.parse(s, ignoretz=True)
-
-        # And add the timezone
-        if not tzname:
-            tz = pytz.timezone('Europe/Stockholm')
-        else:
-            tz = pytz.timezone(tzname)
-        date = tz.localize(date)
-
-        assert date.tzinfo
-
-        t0 = datetime(1970, 1, 1, tzinfo=timezone.utc)
-        delta = (date - t0) / timedelta(seconds=1)
-        return int(delta)
+        return dates.date_to_epoch(s, tzname=tzname)
@@ -0,0 +1,101 @@
+import re
+import logging
+from calendar import timegm
+from functools import lru_cache
+from datetime import datetime
+from dateutil import parser
+import pytz
+
+
+log = logging.getLogger(__name__)
+
+
+# Dates found on Swedish sites have no timezone, and are in Stockholm's time
+DEFAULT_TIMEZONE = 'Europe/Stockholm'
+
+# How many distinct date strings to remember
+DATE_CACHE_SIZE = 4096
+
+# Swedish month names and abbreviations, and their english counterparts
+MONTHS = {
+    'jan': 1, 'januari': 1, 'january': 1,
+    'feb': 2, 'februari': 2, 'february': 2,
+    'mar': 3, 'mars': 3, 'march': 3,
+    'apr': 4, 'april': 4,
+    'maj': 5, 'may': 5,
+    'jun': 6, 'juni': 6, 'june': 6,
+    'jul': 7, 'juli': 7, 'july': 7,
+    'aug': 8, 'augusti': 8, 'august': 8,
+    'sep': 9, 'sept': 9, 'september': 9,
+    'okt': 10, 'oct': 10, 'oktober': 10, 'october': 10,
+    'nov': 11, 'november': 11,
+    'dec': 12, 'december': 12,
+}
+
+# '2019-05-16 10:29', as in tradera's publication dates
+RE_ISO_DATE = re.compile(r'^\s*(\d{4})-(\d{1,2})-(\d{1,2})[ T](\d{1,2}):(\d{2})(?::(\d{2}))?\s*$')
+
+# '30 maj 10:31' or '23 May 2019 20:57:00', as in tradera's end dates
+RE_DAY_MONTH_DATE = re.compile(r'^\s*(\d{1,2})\s+([a-zA-Z]+)\.?(?:\s+(\d{4}))?\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s*$')
+
+# dateutil only knows english months
+RE_SWEDISH_MONTHS = re.compile(r'\b(maj|okt)\b')
+SWEDISH_TO_ENGLISH = {'maj': 'may', 'okt': 'oct'}
+
+
+@lru_cache(maxsize=None)
+def get_timezone(tzname):
+    return pytz.timezone(tzname)
+
+
+def parse_date(s, year=None):
+    """Parse a date string without timezone into a naive datetime. Dates
+    without a year are assumed to be in 'year', or in the current year"""
+    return parse_date_in_year(s, year if year else datetime.now().year)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date_in_year(s, year):
+    m = RE_ISO_DATE.match(s)
+    if m:
+        return datetime(*[int(g or 0) for g in m.groups()])
+
+    m = RE_DAY_MONTH_DATE.match(s)
+    if m and m.group(2).lower() in MONTHS:
+        day, month, y, hour, minute, second = m.groups()
+        return datetime(
+            int(y) if y else year,
+            MONTHS[month.lower()],
+            int(day),
+            int(hour),
+            int(minute),
+            int(second or 0),
+        )
+
+    log.debug("Parsing date [%s] with dateutil" % s)
+    s = RE_SWEDISH_MONTHS.sub(lambda m: SWEDISH_TO_ENGLISH[m.group(1)], s)
+    # Not dateutil's default of today, which the cache would outlive
+    return parser.parse(s, ignoretz=True, default=datetime(year, 1, 1))
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def get_utc_offset(tzname, hour):
+    """Return the utc offset in seconds of a timezone at a naive datetime
+    truncated to the hour. Timezones change offset on the hour, so that all
+    dates in that hour share it"""
+    return int(get_timezone(tzname).localize(hour).utcoffset().total_seconds())
+
+
+def date_to_epoch(s, tzname=None):
+    """Parse a date string without timezone, like 'YYYY-MM-DD HH:MM', into an
+    epoch, assuming Stockholm's timezone by default. Dates without a year
+    are assumed to be in the current year"""
+    return date_in_year_to_epoch(s, tzname if tzname else DEFAULT_TIMEZONE, datetime.now().year)
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def date_in_year_to_epoch(s, tzname, year):
+    # The year is part of the cache's key, for dates without one
+    date = parse_date_in_year(s, year)
+    hour = date.replace(minute=0, second=0, microsecond=0)
+    return timegm(date.timetuple()) - get_utc_offset(tzname, hour)
@@ -49,6 +49,12 @@ error_definitions = [
     ('SKIP_ITEM_ERROR', 404, 'SkipThisItem', lambda s: s),
     ('UNKNOWN_SOURCE_ERROR', 404, 'UnknownSourceError', lambda s: s),
     ('API_CALL_ERROR', 500, 'ApiCallError', lambda s: s),
+    ('RENDER_SERVICE_BUSY', 503, 'RenderServiceBusyError', lambda s: s),
+    ('RENDER_SERVICE_ERROR', 502, 'RenderServiceError', lambda s: s),
+    ('WEBDRIVER_POOL_BUSY', 503, 'WebdriverPoolBusyError', lambda s: s),
+    ('JOB_NOT_FOUND', 404, 'JobNotFoundError', lambda s: s),
+    ('JOB_NOT_QUEUED', 409, 'JobNotQueuedError', lambda s: s),
+    ('PROFILE_NOT_FOUND', 404, 'ProfileNotFoundError', lambda s: s),
 ]
 
 
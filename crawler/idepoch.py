@@ -0,0 +1,117 @@
+import logging
+import threading
+from bisect import bisect_left
+from collections import deque
+from pymacaron.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+# Sites number their announces in order of publication, so that an
+# announce's id tells roughly when it was published. An IdEpochModel learns
+# that relation from the announces scraped in full, and estimates the
+# publication epoch of announces known only by their id, as found in the
+# urls of listing pages.
+
+# How many (id, epoch) points to remember per source
+MAX_POINTS = 256
+
+# Seconds of uncertainty added to any extrapolated epoch
+DEFAULT_MARGIN = 900
+
+# Extrapolated epochs are also uncertain by that share of the time between
+# them and the nearest known point
+EXTRAPOLATION_ERROR = 0.25
+
+
+class IdEpochModel():
+    """Estimate the publication epoch of an announce from its numeric id.
+
+    Between two known points, the epoch is bounded by theirs. Beyond the
+    known points, it is extrapolated from the average rate at which ids grow,
+    with a margin of error growing with the distance to the known points.
+
+    """
+
+    def __init__(self, max_points=MAX_POINTS, margin=DEFAULT_MARGIN):
+        self.max_points = max_points
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.epochs = {}
+        self.ids = []
+        self.added = deque()
+
+
+    def add(self, doc_id, epoch):
+        """Learn that the announce with that id was published at that epoch"""
+        doc_id = int(doc_id)
+        with self.lock:
+            if doc_id not in self.epochs:
+                self.ids.insert(bisect_left(self.ids, doc_id), doc_id)
+                self.added.append(doc_id)
+            self.epochs[doc_id] = epoch
+
+            # Forget the oldest learnt points
+            while len(self.added) > self.max_points:
+                forgotten = self.added.popleft()
+                del self.epochs[forgotten]
+                self.ids.pop(bisect_left(self.ids, forgotten))
+
+
+    def estimate(self, doc_id):
+        """Return the (lowest, highest) possible epochs of the announce with
+        that id, either of which may be None if unbounded"""
+        doc_id = int(doc_id)
+        with self.lock:
+            if not self.ids:
+                return None, None
+
+            i = bisect_left(self.ids, doc_id)
+            if i < len(self.ids) and self.ids[i] == doc_id:
+                epoch = self.epochs[doc_id]
+                return epoch, epoch
+
+            if 0 < i < len(self.ids):
+                a, b = self.epochs[self.ids[i - 1]], self.epochs[self.ids[i]]
+                return min(a, b), max(a, b)
+
+            if len(self.ids) < 2:
+                epoch = self.epochs[self.ids[0]]
+                return (epoch, None) if i else (None, epoch)
+
+            id_min, id_max = self.ids[0], self.ids[-1]
+            rate = (self.epochs[id_max] - self.epochs[id_min]) / (id_max - id_min)
+            nearest = id_max if i else id_min
+            epoch = self.epochs[nearest]
+
+        estimate = epoch + (doc_id - nearest) * rate
+        error = self.margin + EXTRAPOLATION_ERROR * abs(estimate - epoch)
+        if i:
+            return max(epoch, estimate - error), estimate + error
+        return estimate - error, min(epoch, estimate + error)
+
+
+    def compare(self, doc_id, epoch):
+        """Return 1 if the announce with that id was surely published at or
+        after epoch, -1 if surely before, and 0 if the model can't tell"""
+        low, high = self.estimate(doc_id)
+        if low is not None and low >= epoch:
+            return 1
+        if high is not None and high < epoch:
+            return -1
+        return 0
+
+
+models = {}
+models_lock = threading.Lock()
+
+
+def get_id_epoch_model(source):
+    """Return the process-wide id to epoch model of that source"""
+    with models_lock:
+        if source not in models:
+            models[source] = IdEpochModel(
+                margin=getattr(get_config(), 'id_epoch_margin', DEFAULT_MARGIN),
+            )
+        return models[source]
@@ -0,0 +1,83 @@
+import json
+import random
+import logging
+import requests
+from contextlib import contextmanager
+from flask import Flask
+from pymacaron_core.swagger.apipool import ApiPool
+from crawler.exceptions import ApiCallError
+from crawler.exceptions import InvalidDataError
+
+
+try:
+    from flask import _app_ctx_stack as stack
+except ImportError:
+    from flask import _request_ctx_stack as stack
+
+
+log = logging.getLogger(__name__)
+
+
+# Reuse connections to the BDL api
+session = requests.Session()
+
+# A bare flask app, to hold the auth token of calls made outside of the
+# request that asked for them, as from background threads
+flaskapp = Flask(__name__)
+
+
+@contextmanager
+def auth_token(token):
+    """Make token the auth token that calls to the BDL api made by the current
+    thread send"""
+    with flaskapp.app_context():
+        stack.top.current_user = {'token': token}
+        yield
+
+
+def validate_scraped_objects(objects, rate=1.0):
+    """Validate a random sample of scraped objects, in json form, against the
+    BDL api's ScrapedObject definition"""
+    if not rate:
+        return
+    for j in objects:
+        if rate >= 1 or random.random() < rate:
+            try:
+                ApiPool.api.api_spec.validate('ScrapedObject', j)
+            except Exception as e:
+                raise InvalidDataError("Scraped object does not validate: %s (%s)" % (str(e), json.dumps(j)))
+
+
+def post_scraped_objects(source, objects, token, timeout=30):
+    """Send a list of scraped objects, already in json form, to the BDL api's
+    process_items endpoint with that auth token, bypassing the generated
+    client and its model conversions"""
+
+    spec = ApiPool.api.api_spec
+    url = '%s://%s:%s/v1/items/process' % (spec.protocol, spec.host, spec.port)
+
+    data = json.dumps({
+        'index': 'BDL',
+        'source': source.upper(),
+        'real': True,
+        'objects': objects,
+    })
+
+    r = session.post(
+        url,
+        data=data,
+        headers={
+            'Content-Type': 'application/json',
+            'Authorization': 'Bearer %s' % token,
+        },
+        timeout=timeout,
+    )
+
+    if r.status_code != 200:
+        try:
+            msg = r.json().get('error_description', r.text)
+        except ValueError:
+            msg = r.text
+        raise ApiCallError("Flush error: %s" % msg)
+
+    return r.json()
@@ -0,0 +1,94 @@
+import logging
+import threading
+import requests
+import requests.exceptions
+from requests.adapters import HTTPAdapter
+from pymacaron.config import get_config
+from crawler.exceptions import RenderServiceBusyError
+from crawler.exceptions import RenderServiceError
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_BROWSERLESS_URL = 'https://chrome.browserless.io'
+DEFAULT_MAX_CONCURRENT = 2
+DEFAULT_TIMEOUT = 60
+
+
+class BrowserlessClient():
+    """A client for browserless.io's /content endpoint, returning the html of
+    rendered pages.
+
+    Connections are kept alive and pooled, and no more than 'max_concurrent'
+    renders are in flight at once, matching the service's concurrency limit.
+    Errors are classified by status code: RenderServiceBusyError when the
+    service is throttling or failing and the render may be retried, and
+    RenderServiceError when retrying would not help.
+
+    """
+
+    def __init__(self, base_url=DEFAULT_BROWSERLESS_URL, token=None, max_concurrent=DEFAULT_MAX_CONCURRENT, timeout=DEFAULT_TIMEOUT):
+        assert max_concurrent > 0
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Cache-Control': 'no-cache',
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def content(self, url, wait_for_selector=None):
+        """Render url and return its html"""
+
+        data = {'url': url}
+        if wait_for_selector:
+            data['waitFor'] = wait_for_selector
+
+        params = {}
+        if self.token:
+            params['token'] = self.token
+
+        with self.slots:
+            try:
+                r = self.session.post(
+                    self.base_url + '/content',
+                    params=params,
+                    json=data,
+                    timeout=self.timeout,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                raise RenderServiceBusyError("Browserless: failed to render %s: %s" % (url, str(e)))
+
+        if r.status_code == 200:
+            return r.text
+
+        msg = "Browserless: got status %s when rendering %s: %s" % (r.status_code, url, r.text[0:200])
+        if r.status_code == 429 or r.status_code >= 500:
+            raise RenderServiceBusyError(msg)
+        raise RenderServiceError(msg)
+
+
+client = None
+client_lock = threading.Lock()
+
+
+def get_browserless_client():
+    """Return the process-wide browserless client, configured from pym-config"""
+    global client
+    with client_lock:
+        if not client:
+            conf = get_config()
+            client = BrowserlessClient(
+                base_url=getattr(conf, 'browserless_url', DEFAULT_BROWSERLESS_URL),
+                token=getattr(conf, 'browserless_api_key', None),
+                max_concurrent=getattr(conf, 'browserless_max_concurrent', DEFAULT_MAX_CONCURRENT),
+            )
+    return client
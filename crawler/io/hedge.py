@@ -0,0 +1,170 @@
+import logging
+import threading
+from time import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+from pymacaron.config import get_config
+from pymacaron.exceptions import PyMacaronException
+from crawler.io.profiler import propagate
+
+
+log = logging.getLogger(__name__)
+
+
+# Hedge attempts still running after that percentile of recent latencies
+DEFAULT_PERCENTILE = 95
+
+# Bounds of the hedging delay, and the delay used until enough latencies are
+# known
+DEFAULT_MIN_DELAY = 1.0
+DEFAULT_DELAY = 5.0
+MIN_SAMPLES = 20
+WINDOW = 200
+
+# Hedge at most that share of calls, with that many hedges in a burst
+DEFAULT_BUDGET_RATIO = 0.1
+DEFAULT_BUDGET_BURST = 3
+
+DEFAULT_MAX_WORKERS = 16
+
+
+class Hedger():
+    """Run an attempt, and if it hasn't completed after a delay derived from
+    the latencies of recent attempts, start a hedge attempt in parallel. The
+    first attempt to return a result wins, and the other is told to give up
+    through the 'cancelled' event both are called with.
+
+    Hedges are limited by a budget: each call earns 'budget_ratio' hedge,
+    up to 'budget_burst' hedges saved, so that hedging never multiplies the
+    load when the backend is slow across the board.
+
+    """
+
+    def __init__(self, percentile=DEFAULT_PERCENTILE, min_delay=DEFAULT_MIN_DELAY, default_delay=DEFAULT_DELAY, budget_ratio=DEFAULT_BUDGET_RATIO, budget_burst=DEFAULT_BUDGET_BURST, max_workers=DEFAULT_MAX_WORKERS):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.default_delay = default_delay
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.budget = budget_burst
+        self.latencies = deque(maxlen=WINDOW)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self.lock = threading.Lock()
+
+        self.count_calls = 0
+        self.count_hedges = 0
+        self.count_hedge_wins = 0
+        self.count_over_budget = 0
+
+
+    def get_delay(self):
+        """Return how long to wait for an attempt before hedging it"""
+        with self.lock:
+            if len(self.latencies) < MIN_SAMPLES:
+                return self.default_delay
+            latencies = sorted(self.latencies)
+        i = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return max(self.min_delay, latencies[i])
+
+
+    def add_latency(self, sec):
+        with self.lock:
+            self.latencies.append(sec)
+
+
+    def take_budget(self):
+        """Return True if a hedge may be sent"""
+        with self.lock:
+            if self.budget >= 1:
+                self.budget -= 1
+                self.count_hedges += 1
+                return True
+            self.count_over_budget += 1
+            return False
+
+
+    def run(self, attempt, hedge):
+        """Call attempt(cancelled), hedged by hedge(cancelled) if slow, and
+        return the first result that is not None. Raise the error of the last
+        failed attempt if none succeeded"""
+
+        with self.lock:
+            self.count_calls += 1
+            self.budget = min(self.budget_burst, self.budget + self.budget_ratio)
+
+        cancelled = threading.Event()
+        time_start = time()
+
+        # When each attempt started. Only the winner's latency is recorded:
+        # the loser usually completes too, late, once told to give up
+        started = {}
+        first = self.executor.submit(propagate(attempt), cancelled)
+        started[first] = time_start
+        pending = set([first])
+
+        done, _ = wait(pending, timeout=self.get_delay())
+        if not done and self.take_budget():
+            log.info("Attempt still running after %.1fsec - Hedging it" % (time() - time_start))
+            f = self.executor.submit(propagate(hedge), cancelled)
+            started[f] = time()
+            pending.add(f)
+
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    try:
+                        result = f.result()
+                    except (Exception, PyMacaronException) as e:
+                        error = e
+                        continue
+                    if result is not None:
+                        self.add_latency(time() - started[f])
+                        if f is not first:
+                            with self.lock:
+                                self.count_hedge_wins += 1
+                        return result
+        finally:
+            cancelled.set()
+            for f in pending:
+                f.cancel()
+
+        if error:
+            raise error
+        return None
+
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'calls': self.count_calls,
+                'hedges': self.count_hedges,
+                'hedge_wins': self.count_hedge_wins,
+                'over_budget': self.count_over_budget,
+                'budget': self.budget,
+            }
+
+
+hedger = None
+hedger_lock = threading.Lock()
+
+
+def get_hedger():
+    """Return the process-wide hedger, or None if hedging is disabled in
+    config"""
+    global hedger
+    conf = get_config()
+    if not getattr(conf, 'hedge_renders', False):
+        return None
+    with hedger_lock:
+        if not hedger:
+            hedger = Hedger(
+                percentile=float(getattr(conf, 'hedge_percentile', DEFAULT_PERCENTILE)),
+                min_delay=float(getattr(conf, 'hedge_min_delay', DEFAULT_MIN_DELAY)),
+                default_delay=float(getattr(conf, 'hedge_default_delay', DEFAULT_DELAY)),
+                budget_ratio=float(getattr(conf, 'hedge_budget_ratio', DEFAULT_BUDGET_RATIO)),
+            )
+    return hedger
@@ -0,0 +1,362 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import tempfile
+import threading
+from pymacaron.config import get_config
+from pymacaron.exceptions import PyMacaronException
+from crawler.exceptions import JobNotQueuedError
+
+
+log = logging.getLogger(__name__)
+
+
+QUEUED = 'QUEUED'
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+LOST = 'LOST'
+
+# How many jobs of one source may run at once, unless overridden per source
+# in config
+DEFAULT_MAX_RUNNING = 2
+
+# Jobs report progress that often, and a queued or running job that hasn't
+# reported for stale_sec is considered lost (its worker died)
+HEARTBEAT_SEC = 10
+DEFAULT_STALE_SEC = 300
+
+# How often a queued job checks whether it may start
+POLL_SEC = 1
+
+DEFAULT_MAX_AGE_DAYS = 2
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-jobs.sqlite')
+
+COLUMNS = (
+    'job_id',
+    'kind',
+    'source',
+    'native_url',
+    'epoch_oldest',
+    'epoch_youngest',
+    'state',
+    'count',
+    'error',
+    'epoch_created',
+    'epoch_started',
+    'epoch_ended',
+    'epoch_heartbeat',
+)
+
+
+def contains(oldest, youngest, inner_oldest, inner_youngest):
+    """Return True if the epoch window [oldest, youngest] contains the inner
+    one. A missing bound is open"""
+    if oldest is not None and (inner_oldest is None or inner_oldest < oldest):
+        return False
+    if youngest is not None and (inner_youngest is None or inner_youngest > youngest):
+        return False
+    return True
+
+
+def union(oldest, youngest, other_oldest, other_youngest):
+    """Return the smallest epoch window containing both windows. A missing
+    bound is open"""
+    if oldest is not None:
+        oldest = None if other_oldest is None else min(oldest, other_oldest)
+    if youngest is not None:
+        youngest = None if other_youngest is None else max(youngest, other_youngest)
+    return oldest, youngest
+
+
+def get_settings_hash(settings):
+    """Return a digest of a job's settings, or None if it has none"""
+    if not settings:
+        return None
+    return hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class JobRegistry():
+    """Track asynchronous jobs (scans, scrapes) in a sqlite database shared by
+    the api server and the async workers of this host.
+
+    submit() returns the id of an identical job already queued or running
+    instead of registering a new one: same kind, source, url and settings.
+    A queued job has not fetched anything yet, and its epoch window is
+    widened to cover the new one, while a running job must have an epoch
+    window containing the new one. Workers wait in start() until fewer than
+    the source's limit of jobs are running, in the order jobs were
+    submitted, and read the job's window from the registry once started.
+
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_running=DEFAULT_MAX_RUNNING, limits=None, stale_sec=DEFAULT_STALE_SEC, max_age_days=DEFAULT_MAX_AGE_DAYS, clock=time.time, sleep=time.sleep):
+        self.path = path
+        self.max_running = max_running
+        self.limits = limits if limits else {}
+        self.stale_sec = stale_sec
+        self.max_age_days = max_age_days
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            '  job_id TEXT PRIMARY KEY,'
+            '  kind TEXT NOT NULL,'
+            '  source TEXT NOT NULL,'
+            '  native_url TEXT,'
+            '  epoch_oldest REAL,'
+            '  epoch_youngest REAL,'
+            '  settings_hash TEXT,'
+            '  state TEXT NOT NULL,'
+            '  count INTEGER NOT NULL DEFAULT 0,'
+            '  error TEXT,'
+            '  epoch_created REAL NOT NULL,'
+            '  epoch_started REAL,'
+            '  epoch_ended REAL,'
+            '  epoch_heartbeat REAL NOT NULL'
+            ')'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_source_state ON jobs (source, state)')
+
+
+    def get_limit(self, source):
+        return int(self.limits.get(source, self.max_running))
+
+
+    def _expire(self, now):
+        """Mark as lost the jobs whose worker stopped reporting, and forget old
+        jobs. Must be called within a transaction"""
+        cur = self.db.execute(
+            'UPDATE jobs SET state = ?, error = ?, epoch_ended = ? WHERE state IN (?, ?) AND epoch_heartbeat < ?',
+            (LOST, "No news from the job's worker for %s sec" % self.stale_sec, now, QUEUED, RUNNING, now - self.stale_sec),
+        )
+        if cur.rowcount:
+            log.warning("Marked %s jobs as lost" % cur.rowcount)
+        self.db.execute(
+            'DELETE FROM jobs WHERE state NOT IN (?, ?) AND epoch_created < ?',
+            (QUEUED, RUNNING, now - self.max_age_days * 86400),
+        )
+
+
+    def submit(self, kind, source, native_url=None, epoch_oldest=None, epoch_youngest=None, settings=None):
+        """Register a queued job, unless an identical one is already queued or
+        running. Return (job_id, True) for a new job, or (job_id, False) for
+        the identical one. Settings are a dict of whatever else changes what
+        the job does"""
+        settings_hash = get_settings_hash(settings)
+        now = self.clock()
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._expire(now)
+            cur = self.db.execute(
+                'SELECT job_id, state, epoch_oldest, epoch_youngest FROM jobs '
+                'WHERE kind = ? AND source = ? AND native_url IS ? AND settings_hash IS ? AND state IN (?, ?) ORDER BY epoch_created',
+                (kind, source, native_url, settings_hash, QUEUED, RUNNING),
+            )
+            for job_id, state, oldest, youngest in cur.fetchall():
+                if state == QUEUED:
+                    oldest, youngest = union(oldest, youngest, epoch_oldest, epoch_youngest)
+                    self.db.execute(
+                        'UPDATE jobs SET epoch_oldest = ?, epoch_youngest = ? WHERE job_id = ?',
+                        (oldest, youngest, job_id),
+                    )
+                    log.info("Job %s %s is already queued as job %s" % (kind, source, job_id))
+                    return job_id, False
+
+                # A newer window would lose the items after that job's
+                if contains(oldest, youngest, epoch_oldest, epoch_youngest):
+                    log.info("Job %s %s is already running as job %s" % (kind, source, job_id))
+                    return job_id, False
+
+            job_id = uuid.uuid4().hex
+            self.db.execute(
+                'INSERT INTO jobs (job_id, kind, source, native_url, epoch_oldest, epoch_youngest, settings_hash, state, epoch_created, epoch_heartbeat) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, kind, source, native_url, epoch_oldest, epoch_youngest, settings_hash, QUEUED, now, now),
+            )
+            return job_id, True
+
+
+    def try_start(self, job_id):
+        """Mark a queued job as running and return True if its source has room
+        for it, or return False and keep it queued. Return False as well if
+        the job is no longer queued, for example lost"""
+        now = self.clock()
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self._expire(now)
+            row = self.db.execute('SELECT source, state, epoch_created FROM jobs WHERE job_id = ?', (job_id, )).fetchone()
+            if not row:
+                log.warning("Unknown job %s - Running it untracked" % job_id)
+                return True
+            source, state, epoch_created = row
+            if state != QUEUED:
+                return False
+
+            # Jobs start in the order they were submitted
+            running, ahead = self.db.execute(
+                'SELECT SUM(state = ?), SUM(state = ? AND epoch_created < ? AND job_id != ?) FROM jobs WHERE source = ?',
+                (RUNNING, QUEUED, epoch_created, job_id, source),
+            ).fetchone()
+            if (running or 0) + (ahead or 0) < self.get_limit(source):
+                self.db.execute(
+                    'UPDATE jobs SET state = ?, epoch_started = ?, epoch_heartbeat = ? WHERE job_id = ?',
+                    (RUNNING, now, now, job_id),
+                )
+                return True
+
+            self.db.execute('UPDATE jobs SET epoch_heartbeat = ? WHERE job_id = ?', (now, job_id))
+            return False
+
+
+    def start(self, job_id):
+        """Block until the job may run, and mark it as running. Raise
+        JobNotQueuedError if the job is no longer queued"""
+        time_start = self.clock()
+        while not self.try_start(job_id):
+            job = self.get(job_id)
+            if job and job['state'] != QUEUED:
+                raise JobNotQueuedError("Job %s is %s and can't be started" % (job_id, job['state']))
+            self.sleep(POLL_SEC)
+        if self.clock() - time_start > POLL_SEC:
+            log.info("Job %s waited %.1fsec to start" % (job_id, self.clock() - time_start))
+
+
+    def update(self, job_id, count):
+        """Report a running job's progress"""
+        with self.lock:
+            self.db.execute(
+                'UPDATE jobs SET count = ?, epoch_heartbeat = ? WHERE job_id = ?',
+                (count, self.clock(), job_id),
+            )
+
+
+    def finish(self, job_id, count, error=None):
+        """Mark a job as done, or failed with that error"""
+        now = self.clock()
+        with self.lock:
+            self.db.execute(
+                'UPDATE jobs SET state = ?, count = ?, error = ?, epoch_ended = ?, epoch_heartbeat = ? WHERE job_id = ?',
+                (FAILED if error else DONE, count, error, now, now, job_id),
+            )
+
+
+    def get(self, job_id):
+        """Return the job as a dict, or None if unknown"""
+        with self.lock:
+            row = self.db.execute('SELECT %s FROM jobs WHERE job_id = ?' % ', '.join(COLUMNS), (job_id, )).fetchone()
+        if not row:
+            return None
+        return dict(zip(COLUMNS, row))
+
+
+    def run(self, job_id):
+        """Return a context manager running that job"""
+        return JobRun(self, job_id)
+
+
+class JobRun():
+    """Run a job as a context manager: wait for the job's turn on enter,
+    report its progress in the background, and record its outcome on exit.
+    Set 'counter' to a function returning how many items the job processed
+    so far, and get the job's epoch window with window().
+
+    With no registry or job_id, do nothing.
+
+    """
+
+    def __init__(self, registry, job_id):
+        self.registry = registry if job_id else None
+        self.job_id = job_id
+        self.counter = None
+        self.stopped = threading.Event()
+        self.reporter = None
+
+
+    def get_count(self):
+        return self.counter() if self.counter else 0
+
+
+    def window(self, epoch_oldest, epoch_youngest):
+        """Return the job's epoch window, which identical jobs submitted while
+        it was queued may have widened, or the given one if untracked"""
+        job = self.registry.get(self.job_id) if self.registry else None
+        if not job:
+            return epoch_oldest, epoch_youngest
+        return job['epoch_oldest'], job['epoch_youngest']
+
+
+    def report(self):
+        while not self.stopped.wait(HEARTBEAT_SEC):
+            try:
+                self.registry.update(self.job_id, self.get_count())
+            except Exception as e:
+                log.warning("Failed to report progress of job %s: %s" % (self.job_id, str(e)))
+
+
+    def __enter__(self):
+        if self.registry:
+            self.registry.start(self.job_id)
+            self.reporter = threading.Thread(target=self.report, name='job-%s' % self.job_id, daemon=True)
+            self.reporter.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.registry:
+            self.stopped.set()
+            self.reporter.join()
+            error = None
+            if exc_type:
+                error = '%s: %s' % (exc_type.__name__, str(exc_value))
+            self.registry.finish(self.job_id, self.get_count(), error=error)
+        return False
+
+
+job_registry = None
+job_registry_lock = threading.Lock()
+
+
+def get_job_registry():
+    """Return the process-wide job registry, or None if disabled in config"""
+    global job_registry
+    conf = get_config()
+    if not getattr(conf, 'job_registry', False):
+        return None
+    with job_registry_lock:
+        if not job_registry:
+            job_registry = JobRegistry(
+                path=getattr(conf, 'job_registry_path', None) or DEFAULT_PATH,
+                max_running=int(getattr(conf, 'job_max_running', DEFAULT_MAX_RUNNING)),
+                limits=getattr(conf, 'job_limits', None),
+                stale_sec=float(getattr(conf, 'job_stale_sec', DEFAULT_STALE_SEC)),
+            )
+    return job_registry
+
+
+def run_job(job_id):
+    """Return a context manager running that job, tracked in the registry if
+    enabled"""
+    return JobRun(get_job_registry(), job_id)
+
+
+def dispatch_job(f, source, job_id=None, **kwargs):
+    """Call f(source, job_id=job_id, **kwargs) to hand that job to an async
+    worker. If that fails, mark the job as failed, so that it doesn't hold
+    back identical jobs until it is found lost"""
+    try:
+        f(source, job_id=job_id, **kwargs)
+    except (Exception, PyMacaronException) as e:
+        registry = get_job_registry()
+        if registry and job_id:
+            registry.finish(job_id, 0, error='Failed to dispatch job: %s: %s' % (type(e).__name__, str(e)))
+        raise
@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import atexit
+import logging
+import sqlite3
+import tempfile
+import threading
+from bisect import bisect_left
+from pymacaron.config import get_config
+from crawler.exceptions import ConsumerLimitReachedError
+from crawler.exceptions import ConsumerEpochReachedError
+from crawler.exceptions import SkipThisItem
+from crawler.io.pagecache import get_page_cache
+from crawler.io.scheduler import get_scheduler
+from crawler.io.hedge import get_hedger
+from crawler.io.singleflight import get_single_flight
+
+
+log = logging.getLogger(__name__)
+
+
+# Upper bounds of the latency histograms' buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# How often each process adds its metrics to the store, if enabled
+PUSH_SEC = 10
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-metrics.sqlite')
+
+# Exceptions that stop a crawl or skip an item on purpose, and are not errors
+CONTROL_ERRORS = (ConsumerLimitReachedError, ConsumerEpochReachedError, SkipThisItem)
+
+DEFINITIONS = {
+    'crawler_stage_seconds': ('histogram', 'Time spent in each stage of the crawl pipeline'),
+    'crawler_errors_total': ('counter', 'Errors raised by each stage of the crawl pipeline'),
+    'crawler_pages_total': ('counter', 'Pages fetched, by how they were fetched'),
+    'crawler_bytes_total': ('counter', 'Bytes of html fetched, by how they were fetched'),
+    'crawler_retries_total': ('counter', 'Renders retried after a connection or busy error'),
+    'crawler_items_total': ('counter', 'Items accepted by consumers'),
+    'crawler_items_skipped_total': ('counter', 'Items skipped as already sent to BDL'),
+    'crawler_items_flushed_total': ('counter', 'Items sent to BDL'),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for k, v in labels:
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (k, v))
+    return '{%s}' % ','.join(escaped)
+
+
+def format_value(v):
+    v = float(v)
+    if v.is_integer():
+        return str(int(v))
+    return repr(v)
+
+
+def render(counters, histograms, gauges=None):
+    """Return counters, as a dict of (name, labels) to value, and histograms,
+    as a dict of (name, labels) to (bucket counts, sum, count), as text.
+    Optionally take gauges to add, as a dict of name to (help, [(labels
+    dict, value), ...])"""
+
+    series = {}
+    for (name, labels), v in sorted(counters.items()):
+        series.setdefault(name, []).append('%s%s %s' % (name, format_labels(labels), format_value(v)))
+    for (name, labels), (counts, total, count) in sorted(histograms.items()):
+        lines = series.setdefault(name, [])
+        cumulated = 0
+        for le, c in zip(BUCKETS, counts):
+            cumulated += c
+            lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', str(le)), )), cumulated))
+        lines.append('%s_bucket%s %s' % (name, format_labels(labels + (('le', '+Inf'), )), count))
+        lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+        lines.append('%s_count%s %s' % (name, format_labels(labels), count))
+
+    out = []
+    for name in sorted(series.keys()):
+        kind, help = DEFINITIONS.get(name, ('untyped', name))
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s %s' % (name, kind))
+        out.extend(series[name])
+
+    for name, (help, values) in sorted((gauges or {}).items()):
+        out.append('# HELP %s %s' % (name, help))
+        out.append('# TYPE %s gauge' % name)
+        for labels, v in values:
+            if v is None:
+                continue
+            out.append('%s%s %s' % (name, format_labels(tuple(sorted(labels.items()))), format_value(v)))
+
+    return '\n'.join(out) + '\n'
+
+
+class Histogram():
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0
+        self.count = 0
+
+
+    def observe(self, value):
+        i = bisect_left(BUCKETS, value)
+        if i < len(BUCKETS):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Timer():
+    """Time a stage of the pipeline as a context manager, and count its
+    errors"""
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.time_start = None
+
+
+    def __enter__(self):
+        self.time_start = time.monotonic()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe('crawler_stage_seconds', time.monotonic() - self.time_start, **self.labels)
+        if exc_type and not issubclass(exc_type, CONTROL_ERRORS):
+            self.metrics.inc('crawler_errors_total', **self.labels)
+        return False
+
+
+class Metrics():
+    """Counters and latency histograms, labelled, rendered in the Prometheus
+    text exposition format"""
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+
+    def time(self, stage, source=None):
+        """Return a context manager timing that stage"""
+        return Timer(self, {'source': source or '', 'stage': stage})
+
+
+    def snapshot(self, reset=False):
+        """Return (counters, histograms) as taken by render(), and forget
+        them if reset"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {}
+            for key, h in self.histograms.items():
+                histograms[key] = (list(h.counts), h.sum, h.count)
+            if reset:
+                self.counters = {}
+                self.histograms = {}
+        return counters, histograms
+
+
+    def merge(self, counters, histograms):
+        """Add (counters, histograms) as returned by snapshot()"""
+        with self.lock:
+            for key, v in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + v
+            for key, (counts, total, count) in histograms.items():
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram()
+                h = self.histograms[key]
+                h.counts = [a + b for a, b in zip(h.counts, counts)]
+                h.sum += total
+                h.count += count
+
+
+    def render(self, gauges=None):
+        """Return all metrics as text, with optional gauges as taken by
+        render()"""
+        counters, histograms = self.snapshot()
+        return render(counters, histograms, gauges=gauges)
+
+
+class MetricsStore():
+    """Sum the metrics of all the processes of this host, the api server and
+    the async workers, in a sqlite database. Each process pushes what it
+    counted since its last push"""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS metrics ('
+            '  name TEXT NOT NULL,'
+            '  labels TEXT NOT NULL,'
+            '  value TEXT NOT NULL,'
+            '  PRIMARY KEY (name, labels)'
+            ')'
+        )
+
+
+    def push(self, counters, histograms):
+        """Add those counters and histograms, as returned by
+        Metrics.snapshot()"""
+        if not counters and not histograms:
+            return
+
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            for (name, labels), v in counters.items():
+                labels = json.dumps(labels)
+                row = self.db.execute('SELECT value FROM metrics WHERE name = ? AND labels = ?', (name, labels)).fetchone()
+                if row:
+                    v += json.loads(row[0])
+                self.db.execute('INSERT OR REPLACE INTO metrics (name, labels, value) VALUES (?, ?, ?)', (name, labels, json.dumps(v)))
+            for (name, labels), (counts, total, count) in histograms.items():
+                labels = json.dumps(labels)
+                row = self.db.execute('SELECT value FROM metrics WHERE name = ? AND labels = ?', (name, labels)).fetchone()
+                if row:
+                    stored_counts, stored_total, stored_count = json.loads(row[0])
+                    counts = [a + b for a, b in zip(counts, stored_counts)]
+                    total += stored_total
+                    count += stored_count
+                self.db.execute('INSERT OR REPLACE INTO metrics (name, labels, value) VALUES (?, ?, ?)', (name, labels, json.dumps([counts, total, count])))
+
+
+    def load(self):
+        """Return the (counters, histograms) of all processes"""
+        counters = {}
+        histograms = {}
+        with self.lock:
+            rows = self.db.execute('SELECT name, labels, value FROM metrics').fetchall()
+        for name, labels, value in rows:
+            key = (name, tuple(tuple(kv) for kv in json.loads(labels)))
+            value = json.loads(value)
+            if isinstance(value, list):
+                histograms[key] = tuple(value)
+            else:
+                counters[key] = value
+        return counters, histograms
+
+
+metrics = Metrics()
+
+metrics_store = None
+metrics_pid = None
+metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """Return the process-wide metrics"""
+    if metrics_pid != os.getpid():
+        init_metrics()
+    return metrics
+
+
+def get_metrics_store():
+    """Return the store of the metrics of all processes of this host, or None
+    if disabled in config"""
+    if metrics_pid != os.getpid():
+        init_metrics()
+    return metrics_store
+
+
+def init_metrics():
+    """Open the metrics store in this process if enabled in config, and
+    push this process's metrics to it every PUSH_SEC and on exit. A forked
+    process, like an async worker, starts afresh, since its parent pushes
+    the metrics it inherited"""
+    global metrics, metrics_store, metrics_pid
+    with metrics_lock:
+        if metrics_pid == os.getpid():
+            return
+        if metrics_pid is not None:
+            metrics = Metrics()
+            metrics_store = None
+        metrics_pid = os.getpid()
+
+        conf = get_config()
+        if not getattr(conf, 'metrics_store', False):
+            return
+        metrics_store = MetricsStore(path=getattr(conf, 'metrics_store_path', None) or DEFAULT_PATH)
+
+    def loop():
+        while True:
+            time.sleep(PUSH_SEC)
+            push_metrics()
+
+    threading.Thread(target=loop, name='metrics', daemon=True).start()
+    atexit.register(push_metrics)
+
+
+def push_metrics():
+    """Add this process's metrics to the store, if enabled"""
+    store = get_metrics_store()
+    if not store:
+        return
+    counters, histograms = metrics.snapshot(reset=True)
+    try:
+        store.push(counters, histograms)
+    except sqlite3.Error as e:
+        log.warning("Failed to push metrics: %s" % str(e))
+        # Keep them for the next push
+        metrics.merge(counters, histograms)
+
+
+def collect_gauges():
+    """Return the stats of the process-wide page cache, host scheduler, hedger
+    and scrape coalescer, as gauges"""
+    gauges = {}
+
+    def add(prefix, what, stats, **labels):
+        for k, v in stats.items():
+            name = '%s_%s' % (prefix, k)
+            if name not in gauges:
+                gauges[name] = ('%s: %s' % (what, k.replace('_', ' ')), [])
+            gauges[name][1].append((labels, v))
+
+    cache = get_page_cache()
+    if cache:
+        add('crawler_page_cache', 'Page cache', cache.get_stats())
+    for host, stats in get_scheduler().get_stats().items():
+        add('crawler_host', 'Host scheduler', stats, host=host)
+    hedger = get_hedger()
+    if hedger:
+        add('crawler_hedge', 'Hedged renders', hedger.get_stats())
+    flights = get_single_flight()
+    if flights:
+        add('crawler_coalesce', 'Coalesced scrapes', flights.get_stats())
+
+    return gauges
+
+
+def render_metrics():
+    """Return the counters and histograms of all processes of this host if
+    the metrics store is enabled, else of this process, and the gauges of
+    this process, in the Prometheus text format"""
+    store = get_metrics_store()
+    if not store:
+        return metrics.render(gauges=collect_gauges())
+    push_metrics()
+    counters, histograms = store.load()
+    return render(counters, histograms, gauges=collect_gauges())
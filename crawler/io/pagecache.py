@@ -0,0 +1,159 @@
+import os
+import zlib
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from pymacaron.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_MB = 256
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-pagecache.sqlite')
+
+
+class PageCache():
+    """Cache fetched html on disk, keyed by url, zlib-compressed in a sqlite
+    database. Each page expires after the ttl it was stored with, and the
+    least recently read pages are evicted once the cache exceeds max_bytes.
+    Several processes may share the database, so its size is always read
+    from it"""
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.puts = 0
+        self.evictions = 0
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            '  url TEXT PRIMARY KEY,'
+            '  html BLOB NOT NULL,'
+            '  size INTEGER NOT NULL,'
+            '  expires REAL NOT NULL,'
+            '  accessed REAL NOT NULL'
+            ')'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+
+
+    def get(self, url):
+        """Return the cached html at url, or None if missing or expired"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT html, expires FROM pages WHERE url = ?', (url, )).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+
+            if row[1] <= now:
+                self.expired += 1
+                self.misses += 1
+                self._delete(url)
+                return None
+
+            self.hits += 1
+            self.db.execute('UPDATE pages SET accessed = ? WHERE url = ?', (now, url))
+
+        return zlib.decompress(row[0]).decode('utf-8')
+
+
+    def put(self, url, html, ttl):
+        """Cache the html at url for ttl seconds"""
+        blob = zlib.compress(html.encode('utf-8'))
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute(
+                'INSERT OR REPLACE INTO pages (url, html, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                (url, blob, len(blob), now + ttl, now),
+            )
+            self.puts += 1
+            self._evict(now)
+
+
+    def delete(self, url):
+        with self.lock:
+            self._delete(url)
+
+
+    def _delete(self, url):
+        self.db.execute('DELETE FROM pages WHERE url = ?', (url, ))
+
+
+    def _get_size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+
+    def _evict(self, now):
+        """If the cache exceeds max_bytes, drop expired pages, then the least
+        recently read ones, until it fits. Must be called within a write
+        transaction, so that other processes don't change the cache's size
+        meanwhile"""
+        total_bytes = self._get_size()
+        if total_bytes <= self.max_bytes:
+            return
+
+        row = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages WHERE expires <= ?', (now, )).fetchone()
+        if row[0]:
+            self.db.execute('DELETE FROM pages WHERE expires <= ?', (now, ))
+            total_bytes -= row[1]
+            self.evictions += row[0]
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        urls = []
+        for url, size in self.db.execute('SELECT url, size FROM pages ORDER BY accessed, rowid'):
+            if total_bytes <= self.max_bytes:
+                break
+            urls.append((url, ))
+            total_bytes -= size
+
+        self.db.executemany('DELETE FROM pages WHERE url = ?', urls)
+        self.evictions += len(urls)
+        log.debug("Evicted %s pages from page cache" % len(urls))
+
+
+    def get_stats(self):
+        """Return the hit/miss counters and current size of the cache"""
+        with self.lock:
+            count, total_bytes = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages').fetchone()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'puts': self.puts,
+                'evictions': self.evictions,
+                'count': count,
+                'bytes': total_bytes,
+            }
+
+
+page_cache = None
+page_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    """Return the process-wide page cache, or None if disabled in config"""
+    global page_cache
+    conf = get_config()
+    if not getattr(conf, 'page_cache', False):
+        return None
+    with page_cache_lock:
+        if not page_cache:
+            page_cache = PageCache(
+                path=getattr(conf, 'page_cache_path', None) or DEFAULT_PATH,
+                max_bytes=int(getattr(conf, 'page_cache_max_mb', DEFAULT_MAX_MB)) * 1024 * 1024,
+            )
+    return page_cache
@@ -0,0 +1,361 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from pymacaron.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+# Seconds between two samples of the stacks, at least, and the largest share
+# of the time that sampling may take
+DEFAULT_INTERVAL = 0.005
+DEFAULT_MAX_OVERHEAD = 0.05
+
+# Keep at most that many profiles on disk, that many distinct stacks per
+# profile, that many functions in its summary and that many fetched urls
+DEFAULT_MAX_PROFILES = 50
+MAX_STACKS = 2000
+MAX_FUNCTIONS = 100
+MAX_URLS = 100
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-profiles')
+
+RE_PROFILE_ID = re.compile(r'^[0-9]+-[a-z]+-[0-9a-f]+$')
+
+
+def get_label(code):
+    """Return a short name for a function's code"""
+    path = code.co_filename.split(os.sep)
+    return '%s (%s:%s)' % (code.co_name, '/'.join(path[-2:]), code.co_firstlineno)
+
+
+class Sampler():
+    """Sample at a fixed interval the stacks of the threads attached to the
+    sampler, for as long as they are attached. Count for each function how
+    often it was running (self) or on the stack (total), and how often each
+    whole stack was seen.
+
+    Sampling holds the GIL, and slows down the sampled threads: if it takes
+    more than max_overhead of the time, sample less often.
+
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, max_overhead=DEFAULT_MAX_OVERHEAD):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.time_sampling = 0
+        self.stopped = threading.Event()
+        self.thread = None
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.self_counts = {}
+        self.total_counts = {}
+        self.stacks = {}
+
+
+    def attach(self, ident):
+        """Sample that thread, until detached as many times as attached"""
+        with self.lock:
+            self.threads[ident] = self.threads.get(ident, 0) + 1
+
+
+    def detach(self, ident):
+        with self.lock:
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+    def run(self):
+        interval = self.interval
+        while not self.stopped.wait(interval):
+            time_start = time.perf_counter()
+            try:
+                self.sample()
+            except Exception:
+                log.exception("Failed to sample stacks - Stopping the profiler")
+                return
+            spent = time.perf_counter() - time_start
+            self.time_sampling += spent
+
+            # Wait long enough for the last sample to take at most
+            # max_overhead of the time
+            interval = self.interval
+            if self.max_overhead:
+                interval = max(interval, spent / self.max_overhead - spent)
+
+
+    def sample(self):
+        self.samples += 1
+        with self.lock:
+            threads = set(self.threads.keys())
+        for ident, frame in sys._current_frames().items():
+            if ident not in threads:
+                continue
+
+            stack = []
+            while frame:
+                stack.append(get_label(frame.f_code))
+                frame = frame.f_back
+
+            self.self_counts[stack[0]] = self.self_counts.get(stack[0], 0) + 1
+            for label in set(stack):
+                self.total_counts[label] = self.total_counts.get(label, 0) + 1
+
+            key = ';'.join(reversed(stack))
+            if key not in self.stacks and len(self.stacks) >= MAX_STACKS:
+                key = '(other stacks)'
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+
+    def get_functions(self):
+        """Return the functions seen most often, with their self and total
+        sample counts"""
+        labels = sorted(self.total_counts.keys(), key=lambda k: (-self.self_counts.get(k, 0), -self.total_counts[k]))
+        return [
+            {
+                'function': label,
+                'self_samples': self.self_counts.get(label, 0),
+                'total_samples': self.total_counts[label],
+            } for label in labels[:MAX_FUNCTIONS]
+        ]
+
+
+    def get_collapsed_stacks(self):
+        """Return the stacks seen, one per line with its sample count, in the
+        'collapsed' format read by flamegraph tools"""
+        return '\n'.join('%s %s' % (k, v) for k, v in sorted(self.stacks.items(), key=lambda kv: -kv[1]))
+
+
+class ProfileRing():
+    """Keep the last max_profiles profiles as json files in a directory"""
+
+    def __init__(self, path=DEFAULT_PATH, max_profiles=DEFAULT_MAX_PROFILES):
+        self.path = path
+        self.max_profiles = max_profiles
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+
+    def get_ids(self):
+        """Return the ids of the profiles on disk, oldest first"""
+        ids = [f[:-5] for f in os.listdir(self.path) if f.endswith('.json')]
+        return sorted(i for i in ids if RE_PROFILE_ID.match(i))
+
+
+    def save(self, profile):
+        """Write a profile and forget the oldest ones above max_profiles.
+        Return False if it could not be written"""
+        file = os.path.join(self.path, '%s.json' % profile['profile_id'])
+        try:
+            with open(file + '.tmp', 'w') as f:
+                json.dump(profile, f)
+            os.replace(file + '.tmp', file)
+        except (OSError, TypeError, ValueError) as e:
+            log.warning("Failed to save profile %s: %s: %s" % (profile['profile_id'], type(e).__name__, str(e)))
+            try:
+                os.remove(file + '.tmp')
+            except OSError:
+                pass
+            return False
+
+        with self.lock:
+            try:
+                ids = self.get_ids()
+            except OSError as e:
+                log.warning("Failed to list profiles: %s" % str(e))
+                ids = []
+            for profile_id in ids[:max(0, len(ids) - self.max_profiles)]:
+                try:
+                    os.remove(os.path.join(self.path, '%s.json' % profile_id))
+                except OSError:
+                    pass
+        return True
+
+
+    def get(self, profile_id):
+        """Return a profile, or None if unknown"""
+        if not profile_id or not RE_PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.path, '%s.json' % profile_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def list(self):
+        """Return all profiles on disk without their samples, most recent
+        first"""
+        profiles = []
+        for profile_id in reversed(self.get_ids()):
+            p = self.get(profile_id)
+            if p:
+                profiles.append({k: v for k, v in p.items() if k not in ('functions', 'stacks', 'urls')})
+        return profiles
+
+
+# The profiles in progress that each thread works for
+local = threading.local()
+
+
+def get_profiles():
+    return getattr(local, 'profiles', ())
+
+
+class Attached():
+    """Make the current thread work for those profiles, as a context manager"""
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.saved = None
+
+
+    def __enter__(self):
+        self.saved = get_profiles()
+        local.profiles = self.saved + tuple(self.profiles)
+        for p in self.profiles:
+            p.sampler.attach(threading.get_ident())
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for p in self.profiles:
+            p.sampler.detach(threading.get_ident())
+        local.profiles = self.saved
+        return False
+
+
+def propagate(f):
+    """Return f, wrapped to work for the profiles of the current thread in
+    whatever thread it is called, such as a worker of a thread pool. Profiles
+    only sample the threads working for them"""
+    profiles = get_profiles()
+    if not profiles:
+        return f
+
+    def profiled(*args, **kwargs):
+        with Attached(profiles):
+            return f(*args, **kwargs)
+
+    return profiled
+
+
+def note_url(url):
+    """Record that url is being fetched, in the profiles the current thread
+    works for"""
+    for p in get_profiles():
+        with p.lock:
+            if len(p.urls) < MAX_URLS:
+                p.urls.append(url)
+
+
+class Profiling():
+    """Profile the code run within this context manager, if enabled by the
+    request or by config, and save the profile to the ring, along with the
+    kind of request, its source and url, and the urls fetched meanwhile.
+
+    Only the current thread, and code that it hands to other threads wrapped
+    with propagate(), are sampled.
+
+    """
+
+    def __init__(self, kind, source, url=None, enabled=False):
+        conf = get_config()
+        self.kind = kind
+        self.source = source
+        self.url = url
+        self.enabled = enabled or getattr(conf, 'profile_requests', False)
+        self.interval = float(getattr(conf, 'profile_interval', DEFAULT_INTERVAL))
+        self.max_overhead = float(getattr(conf, 'profile_max_overhead', DEFAULT_MAX_OVERHEAD))
+        self.urls = []
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.attached = None
+        self.time_start = None
+
+
+    def __enter__(self):
+        if self.enabled:
+            self.time_start = time.time()
+            self.sampler = Sampler(interval=self.interval, max_overhead=self.max_overhead)
+            self.attached = Attached([self])
+            self.attached.__enter__()
+            self.sampler.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return False
+
+        self.sampler.stop()
+        self.attached.__exit__(None, None, None)
+
+        duration = time.time() - self.time_start
+        profile = {
+            'profile_id': '%s-%s-%s' % (int(self.time_start * 1000), self.kind, uuid.uuid4().hex[:8]),
+            'kind': self.kind,
+            'source': self.source,
+            'url': self.url,
+            'epoch_start': self.time_start,
+            'duration': duration,
+            'interval': self.interval,
+            'samples': self.sampler.samples,
+            'overhead': self.sampler.time_sampling / duration if duration else 0,
+            'error': '%s: %s' % (exc_type.__name__, str(exc_value)) if exc_type else None,
+            'urls': self.urls,
+            'functions': self.sampler.get_functions(),
+            'stacks': self.sampler.get_collapsed_stacks(),
+        }
+
+        try:
+            ring = get_profile_ring()
+        except OSError as e:
+            log.warning("Failed to open the profile ring: %s" % str(e))
+            return False
+
+        if ring.save(profile):
+            log.info("Saved profile %s of %s %s (%s samples)" % (profile['profile_id'], self.kind, self.source, self.sampler.samples))
+
+        return False
+
+
+def profiling(kind, source, url=None, enabled=False):
+    """Return a context manager profiling a request if enabled"""
+    return Profiling(kind, source, url=url, enabled=enabled)
+
+
+profile_ring = None
+profile_ring_lock = threading.Lock()
+
+
+def get_profile_ring():
+    """Return the process-wide ring of profiles"""
+    global profile_ring
+    with profile_ring_lock:
+        if not profile_ring:
+            conf = get_config()
+            profile_ring = ProfileRing(
+                path=getattr(conf, 'profile_path', None) or DEFAULT_PATH,
+                max_profiles=int(getattr(conf, 'profile_max', DEFAULT_MAX_PROFILES)),
+            )
+    return profile_ring
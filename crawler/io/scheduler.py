@@ -0,0 +1,279 @@
+import time
+import logging
+import threading
+from urllib.parse import urlparse
+import requests.exceptions
+from pymacaron.config import get_config
+from crawler.exceptions import RenderServiceBusyError
+
+
+log = logging.getLogger(__name__)
+
+
+# Default limits for any host, overridable per host in config
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 4
+DEFAULT_MAX_CONCURRENCY = 4
+
+# Exponential backoff after a host throttled or failed us
+BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+
+# The rate of a host is halved when it throttles us, and divided by that
+# when its latency rises, down to that share of its configured rate. It
+# then grows back by that share of the configured rate per success
+RATE_DECREASE_ON_SLOWDOWN = 1.5
+RATE_MIN_SHARE = 0.05
+RATE_INCREASE_SHARE = 0.1
+
+# Latency is 'rising' when its recent average exceeds its long-term average
+# by that factor
+LATENCY_FAST_ALPHA = 0.3
+LATENCY_SLOW_ALPHA = 0.02
+LATENCY_RISE_FACTOR = 2.0
+
+# Errors meaning that a host is overloaded or unreachable
+BACKOFF_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    RenderServiceBusyError,
+)
+
+
+class HostState():
+    """The token bucket, concurrency, backoff and metrics of one host"""
+
+    def __init__(self, host, rate, burst, max_concurrency, backoff_max, now):
+        self.host = host
+        self.rate_max = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_concurrency = max_concurrency
+        self.backoff_max = backoff_max
+        self.tokens = float(burst)
+        self.time_refill = now
+        self.in_flight = 0
+        self.blocked_until = 0
+        self.backoff = 0
+        self.latency_fast = None
+        self.latency_slow = None
+        self.time_slowdown = 0
+        self.cond = threading.Condition()
+
+        self.count_requests = 0
+        self.count_throttled = 0
+        self.count_errors = 0
+        self.count_slowdowns = 0
+        self.wait_sec = 0
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.time_refill) * self.rate)
+        self.time_refill = now
+
+
+    def get_wait(self, now):
+        """Return how long to wait before a request may start, 0 if it may start
+        now, or None if it must wait for another request to complete"""
+        if self.in_flight >= self.max_concurrency:
+            return None
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0
+
+
+    def on_throttled(self, now):
+        self.count_throttled += 1
+        self.backoff = min(self.backoff * 2 if self.backoff else BACKOFF_BASE, self.backoff_max)
+        self.blocked_until = now + self.backoff
+        self.rate = max(self.rate_max * RATE_MIN_SHARE, self.rate / 2)
+        log.info("Host %s throttled us - Backing off %.1fsec and slowing down to %.2f req/s" % (self.host, self.backoff, self.rate))
+
+
+    def on_success(self, now, latency):
+        self.backoff = 0
+
+        if self.latency_fast is None:
+            self.latency_fast = self.latency_slow = latency
+        else:
+            self.latency_fast += LATENCY_FAST_ALPHA * (latency - self.latency_fast)
+            self.latency_slow += LATENCY_SLOW_ALPHA * (latency - self.latency_slow)
+
+        # Slow down when latency rises, at most once per request interval
+        if self.latency_fast > LATENCY_RISE_FACTOR * self.latency_slow and now - self.time_slowdown > 1 / self.rate:
+            self.count_slowdowns += 1
+            self.time_slowdown = now
+            self.rate = max(self.rate_max * RATE_MIN_SHARE, self.rate / RATE_DECREASE_ON_SLOWDOWN)
+            log.info("Latency of host %s is rising (%.2fsec vs %.2fsec) - Slowing down to %.2f req/s" % (self.host, self.latency_fast, self.latency_slow, self.rate))
+        else:
+            self.rate = min(self.rate_max, self.rate + self.rate_max * RATE_INCREASE_SHARE)
+
+
+    def get_stats(self):
+        return {
+            'rate': self.rate,
+            'rate_max': self.rate_max,
+            'in_flight': self.in_flight,
+            'backoff': self.backoff,
+            'latency': self.latency_fast,
+            'requests': self.count_requests,
+            'throttled': self.count_throttled,
+            'errors': self.count_errors,
+            'slowdowns': self.count_slowdowns,
+            'wait_sec': self.wait_sec,
+        }
+
+
+class Slot():
+    """The right to send one request to a host, as a context manager. Set
+    'status' to the request's http status, or call fail() if the host could
+    not be reached"""
+
+    def __init__(self, scheduler, url, backoff=True):
+        self.scheduler = scheduler
+        self.url = url
+        self.backoff = backoff
+        self.state = None
+        self.time_start = None
+        self.status = None
+        self.failed = False
+
+
+    def fail(self):
+        self.failed = True
+
+
+    def __enter__(self):
+        self.scheduler.acquire(self)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error = exc_type is not None
+        if exc_type and issubclass(exc_type, BACKOFF_ERRORS):
+            self.failed = True
+        self.scheduler.release(self, error=error)
+        return False
+
+
+class HostScheduler():
+    """Space the requests sent to each host with a token bucket, cap how many
+    are in flight at once, and back off hosts that throttle us (429 or 5xx),
+    fail, or slow down.
+
+    'limits' maps host names to dicts overriding the default rate (requests
+    per second), burst and max_concurrency. 'clock' and 'sleep' may be
+    replaced to test the scheduler deterministically.
+
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_concurrency=DEFAULT_MAX_CONCURRENCY, backoff_max=DEFAULT_BACKOFF_MAX, limits=None, clock=time.monotonic, sleep=time.sleep):
+        self.defaults = {
+            'rate': rate,
+            'burst': burst,
+            'max_concurrency': max_concurrency,
+        }
+        self.backoff_max = backoff_max
+        self.limits = limits if limits else {}
+        self.clock = clock
+        self.sleep = sleep
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+
+    def get_host(self, url):
+        """Return the state of the host of that url"""
+        host = urlparse(url).netloc or url
+        with self.lock:
+            if host not in self.hosts:
+                limits = dict(self.defaults)
+                limits.update(self.limits.get(host, {}))
+                self.hosts[host] = HostState(
+                    host,
+                    limits['rate'],
+                    limits['burst'],
+                    int(limits['max_concurrency']),
+                    self.backoff_max,
+                    self.clock(),
+                )
+            return self.hosts[host]
+
+
+    def slot(self, url, backoff=True):
+        """Return a context manager holding a slot to request url. With
+        backoff=False, failures don't make the host back off, as when the
+        request goes through a proxy which may be the one failing"""
+        return Slot(self, url, backoff=backoff)
+
+
+    def acquire(self, slot):
+        """Block until a request may be sent to the slot's host"""
+        state = self.get_host(slot.url)
+        time_wait = self.clock()
+        while True:
+            with state.cond:
+                now = self.clock()
+                state.refill(now)
+                wait = state.get_wait(now)
+                if wait is None:
+                    state.cond.wait()
+                    continue
+                if wait == 0:
+                    state.tokens -= 1
+                    state.in_flight += 1
+                    state.wait_sec += now - time_wait
+                    break
+            self.sleep(wait)
+
+        slot.state = state
+        slot.time_start = now
+
+
+    def release(self, slot, error=False):
+        """Record the outcome of a slot's request and free its slot"""
+        state = slot.state
+        now = self.clock()
+        with state.cond:
+            state.in_flight -= 1
+            state.count_requests += 1
+            throttled = slot.failed or (slot.status is not None and (slot.status == 429 or slot.status >= 500))
+            if throttled or error:
+                state.count_errors += 1
+            if throttled and slot.backoff:
+                state.on_throttled(now)
+            elif not throttled and not error:
+                state.on_success(now, now - slot.time_start)
+            state.cond.notify()
+
+
+    def get_stats(self):
+        """Return the metrics of each host"""
+        with self.lock:
+            hosts = list(self.hosts.values())
+        stats = {}
+        for state in hosts:
+            with state.cond:
+                stats[state.host] = state.get_stats()
+        return stats
+
+
+scheduler = None
+scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide host scheduler"""
+    global scheduler
+    with scheduler_lock:
+        if not scheduler:
+            conf = get_config()
+            scheduler = HostScheduler(
+                rate=float(getattr(conf, 'host_rate', DEFAULT_RATE)),
+                burst=float(getattr(conf, 'host_burst', DEFAULT_BURST)),
+                max_concurrency=int(getattr(conf, 'host_max_concurrency', DEFAULT_MAX_CONCURRENCY)),
+                backoff_max=float(getattr(conf, 'host_backoff_max', DEFAULT_BACKOFF_MAX)),
+                limits=getattr(conf, 'host_limits', None),
+            )
+    return scheduler
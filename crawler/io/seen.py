@@ -0,0 +1,109 @@
+import os
+import time
+import logging
+import sqlite3
+import tempfile
+import threading
+from pymacaron.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'crawler-seen.sqlite')
+
+
+class SeenIndex():
+    """Remember, per source, the native urls (and native doc ids, when known)
+    of the items already sent to BDL, in a sqlite database. Entries older
+    than max_age_days are forgotten"""
+
+    def __init__(self, path=DEFAULT_PATH, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS seen ('
+            '  source TEXT NOT NULL,'
+            '  native_url TEXT NOT NULL,'
+            '  native_doc_id TEXT,'
+            '  epoch_sent REAL NOT NULL,'
+            '  PRIMARY KEY (source, native_url)'
+            ')'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS seen_epoch_sent ON seen (epoch_sent)')
+
+        cur = self.db.execute('DELETE FROM seen WHERE epoch_sent < ?', (time.time() - max_age_days * 86400, ))
+        if cur.rowcount:
+            log.info("Forgot %s items seen more than %s days ago" % (cur.rowcount, max_age_days))
+
+
+    def add(self, source, objects):
+        """Mark those scraped objects as sent"""
+        now = time.time()
+        rows = []
+        for o in objects:
+            native_url = getattr(o, 'native_url', None)
+            if not native_url:
+                continue
+            bdlitem = getattr(o, 'bdlitem', None)
+            native_doc_id = getattr(bdlitem, 'native_doc_id', None) if bdlitem else None
+            rows.append((source, native_url, native_doc_id, now))
+
+        if not rows:
+            return
+
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.executemany(
+                'INSERT INTO seen (source, native_url, native_doc_id, epoch_sent) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (source, native_url) DO UPDATE SET '
+                '  native_doc_id = COALESCE(excluded.native_doc_id, native_doc_id),'
+                '  epoch_sent = excluded.epoch_sent',
+                rows,
+            )
+            self.db.execute('COMMIT')
+
+
+    def get_seen(self, source, native_urls):
+        """Return the set of those native urls already sent"""
+        native_urls = list(set(native_urls))
+        seen = set()
+        with self.lock:
+            # Stay below sqlite's limit on the number of query parameters
+            for i in range(0, len(native_urls), 500):
+                chunk = native_urls[i:i + 500]
+                cur = self.db.execute(
+                    'SELECT native_url FROM seen WHERE source = ? AND native_url IN (%s)' % ','.join('?' * len(chunk)),
+                    [source] + chunk,
+                )
+                seen.update(row[0] for row in cur)
+        return seen
+
+
+    def is_seen(self, source, native_url):
+        return native_url in self.get_seen(source, [native_url])
+
+
+seen_index = None
+seen_index_lock = threading.Lock()
+
+
+def get_seen_index():
+    """Return the process-wide index of sent items, or None if disabled in
+    config"""
+    global seen_index
+    conf = get_config()
+    if not getattr(conf, 'seen_index', False):
+        return None
+    with seen_index_lock:
+        if not seen_index:
+            seen_index = SeenIndex(
+                path=getattr(conf, 'seen_index_path', None) or DEFAULT_PATH,
+                max_age_days=int(getattr(conf, 'seen_index_max_age_days', DEFAULT_MAX_AGE_DAYS)),
+            )
+    return seen_index
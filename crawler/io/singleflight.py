@@ -0,0 +1,105 @@
+import logging
+import threading
+from urllib.parse import urlsplit, urlunsplit
+from pymacaron.config import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_PORTS = {
+    'http': '80',
+    'https': '443',
+}
+
+
+def normalize_url(url):
+    """Return url with a lowercase scheme and host, and without default port,
+    fragment or trailing slash"""
+    p = urlsplit(url.strip())
+    scheme = p.scheme.lower()
+    netloc = p.netloc.lower()
+    if ':' in netloc and netloc.rsplit(':', 1)[1] == DEFAULT_PORTS.get(scheme):
+        netloc = netloc.rsplit(':', 1)[0]
+    path = p.path.rstrip('/') or '/'
+    return urlunsplit((scheme, netloc, path, p.query, ''))
+
+
+class Flight():
+    """A call in progress, and its outcome once done"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight():
+    """Coalesce concurrent calls with the same key: the first one runs, and
+    the others wait for it and get its result, or its exception"""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+        self.count_calls = 0
+        self.count_coalesced = 0
+
+
+    def do(self, key, f):
+        """Return f(), or the result of the call with the same key already in
+        progress"""
+        with self.lock:
+            self.count_calls += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.followers += 1
+                self.count_coalesced += 1
+
+        if not leader:
+            log.info("Waiting for the call in progress for %s" % str(key))
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = f()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return flight.result
+
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'calls': self.count_calls,
+                'coalesced': self.count_coalesced,
+                'in_flight': len(self.flights),
+            }
+
+
+single_flight = None
+single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """Return the process-wide coalescer of scrapes, or None if disabled in
+    config"""
+    global single_flight
+    if not getattr(get_config(), 'coalesce_scrapes', True):
+        return None
+    with single_flight_lock:
+        if not single_flight:
+            single_flight = SingleFlight()
+    return single_flight
@@ -1,8 +1,12 @@
+import os
 import logging
 import requests
 import json
 import pprint
 import socket
+import threading
+import queue
+from time import time, sleep
 from pymacaron.utils import to_epoch, timenow
 from pymacaron.config import get_config
 
@@ -12,35 +16,170 @@ log = logging.getLogger(__name__)
 
 HOSTNAME = socket.gethostname()
 
+# Reuse connections to slack's webhook
+session = requests.Session()
+
+
+class SlackNotifier():
+    """Send slack messages from a background thread, so that crawling never
+    blocks on slack.
+
+    Messages are queued in a bounded queue, and dropped (and counted) when the
+    queue is full. Digest events, such as urls being fetched, are coalesced
+    into one message per channel and key every 'interval' seconds. Posts to
+    slack are spaced by at least 'min_post_interval' seconds.
+
+    """
+
+    def __init__(self, interval=30, max_queue=1000, min_post_interval=1.0, max_digest_lines=20, post=None):
+        self.interval = interval
+        self.min_post_interval = min_post_interval
+        self.max_digest_lines = max_digest_lines
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.post = post if post else self.do_post
+
+        self.count_dropped = 0
+        self.count_dropped_reported = 0
+        self.time_last_post = 0
+
+        # (channel, key) -> list of digest lines
+        self.digests = {}
+
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+
+    def notify(self, channel, message):
+        """Queue a message to post as is"""
+        self.put((channel, None, message))
+
+
+    def notify_digest(self, channel, key, line):
+        """Queue a line to include in the next digest for that channel and key"""
+        self.put((channel, key, line))
+
+
+    def put(self, event):
+        self.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.count_dropped += 1
+
+
+    def start(self):
+        """Start the sender thread, if not already running in this process"""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.thread = threading.Thread(target=self.run, name='slack-notifier', daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+
+    def run(self):
+        time_next_digest = time() + self.interval
+        while True:
+            try:
+                channel, key, message = self.queue.get(timeout=max(0, time_next_digest - time()))
+                if key:
+                    self.digests.setdefault((channel, key), []).append(message)
+                else:
+                    self.send(channel, message)
+            except queue.Empty:
+                pass
+            except Exception as e:
+                log.warn("Slack notifier failed to send message: %s" % str(e))
+
+            if time() >= time_next_digest:
+                self.send_digests()
+                time_next_digest = time() + self.interval
+
+
+    def send_digests(self):
+        digests, self.digests = self.digests, {}
+        for (channel, key), lines in digests.items():
+            message = "%s (%s in the last %ssec)\n%s" % (
+                key,
+                len(lines),
+                self.interval,
+                '\n'.join(lines[0:self.max_digest_lines]),
+            )
+            if len(lines) > self.max_digest_lines:
+                message += '\n... and %s more' % (len(lines) - self.max_digest_lines)
+
+            dropped = self.count_dropped - self.count_dropped_reported
+            if dropped:
+                message += '\n(%s slack messages dropped)' % dropped
+                self.count_dropped_reported += dropped
+
+            try:
+                self.send(channel, message)
+            except Exception as e:
+                log.warn("Slack notifier failed to send digest: %s" % str(e))
+
+
+    def send(self, channel, message):
+        wait = self.time_last_post + self.min_post_interval - time()
+        if wait > 0:
+            sleep(wait)
+        self.time_last_post = time()
+        self.post(channel, message)
+
+
+    def do_post(self, channel, message):
+        do_slack(
+            message,
+            channel=channel,
+            as_user='SCRAPER',
+            emoji=':robot_face:',
+            is_real=True,
+        )
+
+
+notifier = SlackNotifier()
+
 
 def slack_info(source, message, channel=None):
+    """Post a message to slack in the background"""
     if not channel:
         channel = get_config().slack_channel
-    do_slack(
+    notifier.notify(
+        channel,
         "%s %s|%s: %s" % (
             str(timenow())[11:19],
             source.upper(),
             HOSTNAME,
             message,
         ),
-        channel=channel,
-        as_user='SCRAPER',
-        emoji=':robot_face:',
-        is_real=True,
+    )
+
+
+def slack_fetched(source, url, channel=None):
+    """Report a fetched url in the next digest of fetched urls"""
+    if not channel:
+        channel = get_config().slack_urls
+    notifier.notify_digest(
+        channel,
+        "%s|%s: fetched urls" % (source.upper(), HOSTNAME),
+        "%s %s" % (str(timenow())[11:19], url),
     )
 
 
 def do_slack(message, channel=None, as_user='bazardelux.com', emoji=':heart:', is_real=False):
     assert channel
 
-    r = requests.post(
+    r = session.post(
         get_config().slack_url,
         json={
             "channel": "#%s" % channel,
             "username": as_user,
             "text": message,
             "icon_emoji": emoji,
-        }
+        },
+        timeout=10,
     )
 
     log.info("Sent message to slack and got: %s" % r.text)
@@ -86,7 +225,7 @@ def slack_error(title, body):
 
     log.info("Slacking error to channel %s" % channel)
 
-    r = requests.post(
+    r = session.post(
         get_config().slack_url,
         json={
             "channel": channel,
@@ -0,0 +1,81 @@
+import re
+import logging
+import threading
+import requests
+import requests.exceptions
+from requests.adapters import HTTPAdapter
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 20
+
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36'
+
+
+class StaticFetcher():
+    """Fetch pages over plain http, without rendering them in a browser, using
+    a pooled keep-alive session accepting compressed responses"""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            'User-Agent': USER_AGENT,
+            'Accept': 'text/html,application/xhtml+xml',
+            'Accept-Encoding': 'gzip, deflate',
+            'Accept-Language': 'sv-SE,sv;q=0.9,en;q=0.8',
+        })
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+
+    def get(self, url):
+        """Return the html at url, or None if it could not be fetched"""
+        status, html = self.fetch(url)
+        return html
+
+
+    def fetch(self, url):
+        """Return the http status and html at url. The status is None if the
+        host could not be reached, and the html None unless the status is
+        200"""
+        try:
+            r = self.session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            log.info("Static fetch of %s failed: %s" % (url, str(e)))
+            return None, None
+
+        if r.status_code != 200:
+            log.info("Static fetch of %s returned status %s" % (url, r.status_code))
+            return r.status_code, None
+
+        return r.status_code, r.text
+
+
+marker_regexps = {}
+
+
+def has_class(html, classname):
+    """Return True if some element in this html has that css class"""
+    r = marker_regexps.get(classname)
+    if not r:
+        r = re.compile(r'class="[^"]*\b%s\b' % re.escape(classname))
+        marker_regexps[classname] = r
+    return r.search(html) is not None
+
+
+fetcher = None
+fetcher_lock = threading.Lock()
+
+
+def get_static_fetcher():
+    """Return the process-wide static fetcher"""
+    global fetcher
+    with fetcher_lock:
+        if not fetcher:
+            fetcher = StaticFetcher()
+    return fetcher
@@ -0,0 +1,282 @@
+import os
+import atexit
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+from selenium import webdriver
+from pymacaron.config import get_config
+from crawler.exceptions import WebdriverPoolBusyError
+
+
+log = logging.getLogger(__name__)
+
+
+# Try finding chromedriver if needed and return its path
+HERE = os.path.dirname(os.path.realpath(__file__))
+os.environ['PATH'] += ':%s/../../lib/:/pym/lib' % HERE
+log.info("Searching for chromedriver in PATH=%s" % os.environ['PATH'])
+WEBDRIVER_PATH = os.popen('which chromedriver').read().strip()
+log.info("Found chromedriver at %s" % WEBDRIVER_PATH)
+
+CHROME_OPTIONS = webdriver.ChromeOptions()
+CHROME_OPTIONS.add_argument('--no-sandbox')
+CHROME_OPTIONS.add_argument('--window-size=1420,1080')
+CHROME_OPTIONS.add_argument('--headless')
+CHROME_OPTIONS.add_argument('--disable-gpu')
+CHROME_OPTIONS.add_argument('--disable-dev-shm-usage')
+CHROME_OPTIONS.add_argument('disable-infobars')
+CHROME_OPTIONS.add_argument('--disable-extensions')
+
+
+# Pool defaults, overridable in pym-config.yaml
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_PAGES = 100
+DEFAULT_MAX_RSS_MB = 600
+DEFAULT_CHECKOUT_TIMEOUT = 60
+
+
+def get_rss_mb(pid):
+    """Return the resident memory in MB of a process and all its descendants,
+    as read from /proc, or None if it cannot be read"""
+
+    def rss_kb(pid):
+        try:
+            with open('/proc/%s/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except (IOError, ValueError):
+            pass
+        return 0
+
+    def children(pid):
+        try:
+            with open('/proc/%s/task/%s/children' % (pid, pid)) as f:
+                return [int(p) for p in f.read().split()]
+        except (IOError, ValueError):
+            return []
+
+    if not pid or not os.path.exists('/proc/%s' % pid):
+        return None
+
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        total += rss_kb(p)
+        todo.extend(children(p))
+
+    return total / 1024.0
+
+
+class PooledDriver():
+    """A warm chrome webdriver, and some stats about its usage"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.count_pages = 0
+        self.time_created = time()
+
+    def get_pid(self):
+        try:
+            return self.driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def is_healthy(self):
+        """Probe the browser and return True if it still responds"""
+        try:
+            self.driver.execute_script('return 1')
+            return True
+        except Exception as e:
+            log.info("Webdriver failed health probe: %s" % str(e))
+            return False
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            log.info("Failed to quit webdriver: %s" % str(e))
+
+
+class WebdriverPool():
+    """A process-wide pool of warm headless chrome webdrivers.
+
+    Drivers are created lazily up to 'size', checked out by one crawler at a
+    time, probed for health on checkout and recycled after 'max_pages' pages
+    or when chrome's memory grows above 'max_rss_mb'.
+
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_pages=DEFAULT_MAX_PAGES, max_rss_mb=DEFAULT_MAX_RSS_MB, checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT, factory=None):
+        assert size > 0
+        self.size = size
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.checkout_timeout = checkout_timeout
+        self.factory = factory if factory else self.start_chrome
+
+        # Is chrome installed at all? None until we tried starting one
+        self.has_webdriver = None if factory or WEBDRIVER_PATH else False
+
+        self.idle = []
+        self.busy = {}
+        self.count_reserved = 0
+        self.lock = threading.Condition()
+
+        self.count_created = 0
+        self.count_recycled = 0
+
+
+    def start_chrome(self):
+        return webdriver.Chrome(
+            executable_path=WEBDRIVER_PATH,
+            options=CHROME_OPTIONS,
+        )
+
+
+    def is_available(self):
+        return self.has_webdriver is not False
+
+
+    def checkout(self, blocking=True):
+        """Return a healthy webdriver, or None if chrome is not available on this
+        host. Block until a driver is free if the pool is exhausted, or return
+        None right away if not blocking. Raise WebdriverPoolBusyError if no
+        driver got free within checkout_timeout."""
+
+        if not self.is_available():
+            return None
+
+        with self.lock:
+            deadline = time() + self.checkout_timeout
+            while not self.idle and len(self.busy) + self.count_reserved >= self.size:
+                if not blocking:
+                    return None
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise WebdriverPoolBusyError("Timed out waiting for a free webdriver (pool size %s)" % self.size)
+                self.lock.wait(remaining)
+
+            # Reserve a slot while we probe or start chrome outside the lock
+            pooled = self.idle.pop() if self.idle else None
+            self.count_reserved += 1
+
+        recycled = False
+        try:
+            if pooled and not pooled.is_healthy():
+                pooled.quit()
+                recycled = True
+                pooled = None
+
+            if pooled is None:
+                pooled = self.create()
+
+        finally:
+            with self.lock:
+                self.count_reserved -= 1
+                if recycled:
+                    self.count_recycled += 1
+                if pooled:
+                    self.busy[id(pooled.driver)] = pooled
+                self.lock.notify()
+
+        return pooled.driver if pooled else None
+
+
+    def checkin(self, driver, broken=False):
+        """Return a driver to the pool, recycling it if it is broken, too old or
+        too fat"""
+
+        with self.lock:
+            pooled = self.busy.pop(id(driver), None)
+
+        if not pooled:
+            log.warn("Checking in a webdriver that does not belong to the pool")
+            driver.quit()
+            return
+
+        pooled.count_pages += 1
+
+        recycle = broken
+        if not recycle and self.max_pages and pooled.count_pages >= self.max_pages:
+            log.info("Recycling webdriver after %s pages" % pooled.count_pages)
+            recycle = True
+        if not recycle and self.max_rss_mb:
+            rss = get_rss_mb(pooled.get_pid())
+            if rss and rss > self.max_rss_mb:
+                log.info("Recycling webdriver using %.0fMB (max: %sMB)" % (rss, self.max_rss_mb))
+                recycle = True
+
+        if recycle:
+            pooled.quit()
+
+        with self.lock:
+            if recycle:
+                self.count_recycled += 1
+            else:
+                self.idle.append(pooled)
+            self.lock.notify()
+
+
+    @contextmanager
+    def driver(self):
+        """Check out a driver for the duration of a with-block. Yield None if
+        chrome is not available"""
+        driver = self.checkout()
+        if not driver:
+            yield None
+            return
+
+        broken = True
+        try:
+            yield driver
+            broken = False
+        finally:
+            self.checkin(driver, broken=broken)
+
+
+    def create(self):
+        try:
+            driver = self.factory()
+        except Exception as e:
+            log.info("Chrome does not seem to be installed: %s" % str(e))
+            log.info("Will use browserless.io instead.")
+            if self.has_webdriver is None:
+                self.has_webdriver = False
+            return None
+
+        self.has_webdriver = True
+        with self.lock:
+            self.count_created += 1
+            count = self.count_created
+        log.info("Started webdriver #%s" % count)
+        return PooledDriver(driver)
+
+
+    def close(self):
+        """Quit all idle drivers"""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for pooled in idle:
+            pooled.quit()
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+def get_webdriver_pool():
+    """Return the process-wide webdriver pool, configured from pym-config"""
+    global pool
+    with pool_lock:
+        if not pool:
+            conf = get_config()
+            pool = WebdriverPool(
+                size=getattr(conf, 'webdriver_pool_size', DEFAULT_POOL_SIZE),
+                max_pages=getattr(conf, 'webdriver_max_pages', DEFAULT_MAX_PAGES),
+                max_rss_mb=getattr(conf, 'webdriver_max_rss_mb', DEFAULT_MAX_RSS_MB),
+            )
+            atexit.register(pool.close)
+    return pool
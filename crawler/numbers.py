@@ -0,0 +1,71 @@
+import re
+import logging
+from functools import lru_cache
+from crawler.exceptions import ParserError
+
+
+log = logging.getLogger(__name__)
+
+
+# Characters found between groups of thousands in Swedish amounts: spaces,
+# non-breaking spaces, thin spaces, narrow non-breaking spaces and figure
+# spaces
+THOUSANDS_SEPARATORS = ' \u00a0\u2009\u202f\u2007'
+
+# How many distinct price strings to remember. Listing pages repeat the same
+# round prices over and over
+PRICE_CACHE_SIZE = 4096
+
+RE_CURRENCY = re.compile(r'(?:kr\.?|sek|:-)', re.IGNORECASE)
+RE_SEPARATORS = re.compile('[%s]' % THOUSANDS_SEPARATORS)
+RE_RANGE = re.compile(r'^(.*\d)\s*[-–—]\s*(\d.*)$')
+RE_AMOUNT = re.compile(r'^(\d{1,3}(?:\.\d{3})+|\d+)(?:[,.](\d{1,2}))?$')
+RE_NUMBER_SPAN = re.compile(r'\d(?:.*\d)?', re.DOTALL)
+RE_NUMBER_SPACES = re.compile('[\r\n%s]' % THOUSANDS_SEPARATORS)
+
+
+def is_plain_digits(s):
+    return s.isdigit() and s.isascii()
+
+
+@lru_cache(maxsize=PRICE_CACHE_SIZE)
+def parse_price(s):
+    """Take an amount as displayed on Swedish sites, like '1 250 kr', '50',
+    '1 250,50 SEK' or '100 - 200 kr', and return it as an int, or as a float if
+    it has a non-zero decimal part. Ranges return their lower bound. Raise a
+    ParserError if s is not an amount"""
+
+    if is_plain_digits(s):
+        return int(s)
+
+    amount = RE_CURRENCY.sub('', s).strip()
+
+    m = RE_RANGE.match(amount)
+    if m:
+        low, high = parse_price(m.group(1)), parse_price(m.group(2))
+        return min(low, high)
+
+    amount = RE_SEPARATORS.sub('', amount)
+    m = RE_AMOUNT.match(amount)
+    if not m:
+        raise ParserError("Cannot parse price [%s]" % s)
+
+    units = int(m.group(1).replace('.', ''))
+    decimals = m.group(2)
+    if decimals and int(decimals):
+        return units + int(decimals) / 10 ** len(decimals)
+    return units
+
+
+def parse_number(s):
+    """Take a text containing one number, possibly with thousands separators
+    or line breaks between its digits, and return that number as an int.
+    Anything before the first digit or after the last one is ignored"""
+
+    if is_plain_digits(s):
+        return int(s)
+
+    m = RE_NUMBER_SPAN.search(s)
+    if not m:
+        raise ValueError("No number found in [%s]" % s)
+    return int(RE_NUMBER_SPACES.sub('', m.group(0)))
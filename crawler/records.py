@@ -0,0 +1,104 @@
+import logging
+from datetime import timezone
+from pymacaron_core.swagger.apipool import ApiPool
+
+
+log = logging.getLogger(__name__)
+
+
+#
+# Lightweight records for scraped objects. Crawlers and the consumer handle
+# those, and they are converted to swagger models or json only when they
+# leave the crawler, in ItemConsumer.flush() and get_scraped_objects()
+#
+
+
+def to_wire(v):
+    if hasattr(v, 'isoformat'):
+        if not v.tzinfo:
+            v = v.replace(tzinfo=timezone.utc)
+        return v.isoformat()
+    return v
+
+
+class BDLItemRecord():
+    """Same attributes as the ScrapedBDLItem swagger model"""
+
+    __slots__ = (
+        'title',
+        'description',
+        'price',
+        'price_is_fixed',
+        'currency',
+        'language',
+        'country',
+        'has_ended',
+        'date_ended',
+        'is_sold',
+        'price_sold',
+        'date_sold',
+        'epoch_published',
+        'native_doc_id',
+        'native_seller_id',
+        'native_seller_name',
+        'native_seller_is_shop',
+        'native_group_id',
+        'native_location',
+        'native_external_url',
+        'native_picture_url',
+    )
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.pop(k, None))
+        assert not kwargs, "Unknown ScrapedBDLItem attributes: %s" % ', '.join(kwargs.keys())
+
+    def to_dict(self):
+        d = {}
+        for k in self.__slots__:
+            v = getattr(self, k)
+            if v is not None:
+                d[k] = v
+        return d
+
+    def to_json(self):
+        return {k: to_wire(v) for k, v in self.to_dict().items()}
+
+    def to_model(self):
+        return ApiPool.crawler.model.ScrapedBDLItem(**self.to_dict())
+
+
+class ScrapedRecord():
+    """Same attributes as the ScrapedObject swagger model"""
+
+    __slots__ = (
+        'is_complete',
+        'native_url',
+        'scraper_data',
+        'bdlitem',
+    )
+
+    def __init__(self, is_complete=None, native_url=None, scraper_data=None, bdlitem=None):
+        self.is_complete = is_complete
+        self.native_url = native_url
+        self.scraper_data = scraper_data
+        self.bdlitem = bdlitem
+
+    def to_json(self):
+        j = {
+            'is_complete': self.is_complete,
+            'native_url': self.native_url,
+        }
+        if self.scraper_data is not None:
+            j['scraper_data'] = self.scraper_data
+        if self.bdlitem is not None:
+            j['bdlitem'] = self.bdlitem.to_json()
+        return j
+
+    def to_model(self):
+        return ApiPool.crawler.model.ScrapedObject(
+            is_complete=self.is_complete,
+            native_url=self.native_url,
+            scraper_data=self.scraper_data,
+            bdlitem=self.bdlitem.to_model() if self.bdlitem is not None else None,
+        )
@@ -1,5 +1,7 @@
 import logging
 from crawler.crawler import GenericCrawler
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
 from crawler.exceptions import InternalServerError
 
 
@@ -26,6 +28,24 @@ class TestCrawler(GenericCrawler):
         return None
 
 
+    def fetch_item(self, native_url, scraper_data=None):
+        """Simulate scraping a url into an ended announce"""
+
+        log.info("TEST: mock fetching url %s" % native_url)
+
+        if 'assert' in native_url:
+            assert 0, "Test failing an assert"
+
+        if 'error' in native_url:
+            raise InternalServerError("Test raising fatal error")
+
+        return ScrapedRecord(
+            is_complete=False,
+            native_url=native_url,
+            bdlitem=BDLItemRecord(has_ended=True),
+        )
+
+
     def scan(self):
         """Simulate scanning source"""
 
@@ -34,6 +54,20 @@ class TestCrawler(GenericCrawler):
         return None
 
 
+    def scan_category(self, category):
+        """Simulate scanning a category with 3 new items"""
+
+        log.info("TEST: mock scanning category %s" % category)
+
+        self.count_page = 1
+        for i in range(3):
+            self.consumer.process(ScrapedRecord(
+                is_complete=False,
+                native_url='%s/%s' % (category, i),
+                bdlitem=BDLItemRecord(has_ended=False),
+            ))
+
+
     def search(self, query, scraper_data=None):
         """Simulate searching source"""
 
@@ -1,12 +1,19 @@
+import re
 import logging
 from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 import json
-from datetime import datetime
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from pymacaron_core.swagger.apipool import ApiPool
 from pymacaron.crash import report_error
+from pymacaron.config import get_config
 from crawler.crawler import GenericCrawler
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+from crawler.numbers import parse_price
+from crawler.dates import parse_date
+from crawler.idepoch import get_id_epoch_model
+from crawler.io.metrics import get_metrics
+from crawler.io.profiler import propagate
 from crawler.exceptions import ParserError
 from crawler.exceptions import CannotGetUrlError
 from crawler.exceptions import SkipThisItem
@@ -31,14 +38,34 @@ TRADERA_CATEGORIES = [
     'konst-23',
 ]
 
+# How many categories to scan in parallel by default
+DEFAULT_CATEGORY_WORKERS = 4
+
+# Announce urls look like https://www.tradera.com/item/<category>/<id>/<slug>
+RE_ITEM_URL = re.compile(r'/item/\d+/(\d+)(?:/|$)')
+
 class TraderaCrawler(GenericCrawler):
 
+    # Tradera renders listing and announce pages server-side, so plain http
+    # is usually enough to get them
+    page_types = {
+        'listing': {'marker': 'item-card-figure', 'static': True, 'cache_ttl': 60},
+        'detail': {'marker': 'view-item-image-gallery', 'static': True, 'cache_ttl': 600},
+        'ended': {'marker': 'view-item-ended-summary-label', 'static': True, 'cache_ttl': 86400},
+    }
+
+    # The parts of each page that we actually parse
+    PARSE_LISTING_CARDS = 'item-card-body'
+    PARSE_LISTING_PAGINATION = 'page-link'
+    PARSE_ITEM = ('view-item-ended-summary', 'view-item')
+
     def __init__(self, **args):
         log.debug("TraderaCrawler got init args: %s" % args)
         super().__init__(**args)
         self.country = COUNTRY
         self.language = LANGUAGE
         self.count_page = 0
+        self.id_epoch_model = get_id_epoch_model(self.source.upper())
 
 
     def search(self, query, scraper_data=None):
@@ -46,11 +73,10 @@ class TraderaCrawler(GenericCrawler):
 
         url = BASE_URL + "/search?q=%s" % query
 
-        self.get_url(url, wait_condition=EC.presence_of_element_located((By.CLASS_NAME, "item-card-figure")))
+        self.get_url(url, page_type='listing')
 
-        # scrape the current listing page
-        for item in self.yield_listing_page_items():
-            self.scrape(item.native_url)
+        # scrape the current listing page, scraping announces concurrently
+        self.scrape_many(item.native_url for item in self.yield_listing_page_items())
 
         # The consumer will probably raise a limit exception before getting here, but if not,
         # let's return after the 1st page is scraped
@@ -58,9 +84,16 @@ class TraderaCrawler(GenericCrawler):
 
 
     def scrape(self, native_url, scraper_data=None):
-        """Parse an announce on Tradera"""
+        """Parse an announce on Tradera and pass it to the consumer"""
+        with get_metrics().time('scrape', self.source):
+            item = self.fetch_item_once(native_url, scraper_data=scraper_data)
+        return self.consumer.process(item)
+
 
-        if not self.get_url(native_url, wait_condition=EC.presence_of_element_located((By.CLASS_NAME, "view-item-image-gallery"))):
+    def fetch_item(self, native_url, scraper_data=None):
+        """Parse an announce on Tradera and return it as a ScrapedObject"""
+
+        if not self.get_url(native_url, page_type=('detail', 'ended')):
             raise CannotGetUrlError("Failed to fetch url %s" % native_url)
 
         log.debug("Scraping html: %s" % self.html[0:100])
@@ -69,39 +102,30 @@ class TraderaCrawler(GenericCrawler):
         # Has the announce ended?
         #
 
-        end_label_node = self.get_soup().find(class_='view-item-ended-summary-label')
+        end_label_node = self.get_soup(self.PARSE_ITEM).find(class_='view-item-ended-summary-label')
         if end_label_node:
             date_ended_node = end_label_node.findNext('span')
             assert date_ended_node, "Failed to find end date span in %s" % native_url
             date_ended_str = date_ended_node.text
 
-            # Now the date looks like '	30 maj 10:31'
-
-            # Add year to date
-            year_now = datetime.now().year
-            date_ended_str = '%s %s' % (year_now, date_ended_str)
+            # Now the date looks like '	30 maj 10:31', in the current year
+            date_ended = parse_date(date_ended_str)
 
-            # Format Swedish months to english
-            date_ended_str = date_ended_str.replace('maj', 'may').replace('okt', 'oct')
-
-            from dateutil import parser
-            date_ended = parser.parse(date_ended_str, ignoretz=True)
-
-            item = ApiPool.crawler.model.ScrapedObject(
+            item = ScrapedRecord(
                 is_complete=False,
                 native_url=native_url,
-                bdlitem=ApiPool.crawler.model.ScrapedBDLItem(
+                bdlitem=BDLItemRecord(
                     has_ended=True,
                     date_ended=date_ended,
                 )
             )
-            return self.consumer.process(item)
+            return item
 
         #
         # Item is still for sale
         #
 
-        main = self.get_soup().find(class_='view-item')
+        main = self.get_soup(self.PARSE_ITEM).find(class_='view-item')
         assert main, "Failed to find view-item in %s" % native_url
 
         # Title and picture
@@ -114,7 +138,7 @@ class TraderaCrawler(GenericCrawler):
         # Description
         tag = main.find(class_='view-item-description').find(class_='content-text')
         assert tag, "Failed to find description in %s" % native_url
-        description = self.html_to_text(str(tag))
+        description = self.html_to_text(tag)
 
         # Epoch of publication?
         tag = main.find(class_='view-item-footer-information-details-published')
@@ -138,7 +162,7 @@ class TraderaCrawler(GenericCrawler):
         # Find object id
         tag = main.find(class_='view-item-footer-information-details-itemid')
         assert tag, "Failed to item_id footer in %s" % native_url
-        native_doc_id = self.find_number(str(tag))
+        native_doc_id = self.find_number(tag)
 
         # Seller is a shop?
         native_seller_is_shop = False
@@ -153,10 +177,10 @@ class TraderaCrawler(GenericCrawler):
         native_seller_name = tag.text
         assert native_seller_name, "Failed to find seller name in %s" % native_url
 
-        item = ApiPool.crawler.model.ScrapedObject(
+        item = ScrapedRecord(
             is_complete=True,
             native_url=native_url,
-            bdlitem=ApiPool.crawler.model.ScrapedBDLItem(
+            bdlitem=BDLItemRecord(
                 title=title,
                 price=price,
                 price_is_fixed=price_is_fixed,
@@ -173,53 +197,129 @@ class TraderaCrawler(GenericCrawler):
             )
         )
 
-        log.debug("Scraped Tradera announce: %s" % json.dumps(ApiPool.crawler.model_to_json(item), indent=4))
-
-        return self.consumer.process(item)
+        self.id_epoch_model.add(native_doc_id, epoch_published)
 
+        log.debug("Scraped Tradera announce: %s" % json.dumps(item.to_json(), indent=4))
 
-    def scan(self):
-
-        for category in TRADERA_CATEGORIES:
+        return item
 
-            page_next = self.gen_first_page_url(category)
 
+    def scan(self):
+        """Scan all categories in parallel, each with its own listing page
+        cursor and epoch boundary, all feeding the same consumer. With
+        pre-loaded html, which stands for the first page fetched, scan them one
+        after the other instead"""
+
+        if self.pre_loaded_html:
+            for category in TRADERA_CATEGORIES:
+                try:
+                    self.scan_category(category)
+                except ConsumerEpochReachedError:
+                    log.info("Consumer reached epoch boundary for category %s" % category)
+            return
+
+        workers = getattr(get_config(), 'scan_category_workers', DEFAULT_CATEGORY_WORKERS)
+        executor = ThreadPoolExecutor(max_workers=min(workers, len(TRADERA_CATEGORIES)))
+
+        def scan_one(category):
             try:
-                while page_next:
-
-                    epoch_published = None
-
-                    # Fetch next listing page
-                    self.get_url(
-                        page_next,
-                        wait_condition=EC.presence_of_element_located((By.CLASS_NAME, "item-card-figure")),
-                    )
-
-                    # Get the url of the next listing page to scrape
-                    page_next = self.get_next_page_url()
-
-                    # scrape the current listing page
-                    for item in self.yield_listing_page_items():
-
-                        # The listing page does not show the publication time
-                        # of the announce, but we know that they are listed by
-                        # most recent first, so we get scrape the first item
-                        # and let the consumer check the epoch_published. If it
-                        # passes, all items in the page will pass as well, even
-                        # if their epoch_published is earlier than
-                        # epoch_oldest, but that's ok.
-                        if not epoch_published:
-                            log.info("Scraping and processing first item to get its epoch_published")
-                            item = self.scrape(item.native_url)
-
-                            epoch_published = item.bdlitem.epoch_published
-                            log.info("Using epoch_published=%s for all items on the scanned page" % epoch_published)
-
-                        else:
-                            self.consumer.process(item)
-
+                self.spawn().scan_category(category)
             except ConsumerEpochReachedError:
-                log.info("Consumer reached epoch boundary for category %s - Proceed with next category" % category)
+                log.info("Consumer reached epoch boundary for category %s" % category)
+
+        futures = [executor.submit(propagate(scan_one), category) for category in TRADERA_CATEGORIES]
+
+        try:
+            for f in as_completed(futures):
+                e = f.exception()
+                if e:
+                    # Stop the other categories at their next item and give up
+                    log.info("Category scan stopped with %s - Stopping all categories" % type(e).__name__)
+                    self.consumer.stop(str(e))
+                    raise e
+        finally:
+            for f in futures:
+                f.cancel()
+            executor.shutdown(wait=False)
+
+
+    def scan_category(self, category):
+        """Scan all listing pages of a category, until the consumer raises a
+        limit or epoch exception"""
+
+        page_next = self.gen_first_page_url(category)
+        if not self.get_listing_page(page_next):
+            return
+
+        # The listing page does not show the publication time of the
+        # announces, but we know that they are listed by most recent first,
+        # and that announce ids grow with time. We estimate the epoch of the
+        # most recent announce from its id, and stop at the first page older
+        # than epoch_oldest. If we can't tell, we scrape the first item and
+        # let the consumer check its epoch_published, which also calibrates
+        # the estimates. If it passes, all items in the page will pass as
+        # well, even if their epoch_published is earlier than epoch_oldest,
+        # but that's ok. That first item is scraped in the background while
+        # we fetch the next listing page.
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            while True:
+
+                # Get the url of the next listing page to scrape
+                page_next = self.get_next_page_url()
+                items = list(self.yield_listing_page_items())
+
+                boundary = self.compare_to_epoch_oldest(items) if items else 1
+                if boundary < 0:
+                    raise ConsumerEpochReachedError("Estimated that the items on the scanned page are older than the limit %s" % self.consumer.epoch_oldest)
+
+                # Earlier scans went past this page already, and so past all
+                # the older ones
+                seen = self.consumer.get_seen([item.native_url for item in items])
+                if items and len(seen) == len(set(item.native_url for item in items)):
+                    log.info("All %s items on the scanned page were already sent - Stopping category %s" % (len(items), category))
+                    return
+
+                first = None
+                if boundary == 0:
+                    log.info("Scraping and processing first item to get its epoch_published")
+                    first = executor.submit(propagate(self.spawn().fetch_item_once), items[0].native_url)
+                    first_seen = items[0].native_url in seen
+                    items = items[1:]
+
+                # Fetch next listing page while the first item is scraped
+                has_next = page_next and self.get_listing_page(page_next)
+
+                if first:
+                    item = self.consumer.process(first.result(), seen=first_seen)
+                    log.info("Using epoch_published=%s for all items on the scanned page" % item.bdlitem.epoch_published)
+
+                for item in items:
+                    self.consumer.process(item, seen=item.native_url in seen)
+
+                if not has_next:
+                    return
+
+        finally:
+            executor.shutdown(wait=False)
+
+
+    def compare_to_epoch_oldest(self, items):
+        """Estimate from their ids whether the listed items were published
+        after the consumer's epoch_oldest. Return 1 if surely so, -1 if
+        surely not and 0 if unsure"""
+
+        if not self.consumer.epoch_oldest:
+            return 1
+
+        doc_ids = [self.get_doc_id(item.native_url) for item in items]
+        if None in doc_ids:
+            return 0
+
+        boundary = self.id_epoch_model.compare(max(doc_ids), self.consumer.epoch_oldest)
+        log.info("Estimated epochs of item %s: %s (boundary: %s)" % (max(doc_ids), self.id_epoch_model.estimate(max(doc_ids)), boundary))
+        return boundary
 
     #
     # Internal methods
@@ -230,12 +330,13 @@ class TraderaCrawler(GenericCrawler):
         """Return all items found in this page. Not that these items are
         incomplete: they lack a description"""
 
-        cards = self.get_soup().find_all(class_='item-card-body')
+        cards = self.get_soup(self.PARSE_LISTING_CARDS).find_all(class_='item-card-body')
         log.info("Found %s item cards" % len(cards))
 
         for a in cards:
             try:
-                item = self.card_to_listing_item(a)
+                with get_metrics().time('listing_card', self.source):
+                    item = self.card_to_listing_item(a)
             except SkipThisItem:
                 log.info("Skipping this card")
                 continue
@@ -273,10 +374,10 @@ class TraderaCrawler(GenericCrawler):
         title = tag['title']
 
         # Let's prepare an ItemForSale representing this object
-        item = ApiPool.crawler.model.ScrapedObject(
+        item = ScrapedRecord(
             is_complete=False,
             native_url=native_url,
-            bdlitem=ApiPool.crawler.model.ScrapedBDLItem(
+            bdlitem=BDLItemRecord(
                 has_ended=False,
                 title=title,
                 price=int(price),
@@ -287,11 +388,16 @@ class TraderaCrawler(GenericCrawler):
             )
         )
 
-        log.debug("Generated tradera listing item: %s" % json.dumps(ApiPool.crawler.model_to_json(item), indent=4))
+        log.debug("Generated tradera listing item: %s" % json.dumps(item.to_json(), indent=4))
 
         return item
 
 
+    def get_listing_page(self, url):
+        self.count_page += 1
+        return self.get_url(url, page_type='listing')
+
+
     def gen_first_page_url(self, category, query=None):
         assert category
 
@@ -313,7 +419,7 @@ class TraderaCrawler(GenericCrawler):
         #
         # And it's missing when the last page is reached
 
-        elems = self.get_soup().find_all('a', class_='page-link', attrs={'rel': 'next'})
+        elems = self.get_soup(self.PARSE_LISTING_PAGINATION).find_all('a', class_='page-link', attrs={'rel': 'next'})
 
         if len(elems) == 0:
             log.info("This is the last page!")
@@ -327,11 +433,12 @@ class TraderaCrawler(GenericCrawler):
         return BASE_URL + href
 
 
+    def get_doc_id(self, native_url):
+        """Return the id of the announce at that url, or None"""
+        m = RE_ITEM_URL.search(native_url)
+        return int(m.group(1)) if m else None
+
+
     def string_to_price(self, s):
         """Take a tradera price and return a number"""
-        log.debug("looking at price [%s]" % s)
-        if 'kr' in s:
-            s = s.replace('kr', '')
-        else:
-            assert s.isdigit()
-        return self.find_number(s)
+        return parse_price(s.strip())
@@ -0,0 +1,86 @@
+import json
+import queue
+import logging
+import threading
+from pymacaron.exceptions import PyMacaronException
+from crawler.exceptions import ConsumerLimitReachedError
+from crawler.exceptions import ConsumerEpochReachedError
+
+
+log = logging.getLogger(__name__)
+
+
+# At most that many objects wait for the client to read them. The crawl
+# pauses when the client falls behind
+DEFAULT_MAX_PENDING = 20
+
+# How often a paused crawl checks whether the client went away
+POLL_SEC = 1
+
+
+END = object()
+
+
+def stream_objects(consumer, crawl, max_pending=DEFAULT_MAX_PENDING):
+    """Call crawl() in a background thread, and yield each object accepted by
+    its consumer as a line of json, as soon as it is accepted. The consumer
+    hands over objects instead of buffering them.
+
+    The last line is a summary of the crawl, as {"summary": {...}}, telling
+    how many objects were sent, why the crawl stopped, and its error if it
+    failed. If the generator is closed early, as when the client goes away,
+    the crawl is stopped at its next object.
+
+    """
+
+    pending = queue.Queue(maxsize=max_pending)
+    closed = threading.Event()
+    summary = {
+        'source': consumer.source,
+        'count': 0,
+        'skipped': 0,
+        'stopped': None,
+    }
+
+    def put(o):
+        """Queue o for the client, and return False if the client went away"""
+        while not closed.is_set():
+            try:
+                pending.put(o, timeout=POLL_SEC)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def on_object(o):
+        if not put(o):
+            raise ConsumerLimitReachedError("The client closed the stream - Stopping now.")
+
+    def run():
+        try:
+            crawl()
+        except (ConsumerLimitReachedError, ConsumerEpochReachedError) as e:
+            log.info(str(e))
+            summary['stopped'] = str(e)
+        except (Exception, PyMacaronException) as e:
+            log.exception("Streamed crawl of %s failed" % consumer.source)
+            summary['error'] = getattr(e, 'code', 'INTERNAL_SERVER_ERROR')
+            summary['error_description'] = str(e)
+        finally:
+            summary['count'] = consumer.count_items
+            summary['skipped'] = consumer.count_skipped
+            put(END)
+
+    consumer.on_object = on_object
+    t = threading.Thread(target=run, name='stream-%s' % consumer.source, daemon=True)
+    t.start()
+
+    try:
+        while True:
+            o = pending.get()
+            if o is END:
+                break
+            yield json.dumps(o.to_json()) + '\n'
+        yield json.dumps({'summary': summary}) + '\n'
+    finally:
+        closed.set()
@@ -0,0 +1,335 @@
+import re
+import html
+import string
+import logging
+from textwrap import wrap
+from bs4.element import Tag
+from bs4.element import Comment
+from bs4.element import NavigableString
+from html2text import html2text
+from html2text import config as html2text_config
+from html2text.utils import escape_md_section
+from html2text.utils import skipwrap
+
+
+log = logging.getLogger(__name__)
+
+
+# Html to text conversion used to go through html2text for every fragment,
+# whose pure-python html parser dominates the cost of scraping a page. The
+# TextWriter below replays html2text's output rules for the few tags found in
+# announces, directly on a parsed tree or on a raw fragment, and falls back
+# to html2text for anything else. Both paths give the exact same text.
+
+# Tags whose html2text rendering TextWriter knows how to replay
+SUPPORTED_TAGS = set(['br', 'b', 'strong', 'em', 'i', 'u', 'span', 'div', 'p', 'li'])
+
+# Tokenizing raw fragments, matching what python's HTMLParser would accept
+RE_START_TAG = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)(?:\s+[a-zA-Z_:][-.:a-zA-Z0-9_]*(?:\s*=\s*(?:\'[^\']*\'|"[^"]*"|[^\'"\s>]+))?)*\s*(/?)>')
+RE_END_TAG = re.compile(r'</([a-zA-Z][a-zA-Z0-9]*)\s*>')
+RE_ENTITY = re.compile(r'&([a-zA-Z][a-zA-Z0-9]*);')
+RE_SPECIAL = re.compile(r'[<&]')
+
+# What bs4 escapes when serializing text nodes
+RE_BS4_ESCAPED = re.compile(r'[&<>]')
+
+# html2text's output rules
+RE_WHITESPACES = re.compile(r'\s+')
+RE_MD_ESCAPABLE = re.compile(r'\\|^\s*(?:\d+\.|[-+])', re.MULTILINE)
+RE_NOT_SIMPLE_PARA = re.compile(r'^ |  |-[-\w]|[^\S ]')
+RE_STRESSED_FOLLOWER = re.compile(r'[^][(){}\s.!?]')
+
+# Final clean up
+RE_LEADING_SPACES = re.compile(r'^[\s]+', re.MULTILINE)
+RE_TRAILING_SPACES = re.compile(r'[\s]+$', re.MULTILINE)
+
+# html2text wraps paragraphs at that width
+BODY_WIDTH = html2text_config.BODY_WIDTH
+
+
+class UnsupportedMarkup(Exception):
+    pass
+
+
+class TextWriter():
+    """Replay html2text's conversion to markdown of a stream of html events,
+    for the tags in SUPPORTED_TAGS only. Mirrors the state kept by
+    html2text.HTML2Text, with its default config"""
+
+    def __init__(self):
+        self.outtextlist = []
+        self.p_p = 0
+        self.space = False
+        self.start = True
+        self.stressed = False
+        self.preceding_stressed = False
+        self.preceding_data = ''
+        self.lastWasNL = False
+        self.br_toggle = ''
+        self.in_li = False
+
+
+    def out(self, s):
+        self.outtextlist.append(s)
+        if s:
+            self.lastWasNL = s[-1] == '\n'
+
+
+    def o(self, data, puredata=False, force=False):
+        if puredata:
+            data = RE_WHITESPACES.sub(' ', data)
+            if data and data[0] == ' ':
+                self.space = True
+                data = data[1:]
+        if not data and not force:
+            return
+
+        if self.start:
+            self.space = False
+            self.p_p = 0
+            self.start = False
+
+        if force == 'end':
+            self.p_p = 0
+            self.out('\n')
+            self.space = False
+
+        if self.p_p:
+            self.out((self.br_toggle + '\n') * self.p_p)
+            self.space = False
+            self.br_toggle = ''
+
+        if self.space:
+            if not self.lastWasNL:
+                self.out(' ')
+            self.space = False
+
+        self.p_p = 0
+        self.out(data)
+
+
+    def pbr(self):
+        if self.p_p == 0:
+            self.p_p = 1
+
+
+    def handle_data(self, data, entity_char=False):
+        if not data:
+            return
+
+        if self.stressed:
+            data = data.strip()
+            self.stressed = False
+            self.preceding_stressed = True
+        elif self.preceding_stressed:
+            if RE_STRESSED_FOLLOWER.match(data[0]):
+                data = ' ' + data
+            self.preceding_stressed = False
+
+        if not entity_char and RE_MD_ESCAPABLE.search(data):
+            data = escape_md_section(data)
+        self.preceding_data = data
+        self.o(data, puredata=True)
+
+
+    def handle_entity(self, name):
+        """Handle the entity '&name;'"""
+        if name in html2text_config.UNIFIABLE:
+            ref = html2text_config.UNIFIABLE[name]
+        else:
+            ref = html.entities.html5.get(name + ';', '&%s;' % name)
+        if ref:
+            self.handle_data(ref, True)
+
+
+    def handle_tag(self, tag, start):
+        if tag not in SUPPORTED_TAGS:
+            raise UnsupportedMarkup(tag)
+
+        if tag in ('p', 'div'):
+            self.p_p = 2
+
+        elif tag == 'br':
+            if start:
+                self.o('  \n')
+
+        elif tag in ('em', 'i', 'u'):
+            emphasis = '_'
+            if start and self.preceding_data and self.preceding_data[-1] not in string.whitespace and self.preceding_data[-1] not in string.punctuation:
+                emphasis = ' _'
+                self.preceding_data += ' '
+            self.o(emphasis)
+            if start:
+                self.stressed = True
+
+        elif tag in ('b', 'strong'):
+            strong = '**'
+            if start and self.preceding_data and self.preceding_data[-1] == '*':
+                strong = ' **'
+                self.preceding_data += ' '
+            self.o(strong)
+            if start:
+                self.stressed = True
+
+        elif tag == 'li':
+            # Only list items outside of lists, as in <li>..</li> fragments
+            if start and self.in_li:
+                raise UnsupportedMarkup('nested li')
+            self.in_li = start
+            self.pbr()
+            if start:
+                self.o('* ')
+                self.start = True
+
+
+    def feed_fragment(self, s):
+        """Tokenize a raw html fragment the way HTMLParser would"""
+        pos = 0
+        while True:
+            m = RE_SPECIAL.search(s, pos)
+            if not m:
+                self.handle_data(s[pos:])
+                return
+
+            self.handle_data(s[pos:m.start()])
+            pos = m.start()
+
+            if s[pos] == '&':
+                m = RE_ENTITY.match(s, pos)
+                if not m:
+                    raise UnsupportedMarkup('entity')
+                self.handle_entity(m.group(1))
+
+            elif s.startswith('</', pos):
+                m = RE_END_TAG.match(s, pos)
+                if not m:
+                    raise UnsupportedMarkup('end tag')
+                self.handle_tag(m.group(1).lower(), False)
+
+            else:
+                m = RE_START_TAG.match(s, pos)
+                if not m:
+                    raise UnsupportedMarkup('start tag')
+                tag = m.group(1).lower()
+                self.handle_tag(tag, True)
+                if m.group(2):
+                    self.handle_tag(tag, False)
+
+            pos = m.end()
+
+
+    def feed_tree(self, node):
+        """Walk a beautifulsoup tree, producing the same events as parsing its
+        serialization would"""
+        if isinstance(node, Tag):
+            self.handle_tag(node.name, True)
+            data = []
+            for child in node.children:
+                if type(child) is NavigableString:
+                    data.append(child)
+                    continue
+                self.feed_string(''.join(data))
+                data = []
+                if isinstance(child, Comment):
+                    continue
+                self.feed_tree(child)
+            self.feed_string(''.join(data))
+            self.handle_tag(node.name, False)
+
+        else:
+            raise UnsupportedMarkup(type(node).__name__)
+
+
+    def feed_string(self, s):
+        """Handle a text node, whose &, < and > bs4 serializes as entities"""
+        pos = 0
+        for m in RE_BS4_ESCAPED.finditer(s):
+            self.handle_data(s[pos:m.start()])
+            self.handle_data(m.group(0), True)
+            pos = m.end()
+        self.handle_data(s[pos:])
+
+
+    def get_markdown(self):
+        self.pbr()
+        self.o('', force='end')
+        s = ''.join(self.outtextlist).replace('&nbsp_place_holder;', ' ')
+        return wrap_paragraphs(s)
+
+
+def wrap_paragraphs(s):
+    """Wrap paragraphs as html2text does, but skip textwrap for those fitting
+    on one line. Only the content of lines is kept: blank lines and the
+    whitespaces around lines are dropped by normalize() anyway"""
+
+    lines = []
+    for para in s.split('\n'):
+        if not para:
+            continue
+        if skipwrap(para, True, False, False):
+            if not html2text_config.RE_SPACE.match(para):
+                lines.append(para)
+        elif len(para) <= BODY_WIDTH and '\t' not in para:
+            lines.append(para)
+        elif not RE_NOT_SIMPLE_PARA.search(para.rstrip(' ')):
+            lines.extend(wrap_words(para.rstrip(' ')))
+        else:
+            indent = ''
+            if para.startswith('  *'):
+                indent = '    '
+            elif para.startswith('> '):
+                indent = '> '
+            lines.extend(wrap(para, BODY_WIDTH, break_long_words=False, subsequent_indent=indent))
+    return '\n'.join(lines)
+
+
+def wrap_words(para):
+    """Same as textwrap.wrap(para, BODY_WIDTH, break_long_words=False), for
+    paragraphs of words separated by single spaces and without hyphenated
+    words"""
+    lines = []
+    line = []
+    length = 0
+    for word in para.split(' '):
+        if not word:
+            continue
+        if line and length + 1 + len(word) > BODY_WIDTH:
+            lines.append(' '.join(line))
+            line = []
+        length = length + 1 + len(word) if line else len(word)
+        line.append(word)
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+
+def normalize(s):
+    """Clean up the markdown generated from html into our normalized text"""
+    s = html.unescape(s)
+    s = s.replace('\.', '.')
+    s = s.replace('\*', '*')
+    s = RE_LEADING_SPACES.sub('', s)
+    s = RE_TRAILING_SPACES.sub('', s)
+    return s
+
+
+def html2text_to_text(html):
+    """Convert html to normalized text with html2text"""
+    return normalize(html2text(str(html)))
+
+
+def html_to_text(html):
+    """Take some html, either as a string or a beautifulsoup element, and return
+    a text string, cleaned up of all html and normalized"""
+
+    w = TextWriter()
+    try:
+        if isinstance(html, str):
+            w.feed_fragment(str(html))
+        else:
+            w.feed_tree(html)
+    except UnsupportedMarkup as e:
+        log.debug("Converting html with html2text (unsupported markup: %s)" % str(e))
+        return html2text_to_text(html)
+
+    return normalize(w.get_markdown())
@@ -4,6 +4,7 @@ from flask import Flask
 from pymacaron import API, letsgo
 from crawler.formats import get_custom_formats
 from crawler.exceptions import error_reporter
+from crawler.autoscan import start_autoscan
 
 
 log = logging.getLogger(__name__)
@@ -30,6 +31,7 @@ def start(port=None, debug=None):
     )
     api.load_apis(path_apis)
     api.publish_apis(path='docs')
+    start_autoscan()
     api.start(serve=['crawler'])
 
 
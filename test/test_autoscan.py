@@ -0,0 +1,163 @@
+import os
+import jwt
+import logging
+import tempfile
+from unittest import TestCase
+from pymacaron.config import get_config
+from crawler.autoscan import ScanScheduler
+from crawler.autoscan import load_state
+from crawler.autoscan import scan_category
+from crawler.io import slack
+from crawler.io.slack import SlackNotifier
+from test_bdl import MockBDL
+from test_bdl import MockBDLTestCase
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 100000.0
+
+    def time(self):
+        return self.now
+
+
+class MockSource():
+    """Categories getting new items at the given rates per hour"""
+
+    def __init__(self, clock, rates):
+        self.clock = clock
+        self.rates = rates
+        self.scans = []
+        self.fail = False
+
+    def scan(self, category, epoch_oldest, epoch_youngest):
+        self.scans.append((category, epoch_oldest, epoch_youngest))
+        if self.fail:
+            raise Exception("Boom")
+        count = int(self.rates[category] * (epoch_youngest - epoch_oldest) / 3600)
+        return count, 1 + count // 50
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.source = MockSource(self.clock, {'busy': 600, 'quiet': 6})
+
+
+    def gen_scheduler(self, **kwargs):
+        return ScanScheduler('TEST', ['busy', 'quiet'], self.source.scan, clock=self.clock.time, overlap=0, **kwargs)
+
+
+    def run_for(self, scheduler, sec, step=60):
+        end = self.clock.now + sec
+        while self.clock.now < end:
+            scheduler.run_due()
+            self.clock.now += step
+
+
+    def test_intervals_follow_arrival_rates(self):
+        s = self.gen_scheduler(budget_per_hour=1000, min_interval=60, max_interval=6 * 3600, target_items=50)
+
+        # All categories are scanned at once, over the maximum window
+        self.assertEqual(s.run_due(), 2)
+        self.assertEqual(self.source.scans[0], ('busy', self.clock.now - 86400, self.clock.now))
+        busy, quiet = s.categories
+        self.assertAlmostEqual(busy.rate * 3600, 600)
+        self.assertAlmostEqual(quiet.rate * 3600, 6)
+
+        # Busy categories are scanned every 50 new items, and quiet ones at
+        # most every max_interval
+        self.assertEqual(busy.interval, 300)
+        self.assertEqual(quiet.interval, 6 * 3600)
+        self.source.scans = []
+        self.run_for(s, 3600)
+        self.assertEqual([c for c, _, _ in self.source.scans], ['busy'] * 11)
+
+        # Each scan picks up where the previous one started
+        for (_, oldest, _), (_, _, youngest) in zip(self.source.scans[1:], self.source.scans):
+            self.assertEqual(oldest, youngest)
+
+
+    def test_budget(self):
+        # The busy category alone needs 12 pages per hour to keep up, and 12
+        # more to be scanned every 5 min
+        s = self.gen_scheduler(budget_per_hour=18, min_interval=60, target_items=50)
+        s.run_due()
+        busy, quiet = s.categories
+        self.assertLessEqual(s.planned_per_hour, 18.01)
+        self.assertGreater(busy.interval, 300)
+        self.assertLess(busy.interval, quiet.interval)
+
+        # Over budget, scan as rarely as allowed
+        s = self.gen_scheduler(budget_per_hour=5, max_interval=7200)
+        s.run_due()
+        self.assertEqual([c.interval for c in s.categories], [7200, 7200])
+
+
+    def test_errors_and_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'autoscan.json')
+            s = self.gen_scheduler(min_interval=60, path=path)
+            self.source.fail = True
+            s.run_due()
+            busy = s.categories[0]
+            self.assertEqual(busy.count_errors, 1)
+            self.assertEqual(busy.last_error, 'Exception: Boom')
+            self.assertIsNone(busy.rate)
+            self.assertEqual(busy.epoch_next_run, self.clock.now + 60)
+
+            # The state survives restarts
+            self.source.fail = False
+            self.clock.now += 60
+            s.run_due()
+            state = load_state(path)
+            self.assertEqual([c['count_runs'] for c in state['categories']], [2, 2])
+            s = self.gen_scheduler(min_interval=60, path=path)
+            self.assertEqual(s.categories[0].epoch_last_scan, self.clock.now)
+            self.assertEqual(s.run_due(), 0)
+
+
+class ScanCategoryTests(MockBDLTestCase):
+
+    def setUp(self):
+        super().setUp()
+        conf = get_config()
+        self.keys = ('jwt_secret', 'jwt_issuer', 'jwt_audience', 'job_registry', 'seen_index', 'flush_validate_rate', 'slack_channel')
+        self.saved = {k: getattr(conf, k, None) for k in self.keys}
+        self.saved_notifier = slack.notifier
+        slack.notifier = SlackNotifier(post=lambda c, m: None)
+        conf.jwt_secret, conf.jwt_issuer, conf.jwt_audience = 'secret', 'test', 'bdl'
+        conf.slack_channel = 'test'
+        conf.job_registry = False
+        conf.seen_index = False
+        conf.flush_validate_rate = 0
+
+
+    def tearDown(self):
+        conf = get_config()
+        for k, v in self.saved.items():
+            setattr(conf, k, v)
+        slack.notifier = self.saved_notifier
+
+
+    def test_scheduled_flush_is_authenticated(self):
+        def check(auth):
+            try:
+                payload = jwt.decode(auth.split(' ')[1], 'secret', audience='bdl', algorithms=['HS256'])
+            except jwt.InvalidTokenError:
+                return False
+            return payload['sub'] == 'bdl-crawler-autoscan'
+
+        MockBDL.check = staticmethod(check)
+
+        # Scheduled scans run in a thread of their own, outside any request
+        self.assertEqual(scan_category('TEST', 'cars', 1000, 2000), (3, 1))
+        self.assertEqual(len(MockBDL.posted), 1)
+        path, auth, data = MockBDL.posted[0]
+        self.assertTrue(auth.startswith('Bearer '))
+        self.assertEqual([o['native_url'] for o in data['objects']], ['cars/0', 'cars/1', 'cars/2'])
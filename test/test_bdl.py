@@ -0,0 +1,91 @@
+import json
+import logging
+import threading
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymacaron_core.swagger.apipool import ApiPool
+from crawler.io.bdl import post_scraped_objects
+from crawler.exceptions import ApiCallError
+
+
+log = logging.getLogger(__name__)
+
+
+def is_test_token(auth):
+    return auth == 'Bearer TOK'
+
+
+class MockBDL(BaseHTTPRequestHandler):
+    """Accept items posted with an Authorization header passing
+    MockBDL.check, by default the Bearer token 'TOK' only"""
+
+    posted = []
+    check = staticmethod(is_test_token)
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        MockBDL.posted.append((self.path, self.headers.get('Authorization'), data))
+        if MockBDL.check(self.headers.get('Authorization')):
+            status, body = 200, {}
+        else:
+            status, body = 401, {'error_description': 'Bad token'}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockSpec():
+
+    def __init__(self, port):
+        self.protocol = 'http'
+        self.host = '127.0.0.1'
+        self.port = port
+
+
+class MockApi():
+
+    def __init__(self, port):
+        self.api_spec = MockSpec(port)
+
+
+class MockBDLTestCase(TestCase):
+    """Point calls to the BDL api at a local MockBDL"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockBDL)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.saved_api = getattr(ApiPool, 'api', None)
+        ApiPool.api = MockApi(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.saved_api:
+            ApiPool.api = cls.saved_api
+        else:
+            del ApiPool.api
+        cls.server.shutdown()
+
+    def setUp(self):
+        MockBDL.posted = []
+        MockBDL.check = staticmethod(is_test_token)
+
+
+class Tests(MockBDLTestCase):
+
+    def test_post_scraped_objects(self):
+        post_scraped_objects('tradera', [{'native_url': 'http://a'}], 'TOK')
+        path, auth, data = MockBDL.posted[0]
+        self.assertEqual(path, '/v1/items/process')
+        self.assertEqual(auth, 'Bearer TOK')
+        self.assertEqual(data['source'], 'TRADERA')
+        self.assertEqual(data['objects'], [{'native_url': 'http://a'}])
+
+        with self.assertRaises(ApiCallError):
+            post_scraped_objects('tradera', [], '')
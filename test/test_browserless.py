@@ -0,0 +1,98 @@
+import json
+import logging
+import threading
+from time import sleep
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from crawler.io.browserless import BrowserlessClient
+from crawler.exceptions import RenderServiceBusyError
+from crawler.exceptions import RenderServiceError
+
+
+log = logging.getLogger(__name__)
+
+
+class MockBrowserless(BaseHTTPRequestHandler):
+    """A stand-in for browserless.io's /content endpoint. The url to render
+    tells which status to reply with"""
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        MockBrowserless.requests.append((self.path, data))
+
+        with MockBrowserless.lock:
+            MockBrowserless.in_flight += 1
+            MockBrowserless.max_in_flight = max(MockBrowserless.max_in_flight, MockBrowserless.in_flight)
+        sleep(0.05)
+        with MockBrowserless.lock:
+            MockBrowserless.in_flight -= 1
+
+        status = 200
+        for code in (400, 429, 502):
+            if str(code) in data['url']:
+                status = code
+
+        body = ('<html>%s</html>' % data['url']).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Tests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockBrowserless)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+
+    def setUp(self):
+        MockBrowserless.requests = []
+        MockBrowserless.max_in_flight = 0
+
+
+    def test_content(self):
+        c = BrowserlessClient(base_url=self.base_url, token='abc')
+        url = 'https://www.tradera.com/item/1/2/"quoted"'
+        self.assertEqual(c.content(url), '<html>%s</html>' % url)
+        path, data = MockBrowserless.requests[0]
+        self.assertEqual(path, '/content?token=abc')
+        self.assertEqual(data, {'url': url})
+
+
+    def test_errors_are_classified(self):
+        c = BrowserlessClient(base_url=self.base_url)
+        with self.assertRaises(RenderServiceBusyError):
+            c.content('http://bob/429')
+        with self.assertRaises(RenderServiceBusyError):
+            c.content('http://bob/502')
+        with self.assertRaises(RenderServiceError):
+            c.content('http://bob/400')
+        with self.assertRaises(RenderServiceBusyError):
+            BrowserlessClient(base_url='http://127.0.0.1:1').content('http://bob')
+
+
+    def test_concurrency_limit(self):
+        c = BrowserlessClient(base_url=self.base_url, max_concurrent=3)
+        threads = [threading.Thread(target=c.content, args=('http://bob/%s' % i,)) for i in range(9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(MockBrowserless.requests), 9)
+        self.assertTrue(1 < MockBrowserless.max_in_flight <= 3)
@@ -0,0 +1,123 @@
+import logging
+import threading
+from time import sleep, time
+from unittest import TestCase
+from crawler.consumer import ItemConsumer
+from crawler.exceptions import ConsumerLimitReachedError
+from crawler.exceptions import ApiCallError
+from crawler.io.bdl import auth_token
+
+
+log = logging.getLogger(__name__)
+
+
+class Tests(TestCase):
+
+    def test_limit_count_shared_by_threads(self):
+        consumer = ItemConsumer('test', limit_count=25, allow_flush=False)
+        errors = []
+
+        def crawl(n):
+            try:
+                for i in range(100):
+                    consumer.process('%s-%s' % (n, i))
+            except ConsumerLimitReachedError:
+                errors.append(n)
+
+        threads = [threading.Thread(target=crawl, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(consumer.count_items, 25)
+        self.assertEqual(len(consumer.objects), 25)
+        self.assertEqual(sorted(errors), [0, 1, 2, 3])
+
+
+    def test_stop(self):
+        consumer = ItemConsumer('test', allow_flush=False)
+        consumer.process('a')
+        consumer.stop("Enough")
+        with self.assertRaises(ConsumerLimitReachedError):
+            consumer.process('b')
+        self.assertEqual(consumer.objects, ['a'])
+
+
+class SlowConsumer(ItemConsumer):
+
+    def __init__(self, *args, fail=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flush_count = 2
+        self.fail = fail
+        self.sent = []
+        self.tokens = []
+
+    def send_objects(self, objects, token):
+        sleep(0.1)
+        if self.fail:
+            raise ApiCallError("Flush error: BDL is down")
+        self.sent.append(objects)
+        self.tokens.append(token)
+
+
+class FlushTests(TestCase):
+
+    def test_flush_in_background(self):
+        consumer = SlowConsumer('test')
+        t0 = time()
+        for i in range(6):
+            consumer.process(i)
+        # Sending batches did not block crawling
+        self.assertTrue(time() - t0 < 0.1)
+        self.assertEqual(len(consumer.pending_flushes), 2)
+
+        # Backpressure: a third batch waits for the first one to be sent
+        for i in range(6, 9):
+            consumer.process(i)
+        self.assertTrue(time() - t0 >= 0.1)
+
+        consumer.flush()
+        self.assertEqual(consumer.sent, [[0, 1, 2], [3, 4, 5], [6, 7, 8], []])
+        self.assertEqual(len(consumer.pending_flushes), 0)
+
+
+    def test_flush_errors_surface(self):
+        consumer = SlowConsumer('test', fail=True)
+        for i in range(3):
+            consumer.process(i)
+        sleep(0.2)
+        with self.assertRaises(ApiCallError):
+            consumer.process(3)
+
+        consumer = SlowConsumer('test', fail=True)
+        consumer.process(0)
+        with self.assertRaises(ApiCallError):
+            consumer.flush()
+
+
+    def test_flush_sends_callers_token(self):
+        with auth_token('TOK'):
+            consumer = SlowConsumer('test')
+            for i in range(3):
+                consumer.process(i)
+            consumer.flush()
+        self.assertEqual(consumer.sent, [[0, 1, 2], []])
+        self.assertEqual(consumer.tokens, ['TOK', 'TOK'])
+
+
+    def test_flush_from_other_thread_sends_callers_token(self):
+        # Like a crawler's worker threads, outside of the request's context
+        with auth_token('TOK'):
+            consumer = SlowConsumer('test')
+
+        def work():
+            for i in range(3):
+                consumer.process(i)
+
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+        consumer.flush()
+        self.assertEqual(consumer.sent, [[0, 1, 2], []])
+        self.assertEqual(consumer.tokens, ['TOK', 'TOK'])
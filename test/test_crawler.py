@@ -1,12 +1,27 @@
 import logging
+import random
+from time import sleep
 from unittest import TestCase
 from crawler.crawler import GenericCrawler
+from crawler.crawler import get_crawler
 from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.exceptions import ConsumerLimitReachedError
 
 
 log = logging.getLogger(__name__)
 
 
+class SlowCrawler(GenericCrawler):
+
+    fetched = []
+
+    def fetch_item(self, native_url, scraper_data=None):
+        sleep(random.random() / 50)
+        SlowCrawler.fetched.append(native_url)
+        return ScrapedRecord(native_url=native_url)
+
+
 class Tests(TestCase):
 
     def setUp(self):
@@ -52,3 +67,61 @@ class Tests(TestCase):
 
         for date, tzname, epoch in tests:
             self.assertEqual(c.date_to_epoch(date, tzname=tzname), epoch, "Converting '%s'" % date)
+
+
+    def test_scrape_many__keeps_listing_order(self):
+        consumer = ItemConsumer(source='test', allow_flush=False)
+        c = SlowCrawler(source='test', consumer=consumer, scrape_workers=4)
+        urls = ['url%s' % i for i in range(20)]
+        c.scrape_many(urls)
+        self.assertEqual([o.native_url for o in consumer.objects], urls)
+
+
+    def test_scrape_many__stops_at_consumer_limit(self):
+        SlowCrawler.fetched = []
+        consumer = ItemConsumer(source='test', allow_flush=False, limit_count=5)
+        c = SlowCrawler(source='test', consumer=consumer, scrape_workers=3)
+        urls = ['url%s' % i for i in range(50)]
+        with self.assertRaises(ConsumerLimitReachedError):
+            c.scrape_many(urls)
+        self.assertEqual([o.native_url for o in consumer.objects], urls[0:5])
+        sleep(0.1)
+        # At most scrape_workers pages were in flight when the limit was reached
+        self.assertTrue(len(SlowCrawler.fetched) <= 5 + 3)
+
+
+    def test_scrape_batch__per_url_errors(self):
+        consumer = ItemConsumer(source='test', allow_flush=False)
+        c = SlowCrawler(source='test', consumer=consumer, scrape_workers=4)
+        urls = ['url%s' % i for i in range(20)]
+        self.assertEqual(c.scrape_batch(urls), [])
+        self.assertEqual([o.native_url for o in consumer.objects], urls)
+
+        # Urls may come from a generator
+        consumer.objects = []
+        self.assertEqual(c.scrape_batch(u for u in urls), [])
+        self.assertEqual([o.native_url for o in consumer.objects], urls)
+
+        c = get_crawler('TEST', scrape_workers=4, allow_flush=False)
+        errors = c.scrape_batch(['a', 'b-error', 'c', 'd-assert', 'e'])
+        self.assertEqual([o.native_url for o in c.consumer.objects], ['a', 'c', 'e'])
+        self.assertEqual([(u, type(e).__name__) for u, e in errors], [('b-error', 'InternalServerError'), ('d-assert', 'AssertionError')])
+
+
+    def test_get_soup__parse_only(self):
+        c = GenericCrawler(source='test', consumer=ItemConsumer(source='test'))
+        self.assertIsNone(c.get_soup())
+
+        c.html = '<html><body><div class="menu">menu</div><article class="view-item big"><p class="x">item</p></article><p class="other">other</p></body></html>'
+
+        soup = c.get_soup('view-item')
+        self.assertEqual(soup.find(class_='x').text, 'item')
+        self.assertIsNone(soup.find(class_='menu'))
+        self.assertIsNone(soup.find(class_='other'))
+        self.assertIs(c.get_soup('view-item'), soup)
+
+        soup = c.get_soup(('view-item', 'other'))
+        self.assertEqual(soup.find(class_='other').text, 'other')
+        self.assertIsNone(soup.find(class_='menu'))
+
+        self.assertEqual(c.get_soup().find(class_='menu').text, 'menu')
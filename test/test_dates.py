@@ -0,0 +1,84 @@
+import logging
+from unittest import TestCase
+from datetime import datetime
+from crawler import dates
+from crawler.dates import parse_date
+from crawler.dates import date_to_epoch
+from crawler.dates import get_timezone
+
+
+log = logging.getLogger(__name__)
+
+
+class Tests(TestCase):
+
+    def test_parse_date(self):
+        year = datetime.now().year
+        tests = [
+            # date, datetime
+            ['2019-05-16 10:29', datetime(2019, 5, 16, 10, 29)],
+            ['2019-05-16 10:29:13', datetime(2019, 5, 16, 10, 29, 13)],
+            ['\t30 maj 10:31', datetime(year, 5, 30, 10, 31)],
+            ['1 okt 08:05', datetime(year, 10, 1, 8, 5)],
+            ['12 februari 23:59', datetime(year, 2, 12, 23, 59)],
+            ['23 May 2019 20:57:00', datetime(2019, 5, 23, 20, 57)],
+            ['Thu May 23 2019 22:02:14', datetime(2019, 5, 23, 22, 2, 14)],
+        ]
+
+        for s, date in tests:
+            self.assertEqual(parse_date(s), date, "Parsing '%s'" % s)
+
+
+    def test_parse_date__swedish_months(self):
+        months = ['jan', 'feb', 'mar', 'apr', 'maj', 'jun', 'jul', 'aug', 'sep', 'okt', 'nov', 'dec']
+        for i, month in enumerate(months):
+            self.assertEqual(parse_date('3 %s 12:00' % month, year=2019), datetime(2019, i + 1, 3, 12, 0))
+
+
+    def test_parse_date__year(self):
+        self.assertEqual(parse_date('30 maj 10:31', year=2018), datetime(2018, 5, 30, 10, 31))
+        self.assertEqual(parse_date('Wed May 30 10:31', year=2018), datetime(2018, 5, 30, 10, 31))
+
+
+    def test_date_to_epoch(self):
+        tests = [
+            # date, tzname, epoch
+            ['23 May 2019 20:57:00', None, 1558637820],
+            ['23 May 2019 20:57:00', 'Europe/Stockholm', 1558637820],
+            ['2019-05-23 20:57', None, 1558637820],
+            ['2019-05-23 20:57', 'UTC', 1558645020],
+            # Winter time, and around changes of time, as pytz localizes them
+            ['2019-01-23 20:57', None, 1548273420],
+            ['2019-10-27 01:30', None, 1572132600],
+            ['2019-10-27 02:30', None, 1572139800],
+            ['2019-10-27 03:30', None, 1572143400],
+            ['2019-03-31 02:30', None, 1553995800],
+        ]
+
+        for s, tzname, epoch in tests:
+            self.assertEqual(date_to_epoch(s, tzname=tzname), epoch, "Converting '%s'" % s)
+
+
+    def test_date_to_epoch__new_year(self):
+        class FakeDatetime(datetime):
+            year = 2018
+
+            @classmethod
+            def now(cls, tz=None):
+                return datetime(cls.year, 12, 31, 23, 59)
+
+        saved = dates.datetime
+        dates.datetime = FakeDatetime
+        try:
+            epoch = date_to_epoch('Thu May 23 22:02:14')
+            self.assertEqual(epoch, date_to_epoch('2018-05-23 22:02:14'))
+
+            # A long-lived worker gets this year's date after New Year
+            FakeDatetime.year = 2019
+            self.assertEqual(date_to_epoch('Thu May 23 22:02:14'), date_to_epoch('2019-05-23 22:02:14'))
+        finally:
+            dates.datetime = saved
+
+
+    def test_get_timezone(self):
+        self.assertIs(get_timezone('Europe/Stockholm'), get_timezone('Europe/Stockholm'))
@@ -0,0 +1,136 @@
+import logging
+from time import sleep, time
+from unittest import TestCase
+from pymacaron.config import get_config
+from crawler.io import hedge
+from crawler.io.hedge import Hedger
+from crawler.crawler import GenericCrawler
+from crawler.consumer import ItemConsumer
+from crawler.exceptions import RenderServiceBusyError
+
+
+log = logging.getLogger(__name__)
+
+
+def gen_attempt(result, delay=0, error=None, calls=None):
+    """Return an attempt taking 'delay' seconds, or until cancelled"""
+    def attempt(cancelled):
+        if calls is not None:
+            calls.append(result)
+        if cancelled.wait(delay):
+            return None
+        if error:
+            raise error
+        return result
+    return attempt
+
+
+class MockCrawler(GenericCrawler):
+    """Renders hang on the first call only"""
+
+    def __init__(self, **args):
+        super().__init__(**args)
+        self.calls = []
+
+    def render_once(self, url, wait_condition=None, cancelled=None, is_hedge=False):
+        self.calls.append(is_hedge)
+        if len(self.calls) == 1:
+            if cancelled:
+                cancelled.wait(5)
+            return None
+        return '<html>%s</html>' % url
+
+
+class Tests(TestCase):
+
+    def test_fast_attempt_is_not_hedged(self):
+        h = Hedger(default_delay=0.5)
+        calls = []
+        self.assertEqual(h.run(gen_attempt('a', calls=calls), gen_attempt('b', calls=calls)), 'a')
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(h.get_stats()['hedges'], 0)
+
+
+    def test_slow_attempt_is_hedged(self):
+        h = Hedger(default_delay=0.1)
+        t0 = time()
+        self.assertEqual(h.run(gen_attempt('a', delay=5), gen_attempt('b')), 'b')
+        self.assertLess(time() - t0, 1)
+        stats = h.get_stats()
+        self.assertEqual(stats['hedges'], 1)
+        self.assertEqual(stats['hedge_wins'], 1)
+
+        # The slow attempt may still win
+        self.assertEqual(h.run(gen_attempt('a', delay=0.2), gen_attempt('b', delay=5)), 'a')
+        self.assertEqual(h.get_stats()['hedge_wins'], 1)
+
+
+    def test_failures(self):
+        h = Hedger(default_delay=0.1)
+        self.assertEqual(h.run(gen_attempt('a', delay=0.2, error=Exception("a")), gen_attempt('b', delay=0.2)), 'b')
+        self.assertEqual(h.run(gen_attempt('a', delay=0.2), gen_attempt('b', error=Exception("b"))), 'a')
+        self.assertEqual(h.run(gen_attempt('a', delay=0.2), gen_attempt('b', error=RenderServiceBusyError("b"))), 'a')
+        with self.assertRaises(Exception):
+            h.run(gen_attempt('a', error=Exception("a")), gen_attempt('b'))
+
+
+    def test_budget(self):
+        h = Hedger(default_delay=0.05, budget_ratio=0.5, budget_burst=1)
+        for i in range(4):
+            h.run(gen_attempt('a', delay=0.1), gen_attempt('b', delay=1))
+        # One hedge saved, then one every 2 calls
+        stats = h.get_stats()
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(stats['hedges'], 2)
+        self.assertEqual(stats['over_budget'], 2)
+
+
+    def test_delay_percentile(self):
+        h = Hedger(percentile=90, min_delay=0.5, default_delay=3)
+        self.assertEqual(h.get_delay(), 3)
+        for i in range(100):
+            h.add_latency(i / 10)
+        self.assertEqual(h.get_delay(), 9)
+        h = Hedger(percentile=90, min_delay=0.5)
+        for i in range(100):
+            h.add_latency(0.1)
+        self.assertEqual(h.get_delay(), 0.5)
+
+        # Successful attempts are timed
+        h = Hedger()
+        h.run(gen_attempt('a', delay=0.05), gen_attempt('b'))
+        sleep(0.05)
+        self.assertEqual(len(h.latencies), 1)
+        self.assertGreaterEqual(h.latencies[0], 0.05)
+
+        # Only the winner is, not an attempt completing after it lost
+        def stubborn(cancelled):
+            sleep(0.3)
+            return 'a'
+
+        h = Hedger(default_delay=0.1)
+        self.assertEqual(h.run(stubborn, gen_attempt('b')), 'b')
+        sleep(0.4)
+        self.assertEqual(len(h.latencies), 1)
+        self.assertLess(h.latencies[0], 0.1)
+
+
+    def test_render_hedged(self):
+        conf = get_config()
+        saved = getattr(conf, 'hedge_renders', False), hedge.hedger
+        conf.hedge_renders = True
+        hedge.hedger = Hedger(default_delay=0.1)
+        try:
+            # Crawlers hedge only when asked to
+            c = MockCrawler(source='test', consumer=ItemConsumer('test'))
+            self.assertIsNone(c.render_hedged('http://a'))
+            self.assertEqual(c.calls, [False])
+
+            c = MockCrawler(source='test', consumer=ItemConsumer('test'), hedge=True)
+            self.assertEqual(c.spawn().hedge, True)
+            t0 = time()
+            self.assertEqual(c.render_hedged('http://a'), '<html>http://a</html>')
+            self.assertLess(time() - t0, 1)
+            self.assertEqual(c.calls, [False, True])
+        finally:
+            conf.hedge_renders, hedge.hedger = saved
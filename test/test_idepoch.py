@@ -0,0 +1,101 @@
+import logging
+from unittest import TestCase
+from crawler.idepoch import IdEpochModel
+from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+from crawler.sources.tradera import TraderaCrawler
+from crawler.exceptions import ConsumerEpochReachedError
+
+
+log = logging.getLogger(__name__)
+
+
+CARD = '<div class="item-card-body"><figure class="item-card-figure"><a href="/item/1/%s/x"><img alt="x" src="//img.tradera.net/%s.jpg"/></a></figure><span class="item-card-details-price-before-discount">%s kr</span><h3 class="item-card-details-header" title="Item %s"></h3></div>'
+
+
+class MockTraderaCrawler(TraderaCrawler):
+    """Scan listing pages made of the given lists of item ids, where item i
+    was published at epoch 1000 * i"""
+
+    def __init__(self, pages=None, **args):
+        super().__init__(**args)
+        self.pages = pages
+        self.scraped = []
+
+    def get_listing_page(self, url):
+        self.soups = {}
+        self.html = '<html><body>%s</body></html>' % ''.join([CARD % (i, i, i, i) for i in self.pages.pop(0)])
+        return True
+
+    def get_next_page_url(self):
+        return 'next' if self.pages else None
+
+    def fetch_item(self, native_url, scraper_data=None):
+        doc_id = self.get_doc_id(native_url)
+        self.scraped.append(doc_id)
+        self.id_epoch_model.add(doc_id, doc_id * 1000)
+        return ScrapedRecord(
+            is_complete=True,
+            native_url=native_url,
+            bdlitem=BDLItemRecord(has_ended=False, native_doc_id=str(doc_id), epoch_published=doc_id * 1000),
+        )
+
+
+class Tests(TestCase):
+
+    def test_estimate(self):
+        m = IdEpochModel(margin=10)
+        self.assertEqual(m.estimate(100), (None, None))
+        self.assertEqual(m.compare(100, 0), 0)
+
+        m.add(100, 1000)
+        self.assertEqual(m.estimate(100), (1000, 1000))
+        self.assertEqual(m.estimate(200), (1000, None))
+        self.assertEqual(m.estimate(50), (None, 1000))
+
+        # Between known points, epochs are bounded by theirs
+        m.add(200, 2000)
+        self.assertEqual(m.estimate(150), (1000, 2000))
+        self.assertEqual(m.compare(150, 1000), 1)
+        self.assertEqual(m.compare(150, 2001), -1)
+        self.assertEqual(m.compare(150, 1500), 0)
+
+        # Beyond them, epochs are extrapolated at 10 sec per id, with an
+        # error of 10 sec + 25% of the distance to the nearest point
+        self.assertEqual(m.estimate(300), (2740, 3260))
+        self.assertEqual(m.estimate(0), (-260, 260))
+        self.assertEqual(m.estimate(201), (2000, 2022.5))
+        self.assertEqual(m.compare(0, 500), -1)
+        self.assertEqual(m.compare(300, 2700), 1)
+        self.assertEqual(m.compare(300, 2900), 0)
+
+
+    def test_forget_oldest_points(self):
+        m = IdEpochModel(max_points=3)
+        for i in (5, 1, 3, 4):
+            m.add(i, i * 10)
+        self.assertEqual(m.ids, [1, 3, 4])
+        self.assertEqual(sorted(m.epochs.keys()), [1, 3, 4])
+        m.add(3, 30)
+        self.assertEqual(m.ids, [1, 3, 4])
+
+
+    def test_scan_boundary(self):
+        consumer = ItemConsumer('TEST-IDEPOCH', epoch_oldest=90000, allow_flush=False)
+        c = MockTraderaCrawler(
+            source='TEST-IDEPOCH',
+            consumer=consumer,
+            pages=[[100, 99, 98], [97, 96, 95], [94, 93, 92], [91, 90, 89], [88, 87, 86], [85, 84, 83]],
+            scrape_workers=1,
+        )
+        c.spawn = lambda: c
+        with self.assertRaises(ConsumerEpochReachedError):
+            c.scan_category('test')
+
+        # Only pages whose epochs could not be estimated closely enough were
+        # scraped, and the scan stopped at the first page estimated older
+        # than epoch_oldest, without scraping it
+        self.assertEqual(c.scraped, [100, 97, 91])
+        self.assertEqual(consumer.count_items, 12)
+        self.assertEqual(c.pages, [[85, 84, 83]])
@@ -0,0 +1,206 @@
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from pymacaron.config import get_config
+from crawler.io import jobs
+from crawler.io.jobs import JobRegistry
+from crawler.io.jobs import contains
+from crawler.io.jobs import union
+from crawler.io.jobs import dispatch_job
+from crawler.io.jobs import QUEUED, RUNNING, DONE, FAILED, LOST
+from crawler.exceptions import JobNotQueuedError
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.now += sec
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'jobs.sqlite')
+        self.clock = FakeClock()
+        self.registry = JobRegistry(path=self.path, max_running=2, limits={'TRADERA': 1}, stale_sec=60, clock=self.clock.time, sleep=self.clock.sleep)
+
+
+    def tearDown(self):
+        self.registry.db.close()
+        self.tmpdir.cleanup()
+
+
+    def submit(self, *args, **kwargs):
+        self.clock.now += 1
+        return self.registry.submit(*args, **kwargs)
+
+
+    def test_contains(self):
+        self.assertTrue(contains(0, 10, 0, 10))
+        self.assertTrue(contains(0, 10, 2, 8))
+        self.assertFalse(contains(0, 10, 5, 15))
+        self.assertFalse(contains(5, 15, 0, 10))
+        self.assertTrue(contains(None, None, 11, 15))
+        self.assertTrue(contains(0, None, 11, None))
+        self.assertFalse(contains(0, 10, 5, None))
+
+
+    def test_union(self):
+        self.assertEqual(union(0, 10, 5, 15), (0, 15))
+        self.assertEqual(union(5, 15, 0, 10), (0, 15))
+        self.assertEqual(union(0, 10, 2, 8), (0, 10))
+        self.assertEqual(union(0, 10, None, 8), (None, 10))
+        self.assertEqual(union(0, None, 2, 8), (0, None))
+
+
+    def test_coalesce_identical_jobs(self):
+        job_id, is_new = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)
+        self.assertTrue(is_new)
+        self.assertEqual(self.registry.get(job_id)['state'], QUEUED)
+
+        # Scans of the same source are the same job while it is queued, which
+        # then covers their windows too
+        self.assertEqual(self.submit('scan', 'TRADERA', epoch_oldest=20, epoch_youngest=80), (job_id, False))
+        self.assertEqual(self.submit('scan', 'TRADERA', epoch_oldest=50, epoch_youngest=150), (job_id, False))
+        job = self.registry.get(job_id)
+        self.assertEqual((job['epoch_oldest'], job['epoch_youngest']), (0, 150))
+        self.assertTrue(self.submit('scan', 'BLOCKET', epoch_oldest=0, epoch_youngest=100)[1])
+
+        # Once running, only those within its window are
+        self.assertTrue(self.registry.try_start(job_id))
+        self.assertEqual(self.submit('scan', 'TRADERA', epoch_oldest=20, epoch_youngest=80), (job_id, False))
+        running_id = job_id
+        job_id, is_new = self.submit('scan', 'TRADERA', epoch_oldest=50, epoch_youngest=200)
+        self.assertTrue(is_new)
+        job = self.registry.get(running_id)
+        self.assertEqual((job['epoch_oldest'], job['epoch_youngest']), (0, 150))
+
+        # Scrapes of the same page are the same job
+        scrape_id, is_new = self.submit('scrape', 'TRADERA', native_url='http://a')
+        self.assertTrue(is_new)
+        self.assertEqual(self.submit('scrape', 'TRADERA', native_url='http://a'), (scrape_id, False))
+        self.assertTrue(self.submit('scrape', 'TRADERA', native_url='http://b')[1])
+
+        # Until the job completes
+        self.registry.finish(running_id, 12)
+        job = self.registry.get(running_id)
+        self.assertEqual(job['state'], DONE)
+        self.assertEqual(job['count'], 12)
+        self.assertNotEqual(self.submit('scan', 'TRADERA', epoch_oldest=20, epoch_youngest=80)[0], running_id)
+
+
+    def test_coalesce_same_settings_only(self):
+        settings = {'limit_count': 10, 'use_cache': True}
+        job_id = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings=settings)[0]
+        self.assertEqual(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings=dict(settings)), (job_id, False))
+        self.assertTrue(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings=dict(settings, use_cache=False))[1])
+        self.assertTrue(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings=dict(settings, pre_loaded_html='<html>'))[1])
+        self.assertTrue(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)[1])
+
+
+    def test_per_source_limits(self):
+        t1 = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings={'limit_count': 1})[0]
+        t2 = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings={'limit_count': 2})[0]
+        t3 = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100, settings={'limit_count': 3})[0]
+        b1 = self.submit('scan', 'BLOCKET', epoch_oldest=0, epoch_youngest=100, settings={'limit_count': 1})[0]
+        b2 = self.submit('scan', 'BLOCKET', epoch_oldest=0, epoch_youngest=100, settings={'limit_count': 2})[0]
+
+        # Jobs start in the order they were submitted
+        self.assertFalse(self.registry.try_start(t2))
+        self.assertTrue(self.registry.try_start(t1))
+        self.assertFalse(self.registry.try_start(t2))
+        self.assertTrue(self.registry.try_start(b1))
+        self.assertTrue(self.registry.try_start(b2))
+        self.assertEqual(self.registry.get(t2)['state'], QUEUED)
+
+        self.registry.finish(t1, 0, error='Boom')
+        self.assertEqual(self.registry.get(t1)['state'], FAILED)
+        self.assertEqual(self.registry.get(t1)['error'], 'Boom')
+        self.assertFalse(self.registry.try_start(t3))
+        self.registry.start(t2)
+        self.assertEqual(self.registry.get(t2)['state'], RUNNING)
+
+
+    def test_lost_jobs(self):
+        job_id = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)[0]
+        self.registry.try_start(job_id)
+        self.clock.now += 30
+        self.registry.update(job_id, 5)
+        self.assertEqual(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100), (job_id, False))
+
+        # A job whose worker stopped reporting is lost, and frees its slot
+        self.clock.now += 61
+        new_id, is_new = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)
+        self.assertTrue(is_new)
+        job = self.registry.get(job_id)
+        self.assertEqual(job['state'], LOST)
+        self.assertEqual(job['count'], 5)
+        self.assertTrue(self.registry.try_start(new_id))
+
+        # A late worker can't start a lost job
+        lost_id = self.submit('scan', 'BLOCKET', epoch_oldest=0, epoch_youngest=100)[0]
+        self.clock.now += 61
+        self.assertFalse(self.registry.try_start(lost_id))
+        self.assertEqual(self.registry.get(lost_id)['state'], LOST)
+        with self.assertRaises(JobNotQueuedError):
+            self.registry.start(lost_id)
+
+
+    def test_run(self):
+        job_id = self.submit('scrape', 'TEST', native_url='http://a')[0]
+        with self.registry.run(job_id) as job:
+            job.counter = lambda: 3
+            self.assertEqual(self.registry.get(job_id)['state'], RUNNING)
+        self.assertEqual(self.registry.get(job_id)['state'], DONE)
+        self.assertEqual(self.registry.get(job_id)['count'], 3)
+
+        job_id = self.submit('scrape', 'TEST', native_url='http://b')[0]
+        with self.assertRaises(ValueError):
+            with self.registry.run(job_id):
+                raise ValueError("bob")
+        self.assertEqual(self.registry.get(job_id)['state'], FAILED)
+        self.assertEqual(self.registry.get(job_id)['error'], 'ValueError: bob')
+
+        # Jobs run over their window, as widened while queued
+        job_id = self.submit('scan', 'TEST', epoch_oldest=0, epoch_youngest=100)[0]
+        self.submit('scan', 'TEST', epoch_oldest=0, epoch_youngest=160)
+        with self.registry.run(job_id) as job:
+            self.assertEqual(job.window(0, 100), (0, 160))
+
+        # Jobs without id are not tracked
+        with self.registry.run(None) as job:
+            self.assertEqual(job.window(0, 100), (0, 100))
+        self.assertIsNone(self.registry.get(None))
+
+
+    def test_dispatch_failure(self):
+        conf = get_config()
+        saved = getattr(conf, 'job_registry', False), jobs.job_registry
+        conf.job_registry = True
+        jobs.job_registry = self.registry
+        try:
+            def broken(*args, **kwargs):
+                raise ConnectionError("Broker is down")
+
+            job_id = self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)[0]
+            with self.assertRaises(ConnectionError):
+                dispatch_job(broken, 'TRADERA', job_id=job_id)
+
+            # The job doesn't hold back identical ones
+            job = self.registry.get(job_id)
+            self.assertEqual(job['state'], FAILED)
+            self.assertEqual(job['error'], 'Failed to dispatch job: ConnectionError: Broker is down')
+            self.assertTrue(self.submit('scan', 'TRADERA', epoch_oldest=0, epoch_youngest=100)[1])
+        finally:
+            conf.job_registry, jobs.job_registry = saved
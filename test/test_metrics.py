@@ -0,0 +1,131 @@
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from pymacaron.config import get_config
+from crawler.io import metrics
+from crawler.io.metrics import Metrics
+from crawler.io.metrics import MetricsStore
+from crawler.io.metrics import get_metrics
+from crawler.io.metrics import render_metrics
+from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.crawler import GenericCrawler
+from crawler.exceptions import ConsumerLimitReachedError
+
+
+log = logging.getLogger(__name__)
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.saved = metrics.metrics
+        metrics.metrics = Metrics()
+
+
+    def tearDown(self):
+        metrics.metrics = self.saved
+
+
+    def test_render(self):
+        m = metrics.metrics
+        m.inc('crawler_pages_total', source='TRADERA', method='static')
+        m.inc('crawler_pages_total', 2, source='TRADERA', method='static')
+        m.inc('crawler_bytes_total', 1234, source='TRA"DERA', method='static')
+        m.observe('crawler_stage_seconds', 0.3, source='TRADERA', stage='render')
+        m.observe('crawler_stage_seconds', 100, source='TRADERA', stage='render')
+
+        text = m.render(gauges={'crawler_host_rate': ('Host rate', [({'host': 'a.com'}, 0.5), ({'host': 'b.com'}, None)])})
+        lines = text.split('\n')
+        self.assertIn('# TYPE crawler_pages_total counter', lines)
+        self.assertIn('crawler_pages_total{method="static",source="TRADERA"} 3', lines)
+        self.assertIn('crawler_bytes_total{method="static",source="TRA\\"DERA"} 1234', lines)
+        self.assertIn('# TYPE crawler_stage_seconds histogram', lines)
+        self.assertIn('crawler_stage_seconds_bucket{source="TRADERA",stage="render",le="0.25"} 0', lines)
+        self.assertIn('crawler_stage_seconds_bucket{source="TRADERA",stage="render",le="0.5"} 1', lines)
+        self.assertIn('crawler_stage_seconds_bucket{source="TRADERA",stage="render",le="60"} 1', lines)
+        self.assertIn('crawler_stage_seconds_bucket{source="TRADERA",stage="render",le="+Inf"} 2', lines)
+        self.assertIn('crawler_stage_seconds_sum{source="TRADERA",stage="render"} 100.3', lines)
+        self.assertIn('crawler_stage_seconds_count{source="TRADERA",stage="render"} 2', lines)
+        self.assertIn('# TYPE crawler_host_rate gauge', lines)
+        self.assertIn('crawler_host_rate{host="a.com"} 0.5', lines)
+        self.assertNotIn('b.com', text)
+
+
+    def test_timer_counts_errors(self):
+        m = metrics.metrics
+        with m.time('parse', 'TEST'):
+            pass
+        with self.assertRaises(ValueError):
+            with m.time('parse', 'TEST'):
+                raise ValueError()
+        with self.assertRaises(ConsumerLimitReachedError):
+            with m.time('parse', 'TEST'):
+                raise ConsumerLimitReachedError("Enough")
+
+        labels = (('source', 'TEST'), ('stage', 'parse'))
+        self.assertEqual(m.histograms[('crawler_stage_seconds', labels)].count, 3)
+        self.assertEqual(m.counters[('crawler_errors_total', labels)], 1)
+
+
+    def test_store_sums_processes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = MetricsStore(path=os.path.join(tmpdir, 'metrics.sqlite'))
+
+            # Two processes, pushing what they counted since their last push
+            for i in range(2):
+                m = Metrics()
+                m.inc('crawler_pages_total', 2, source='TRADERA', method='static')
+                m.observe('crawler_stage_seconds', 0.3, source='TRADERA', stage='render')
+                store.push(*m.snapshot(reset=True))
+                self.assertEqual(m.snapshot(), ({}, {}))
+            m.inc('crawler_pages_total', source='TRADERA', method='static')
+            store.push(*m.snapshot(reset=True))
+
+            counters, histograms = store.load()
+            self.assertEqual(counters, {('crawler_pages_total', (('method', 'static'), ('source', 'TRADERA'))): 5})
+            counts, total, count = histograms[('crawler_stage_seconds', (('source', 'TRADERA'), ('stage', 'render')))]
+            self.assertEqual(count, 2)
+            self.assertEqual(total, 0.6)
+            self.assertEqual(sum(counts), 2)
+            store.db.close()
+
+
+    def test_render_metrics_of_all_processes(self):
+        conf = get_config()
+        saved = metrics.metrics_store, metrics.metrics_pid, getattr(conf, 'metrics_store', False), getattr(conf, 'metrics_store_path', None)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conf.metrics_store = True
+            conf.metrics_store_path = os.path.join(tmpdir, 'metrics.sqlite')
+            try:
+                # Another process pushed its metrics
+                other = Metrics()
+                other.inc('crawler_items_total', 3, source='TEST')
+                MetricsStore(path=conf.metrics_store_path).push(*other.snapshot())
+
+                # A forked process forgets the metrics it inherited
+                metrics.metrics.inc('crawler_items_total', 100, source='TEST')
+                metrics.metrics_pid = -1
+                get_metrics().inc('crawler_items_total', 2, source='TEST')
+                self.assertIn('crawler_items_total{source="TEST"} 5', render_metrics())
+            finally:
+                metrics.metrics_store.db.close()
+                metrics.metrics_store, metrics.metrics_pid, conf.metrics_store, conf.metrics_store_path = saved
+
+
+    def test_pipeline_stages(self):
+        consumer = ItemConsumer('TEST', allow_flush=False, limit_count=2)
+        c = GenericCrawler(source='TEST', consumer=consumer)
+        c.html = '<div class="a">bob</div>'
+        c.get_soup('a')
+        c.html_to_text('<b>bob</b>')
+        consumer.process(ScrapedRecord(native_url='http://a'))
+        with self.assertRaises(ConsumerLimitReachedError):
+            consumer.process(ScrapedRecord(native_url='http://b'))
+
+        text = metrics.metrics.render()
+        for stage in ('parse', 'html_to_text', 'consume'):
+            self.assertIn('crawler_stage_seconds_count{source="TEST",stage="%s"}' % stage, text)
+        self.assertIn('crawler_items_total{source="TEST"} 2', text)
+        self.assertNotIn('crawler_errors_total', text)
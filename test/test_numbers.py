@@ -0,0 +1,103 @@
+import os
+import re
+import logging
+from unittest import TestCase
+from bs4 import BeautifulSoup
+from crawler.numbers import parse_price
+from crawler.numbers import parse_number
+from crawler.text import html2text_to_text
+from crawler.exceptions import ParserError
+
+
+log = logging.getLogger(__name__)
+
+
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testaccept', 'data')
+
+
+def old_find_number(html):
+    """How GenericCrawler.find_number used to parse numbers"""
+    s = html2text_to_text(html)
+    s = re.sub(re.compile('[\r\n]+', re.MULTILINE), '', s)
+    s = re.sub(r'^[^\d]*', '', s)
+    s = re.sub(r'[^\d]*$', '', s)
+    s = s.replace(' ', '')
+    return int(s)
+
+
+def fixture_prices():
+    """Return all prices found in the pages in testaccept/data/"""
+    prices = []
+    for name in sorted(os.listdir(PATH_DATA)):
+        with open(os.path.join(PATH_DATA, name)) as f:
+            html = f.read()
+        prices.extend(re.findall(r'data-amount-in-sek="([^"]*)"', html))
+        soup = BeautifulSoup(html, 'lxml')
+        for tag in soup.find_all(class_=re.compile('price|amount')):
+            for s in tag.find_all(string=re.compile(r'^\s*[\d ]+ kr\s*$')):
+                prices.append(s)
+    return prices
+
+
+class Tests(TestCase):
+
+    def test_parse_price(self):
+        tests = [
+            # string, price
+            ['150', 150],
+            ['150 kr', 150],
+            ['5 909 kr', 5909],
+            ['1 250 kr', 1250],
+            ['1 250 kr', 1250],
+            ['1 250 SEK', 1250],
+            ['1 250 sek', 1250],
+            ['1 250,50 kr', 1250.5],
+            ['12,5 kr', 12.5],
+            ['150,00 kr', 150],
+            ['1.250 kr', 1250],
+            ['1 000 000 kr', 1000000],
+            ['99:-', 99],
+            ['100 - 200 kr', 100],
+            ['200–150 kr', 150],
+        ]
+
+        for s, price in tests:
+            self.assertEqual(parse_price(s), price, "Parsing '%s'" % s)
+            self.assertEqual(type(parse_price(s)), type(price), "Parsing '%s'" % s)
+
+
+    def test_parse_price__not_a_price(self):
+        for s in ['', 'kr', 'Lägg 295 kr eller mer', '1,2,3 kr', '12.3456']:
+            with self.assertRaises(ParserError):
+                parse_price(s)
+
+
+    def test_parse_price__fixtures(self):
+        prices = fixture_prices()
+        self.assertTrue(len(prices) >= 4)
+        for s in prices:
+            self.assertEqual(parse_price(s.strip()), old_find_number(s.replace('kr', '')), "Parsing '%s'" % s)
+
+
+    def test_parse_price__cached(self):
+        parse_price.cache_clear()
+        parse_price('1 250 kr')
+        parse_price('1 250 kr')
+        self.assertEqual(parse_price.cache_info().hits, 1)
+
+
+    def test_parse_number(self):
+        tests = [
+            "**Objektsnr:** 351090548",
+            "**Objektsnr:**\n 35  109\n0548",
+            "409 kr",
+            "5 909 kr",
+            "5 909",
+            "351090548",
+        ]
+
+        for s in tests:
+            self.assertEqual(parse_number(s), old_find_number(s), "Parsing '%s'" % s)
+
+        with self.assertRaises(ValueError):
+            parse_number("no digits")
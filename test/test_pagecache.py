@@ -0,0 +1,150 @@
+import os
+import logging
+import tempfile
+import threading
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pymacaron.config import get_config
+from crawler.io import pagecache
+from crawler.io.pagecache import PageCache
+from crawler.crawler import GenericCrawler
+from crawler.consumer import ItemConsumer
+
+
+log = logging.getLogger(__name__)
+
+
+class MockSite(BaseHTTPRequestHandler):
+
+    requests = 0
+
+    def do_GET(self):
+        MockSite.requests += 1
+        body = ('<div class="%s">%s</div>' % (self.path.lstrip('/'), MockSite.requests)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockCrawler(GenericCrawler):
+
+    page_types = {
+        'listing': {'marker': 'item-card-figure', 'static': True, 'cache_ttl': 60},
+        'uncached': {'marker': 'view-item', 'static': True},
+    }
+
+
+class Tests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockSite)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'pages.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_get_put(self):
+        c = PageCache(path=self.path)
+        self.assertIsNone(c.get('http://a'))
+        c.put('http://a', '<div>å</div>', 60)
+        self.assertEqual(c.get('http://a'), '<div>å</div>')
+        c.put('http://a', '<div>b</div>', 60)
+        self.assertEqual(c.get('http://a'), '<div>b</div>')
+        c.delete('http://a')
+        self.assertIsNone(c.get('http://a'))
+
+        stats = c.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['puts'], 2)
+        self.assertEqual(stats['count'], 0)
+        self.assertEqual(stats['bytes'], 0)
+
+
+    def test_ttl(self):
+        c = PageCache(path=self.path)
+        c.put('http://a', 'a', 0)
+        c.put('http://b', 'b', 60)
+        self.assertIsNone(c.get('http://a'))
+        self.assertEqual(c.get('http://b'), 'b')
+        stats = c.get_stats()
+        self.assertEqual(stats['expired'], 1)
+        self.assertEqual(stats['count'], 1)
+
+
+    def test_lru_eviction(self):
+        page = os.urandom(1000).hex()
+        c = PageCache(path=self.path)
+        c.put('http://0', page, 60)
+        size = c.get_stats()['bytes']
+
+        # Room for 3 pages only
+        c = PageCache(path=self.path, max_bytes=int(3.5 * size))
+        for i in range(3):
+            c.put('http://%s' % i, page, 60)
+        # Read 0, making 1 the least recently read
+        self.assertIsNotNone(c.get('http://0'))
+        c.put('http://3', page, 60)
+
+        self.assertIsNone(c.get('http://1'))
+        self.assertIsNotNone(c.get('http://0'))
+        self.assertIsNotNone(c.get('http://3'))
+        self.assertEqual(c.get_stats()['bytes'], 3 * size)
+        self.assertEqual(c.get_stats()['evictions'], 1)
+
+        # Other processes sharing the cache see its size, and evict pages to
+        # keep it within max_bytes
+        c2 = PageCache(path=self.path, max_bytes=int(3.5 * size))
+        self.assertEqual(c2.get_stats()['bytes'], 3 * size)
+        c2.put('http://4', page, 60)
+        self.assertEqual(c.get_stats()['bytes'], 3 * size)
+        self.assertIsNone(c.get('http://2'))
+
+
+    def test_get_url__cached(self):
+        conf = get_config()
+        saved = getattr(conf, 'page_cache', False), getattr(conf, 'slack_urls', None), pagecache.page_cache
+        conf.page_cache = True
+        conf.slack_urls = 'test'
+        pagecache.page_cache = PageCache(path=self.path)
+        try:
+            c = MockCrawler(source='test', consumer=ItemConsumer('test'))
+
+            url = self.base_url + '/item-card-figure'
+            self.assertTrue(c.get_url(url, page_type='listing'))
+            first = c.html
+            self.assertTrue(c.get_url(url, page_type='listing'))
+            self.assertEqual(c.html, first)
+
+            # Bypassing the cache fetches the page again, and refreshes it
+            self.assertTrue(c.get_url(url, page_type='listing', use_cache=False))
+            self.assertNotEqual(c.html, first)
+            second = c.html
+            c = MockCrawler(source='test', consumer=ItemConsumer('test'), use_cache=False)
+            self.assertTrue(c.spawn().get_url(url, page_type='listing'))
+            self.assertTrue(c.get_url(url, page_type='listing'))
+            self.assertNotEqual(c.html, second)
+
+            # Page types without a ttl are never cached
+            url = self.base_url + '/view-item'
+            self.assertTrue(c.get_url(url, page_type='uncached'))
+            self.assertIsNone(pagecache.page_cache.get(url))
+
+            self.assertEqual(pagecache.page_cache.get_stats()['hits'], 1)
+        finally:
+            conf.page_cache, conf.slack_urls, pagecache.page_cache = saved
@@ -0,0 +1,163 @@
+import os
+import time
+import logging
+import tempfile
+import threading
+from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from crawler.io import profiler
+from crawler.io.profiler import Sampler
+from crawler.io.profiler import ProfileRing
+from crawler.io.profiler import profiling
+from crawler.io.profiler import note_url
+from crawler.io.profiler import propagate
+from crawler.io.profiler import get_label
+
+
+log = logging.getLogger(__name__)
+
+
+def busy_loop(sec):
+    end = time.time() + sec
+    while time.time() < end:
+        pass
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.ring = ProfileRing(path=self.tmpdir.name, max_profiles=3)
+        self.saved_ring = profiler.profile_ring
+        profiler.profile_ring = self.ring
+
+
+    def tearDown(self):
+        profiler.profile_ring = self.saved_ring
+        self.tmpdir.cleanup()
+
+
+    def test_sampler(self):
+        s = Sampler(interval=0.001)
+        s.start()
+        t = threading.Thread(target=busy_loop, args=(0.2, ))
+        t.start()
+        s.attach(t.ident)
+        t.join()
+        s.stop()
+        s.detach(t.ident)
+
+        self.assertTrue(s.samples > 10)
+        self.assertEqual(s.threads, {})
+        label = get_label(busy_loop.__code__)
+        self.assertEqual(label, 'busy_loop (test/test_profiler.py:%s)' % busy_loop.__code__.co_firstlineno)
+        busy = [f for f in s.get_functions() if f['function'] == label]
+        self.assertTrue(busy[0]['self_samples'] > s.samples / 2)
+        self.assertTrue([k for k in s.stacks.keys() if k.endswith(';%s' % label)])
+
+        first = s.get_collapsed_stacks().split('\n')[0]
+        self.assertTrue(first.endswith(' %s' % max(s.stacks.values())))
+
+
+    def test_sampler_overhead_budget(self):
+        class SlowSampler(Sampler):
+            def sample(self):
+                super().sample()
+                time.sleep(0.01)
+
+        for max_overhead, low, high in ((None, 0.5, 1), (0.05, 0, 0.1)):
+            s = SlowSampler(interval=0.001, max_overhead=max_overhead)
+            time_start = time.time()
+            s.start()
+            time.sleep(0.5)
+            s.stop()
+            overhead = s.time_sampling / (time.time() - time_start)
+            self.assertTrue(low < overhead < high, "Overhead %s with max_overhead %s" % (overhead, max_overhead))
+            self.assertTrue(s.samples > 0)
+
+
+    def test_sampler_errors_are_logged(self):
+        class BrokenSampler(Sampler):
+            def sample(self):
+                raise ValueError("bob")
+
+        s = BrokenSampler(interval=0.001)
+        with self.assertLogs('crawler.io.profiler', level='ERROR'):
+            s.start()
+            s.thread.join(1)
+        self.assertFalse(s.thread.is_alive())
+        s.stop()
+
+
+    def test_save_failure(self):
+        profile = {'profile_id': '1000-scan-abc', 'kind': 'scan'}
+        self.tmpdir.cleanup()
+        with self.assertLogs('crawler.io.profiler', level='WARNING'):
+            self.assertFalse(self.ring.save(profile))
+
+        # The profiled request doesn't notice
+        with profiling('scan', 'TEST', enabled=True):
+            busy_loop(0.01)
+
+
+    def test_profiling_samples_threads_working_for_it(self):
+        def work(url):
+            note_url(url)
+            busy_loop(0.1)
+
+        def other_loop(url):
+            note_url(url)
+            busy_loop(0.1)
+
+        with profiling('scan', 'TEST', enabled=True):
+            # Threads running code propagated by the profiled thread work for
+            # its profile, other threads don't, even if started meanwhile
+            pool = ThreadPoolExecutor(max_workers=1)
+            pool.submit(other_loop, 'http://other').result()
+            pool.submit(propagate(work), 'http://work').result()
+            pool.shutdown()
+
+        p = self.ring.get(self.ring.list()[0]['profile_id'])
+        self.assertEqual(p['urls'], ['http://work'])
+        self.assertTrue([k for k in p['stacks'].split('\n') if ';work (' in k])
+        self.assertFalse([k for k in p['stacks'].split('\n') if ';other_loop (' in k])
+
+
+    def test_profiling(self):
+        with profiling('scrape', 'TEST', url='http://a') as p:
+            self.assertFalse(p.enabled)
+        self.assertEqual(self.ring.list(), [])
+
+        with profiling('scrape', 'TEST', url='http://a', enabled=True):
+            note_url('http://a')
+            busy_loop(0.05)
+        note_url('http://b')
+
+        profiles = self.ring.list()
+        self.assertEqual(len(profiles), 1)
+        p = self.ring.get(profiles[0]['profile_id'])
+        self.assertEqual(p['kind'], 'scrape')
+        self.assertEqual(p['source'], 'TEST')
+        self.assertEqual(p['url'], 'http://a')
+        self.assertEqual(p['urls'], ['http://a'])
+        self.assertIsNone(p['error'])
+        self.assertTrue(p['samples'] > 0)
+        self.assertTrue(0 < p['overhead'] < 1)
+        self.assertTrue([f for f in p['functions'] if f['function'].startswith('busy_loop')])
+        self.assertNotIn('stacks', profiles[0])
+
+        # Failed requests are profiled too
+        with self.assertRaises(ValueError):
+            with profiling('scan', 'TEST', enabled=True):
+                raise ValueError("bob")
+        self.assertEqual(self.ring.list()[0]['error'], 'ValueError: bob')
+
+
+    def test_ring_is_bounded(self):
+        for i in range(5):
+            self.ring.save({'profile_id': '%s-scan-abc' % (1000 + i), 'kind': 'scan'})
+        self.assertEqual([p['profile_id'] for p in self.ring.list()], ['1004-scan-abc', '1003-scan-abc', '1002-scan-abc'])
+        self.assertEqual(len(os.listdir(self.tmpdir.name)), 3)
+        self.assertIsNone(self.ring.get('1000-scan-abc'))
+        self.assertIsNone(self.ring.get('../1004-scan-abc'))
+        self.assertEqual(self.ring.get('1004-scan-abc')['kind'], 'scan')
@@ -0,0 +1,59 @@
+import os
+import logging
+from datetime import datetime
+from unittest import TestCase
+from pymacaron_core.swagger.apipool import ApiPool
+from crawler.formats import get_custom_formats
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+
+
+log = logging.getLogger(__name__)
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        ApiPool.add(
+            'crawler',
+            yaml_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apis', 'crawler.yaml'),
+            formats=get_custom_formats(),
+        )
+        self.maxDiff = None
+
+
+    def test_records_match_models(self):
+        tests = [
+            ScrapedRecord(
+                is_complete=False,
+                native_url='https://www.tradera.com/item/1/2/bob',
+                bdlitem=BDLItemRecord(
+                    has_ended=True,
+                    date_ended=datetime(2019, 5, 30, 10, 31),
+                ),
+            ),
+            ScrapedRecord(
+                is_complete=True,
+                native_url='https://www.tradera.com/item/1/2/bob',
+                bdlitem=BDLItemRecord(
+                    title='Mini Kånken',
+                    price=280,
+                    price_is_fixed=False,
+                    currency='SEK',
+                    has_ended=False,
+                    epoch_published=1557079800,
+                    native_doc_id='349772619',
+                    native_seller_is_shop=False,
+                ),
+            ),
+        ]
+
+        for r in tests:
+            self.assertEqual(r.to_json(), ApiPool.crawler.model_to_json(r.to_model()))
+
+        self.assertEqual(tests[0].to_json()['bdlitem']['date_ended'], '2019-05-30T10:31:00+00:00')
+
+
+    def test_unknown_attribute(self):
+        with self.assertRaises(AssertionError):
+            BDLItemRecord(has_ended=False, colour='blue')
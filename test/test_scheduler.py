@@ -0,0 +1,172 @@
+import logging
+import threading
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from crawler.io import scheduler
+from crawler.io.scheduler import HostScheduler
+from crawler.crawler import GenericCrawler
+from crawler.consumer import ItemConsumer
+from crawler.exceptions import RenderServiceBusyError
+
+
+log = logging.getLogger(__name__)
+
+
+class FakeClock():
+    """A clock that only moves when slept on"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.sleeps.append(sec)
+        self.now += sec
+
+
+class MockSite(BaseHTTPRequestHandler):
+    """Throttle the first 'throttled' requests, then serve a listing page"""
+
+    throttled = 0
+
+    def do_GET(self):
+        if MockSite.throttled:
+            MockSite.throttled -= 1
+            self.send_response(429)
+            self.end_headers()
+            return
+
+        body = b'<div class="item-card-figure">bob</div>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockCrawler(GenericCrawler):
+
+    page_types = {
+        'listing': {'marker': 'item-card-figure', 'static': True},
+    }
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = HostScheduler(rate=2, burst=2, max_concurrency=2, clock=self.clock.time, sleep=self.clock.sleep)
+
+
+    def request(self, url, status=200, latency=0):
+        with self.scheduler.slot(url) as slot:
+            time_start = self.clock.now
+            self.clock.now += latency
+            slot.status = status
+        return time_start
+
+
+    def test_token_bucket(self):
+        starts = [self.request('http://a.com/%s' % i) for i in range(5)]
+        self.assertEqual(starts, [0, 0, 0.5, 1.0, 1.5])
+
+        # Hosts have their own buckets
+        self.assertEqual(self.request('http://b.com/'), 1.5)
+
+        # Per host limits
+        s = HostScheduler(rate=2, burst=2, limits={'a.com': {'rate': 10, 'burst': 1}}, clock=self.clock.time, sleep=self.clock.sleep)
+        self.assertEqual(s.get_host('http://a.com/x').rate, 10)
+        self.assertEqual(s.get_host('http://a.com/x').burst, 1)
+        self.assertEqual(s.get_host('http://b.com/x').rate, 2)
+
+
+    def test_backoff(self):
+        self.assertEqual(self.request('http://a.com/', status=429), 0)
+        self.assertEqual(self.request('http://a.com/', status=503), 1)
+        self.assertEqual(self.request('http://a.com/', status=200), 3)
+
+        stats = self.scheduler.get_stats()['a.com']
+        self.assertEqual(stats['throttled'], 2)
+        self.assertEqual(stats['errors'], 2)
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['backoff'], 0)
+        self.assertEqual(stats['wait_sec'], 3)
+        # Halved twice, then growing back by 10%
+        self.assertAlmostEqual(stats['rate'], 0.7)
+
+        # Unreachable hosts and overloaded services back off too
+        with self.assertRaises(RenderServiceBusyError):
+            with self.scheduler.slot('http://a.com/'):
+                raise RenderServiceBusyError("busy")
+        self.assertEqual(self.scheduler.get_stats()['a.com']['backoff'], 1)
+
+        # Unless requested through a proxy
+        with self.scheduler.slot('http://b.com/', backoff=False) as slot:
+            slot.fail()
+        self.assertEqual(self.scheduler.get_stats()['b.com']['backoff'], 0)
+        self.assertEqual(self.scheduler.get_stats()['b.com']['errors'], 1)
+
+
+    def test_rising_latency(self):
+        for i in range(20):
+            self.request('http://a.com/', latency=0.1)
+        self.assertEqual(self.scheduler.get_stats()['a.com']['slowdowns'], 0)
+        self.assertEqual(self.scheduler.get_stats()['a.com']['rate'], 2)
+
+        for i in range(3):
+            self.request('http://a.com/', latency=1)
+        stats = self.scheduler.get_stats()['a.com']
+        self.assertGreater(stats['slowdowns'], 0)
+        self.assertLess(stats['rate'], 2)
+
+
+    def test_max_concurrency(self):
+        s = HostScheduler(rate=100, burst=100, max_concurrency=1)
+        first = s.slot('http://a.com/')
+        first.__enter__()
+
+        started = threading.Event()
+
+        def request():
+            with s.slot('http://a.com/'):
+                started.set()
+
+        t = threading.Thread(target=request)
+        t.start()
+        self.assertFalse(started.wait(0.2))
+        self.assertEqual(s.get_stats()['a.com']['in_flight'], 1)
+
+        first.__exit__(None, None, None)
+        self.assertTrue(started.wait(1))
+        t.join()
+        self.assertEqual(s.get_stats()['a.com']['requests'], 2)
+
+
+    def test_fetch_static_through_scheduler(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockSite)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:%s/listing' % server.server_address[1]
+
+        saved = scheduler.scheduler
+        scheduler.scheduler = self.scheduler
+        try:
+            MockSite.throttled = 2
+            c = MockCrawler(source='test', consumer=ItemConsumer('test'))
+            listing = c.get_page_types('listing')
+            self.assertIsNone(c.fetch_static(url, listing))
+            self.assertIsNone(c.fetch_static(url, listing))
+            self.assertIsNotNone(c.fetch_static(url, listing))
+
+            # Each retry waited for the host's backoff
+            self.assertEqual(self.clock.sleeps, [1, 2])
+            stats = self.scheduler.get_stats()['127.0.0.1:%s' % server.server_address[1]]
+            self.assertEqual(stats['throttled'], 2)
+            self.assertEqual(stats['requests'], 3)
+        finally:
+            scheduler.scheduler = saved
+            server.shutdown()
@@ -0,0 +1,148 @@
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from crawler.io.seen import SeenIndex
+from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+from crawler.sources.tradera import TraderaCrawler
+from crawler.exceptions import ConsumerEpochReachedError
+
+
+log = logging.getLogger(__name__)
+
+
+CARD = '<div class="item-card-body"><figure class="item-card-figure"><a href="/item/1/%s/x"><img alt="x" src="//img.tradera.net/%s.jpg"/></a></figure><span class="item-card-details-price-before-discount">%s kr</span><h3 class="item-card-details-header" title="Item %s"></h3></div>'
+
+
+def gen_listing_page(ids):
+    return '<html><body>%s</body></html>' % ''.join([CARD % (i, i, i, i) for i in ids])
+
+
+def gen_item(native_url, native_doc_id=None):
+    return ScrapedRecord(
+        is_complete=False,
+        native_url=native_url,
+        bdlitem=BDLItemRecord(has_ended=False, native_doc_id=native_doc_id),
+    )
+
+
+class MockConsumer(ItemConsumer):
+
+    def __init__(self, *args, seen=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seen = seen
+        self.skip_seen = True
+        self.sent = []
+
+    def send_objects(self, objects, token):
+        self.sent.extend(objects)
+
+
+class MockTraderaCrawler(TraderaCrawler):
+    """Scan listing pages made of the given lists of item ids"""
+
+    def __init__(self, pages=None, **args):
+        super().__init__(**args)
+        self.pages = pages
+
+    def get_listing_page(self, url):
+        self.soups = {}
+        self.html = gen_listing_page(self.pages.pop(0))
+        return True
+
+    def get_next_page_url(self):
+        return 'next' if self.pages else None
+
+    def fetch_item(self, native_url, scraper_data=None):
+        return gen_item(native_url)
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'seen.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_add_get_seen(self):
+        index = SeenIndex(path=self.path)
+        index.add('TRADERA', [gen_item('a', '1'), gen_item('b'), 'not an item'])
+        self.assertEqual(index.get_seen('TRADERA', ['a', 'b', 'c']), set(['a', 'b']))
+        self.assertEqual(index.get_seen('BLOCKET', ['a', 'b', 'c']), set())
+        self.assertTrue(index.is_seen('TRADERA', 'a'))
+        self.assertFalse(index.is_seen('TRADERA', 'c'))
+
+        # Doc ids are kept when an item is sent again without one
+        index.add('TRADERA', [gen_item('a')])
+        row = index.db.execute("SELECT native_doc_id FROM seen WHERE native_url = 'a'").fetchone()
+        self.assertEqual(row[0], '1')
+
+        urls = ['u%s' % i for i in range(1200)]
+        index.add('TRADERA', [gen_item(u) for u in urls])
+        self.assertEqual(len(index.get_seen('TRADERA', urls + ['c'])), 1200)
+
+
+    def test_forget_old_items(self):
+        index = SeenIndex(path=self.path)
+        index.add('TRADERA', [gen_item('a'), gen_item('b')])
+        index.db.execute("UPDATE seen SET epoch_sent = 0 WHERE native_url = 'a'")
+        index = SeenIndex(path=self.path, max_age_days=1)
+        self.assertEqual(index.get_seen('TRADERA', ['a', 'b']), set(['b']))
+
+
+    def test_consumer_skips_seen(self):
+        index = SeenIndex(path=self.path)
+        consumer = MockConsumer('TRADERA', seen=index)
+        for u in ('a', 'b'):
+            consumer.process(gen_item(u))
+        consumer.flush()
+        self.assertEqual(index.get_seen('TRADERA', ['a', 'b', 'c']), set(['a', 'b']))
+
+        consumer = MockConsumer('TRADERA', seen=index)
+        for u in ('a', 'b', 'c'):
+            consumer.process(gen_item(u))
+        consumer.flush()
+        self.assertEqual([o.native_url for o in consumer.sent], ['c'])
+        self.assertEqual(consumer.count_skipped, 2)
+
+
+    def test_scan_stops_at_seen_page(self):
+        index = SeenIndex(path=self.path)
+        index.add('TRADERA', [gen_item('https://www.tradera.com/item/1/%s/x' % i) for i in (4, 5, 6)])
+
+        # Items are checked once per page, not one by one
+        index.is_seen = None
+
+        consumer = MockConsumer('TRADERA', seen=index)
+        c = MockTraderaCrawler(
+            source='TRADERA',
+            consumer=consumer,
+            pages=[[1, 2, 3], [4, 5, 6], [7, 8, 9]],
+            scrape_workers=1,
+        )
+        c.spawn = lambda: c
+        c.scan_category('test')
+        consumer.flush()
+
+        self.assertEqual(
+            [o.native_url for o in consumer.sent],
+            ['https://www.tradera.com/item/1/%s/x' % i for i in (1, 2, 3)],
+        )
+        # The page after the seen one was never fetched
+        self.assertEqual(c.pages, [[7, 8, 9]])
+
+
+    def test_scan_checks_epoch_before_seen_page(self):
+        index = SeenIndex(path=self.path)
+        index.add('TRADERA', [gen_item('https://www.tradera.com/item/1/%s/x' % i) for i in (1, 2, 3)])
+
+        consumer = MockConsumer('TRADERA', seen=index)
+        c = MockTraderaCrawler(source='TRADERA', consumer=consumer, pages=[[1, 2, 3]])
+        c.compare_to_epoch_oldest = lambda items: -1
+        with self.assertRaises(ConsumerEpochReachedError):
+            c.scan_category('test')
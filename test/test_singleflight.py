@@ -0,0 +1,121 @@
+import logging
+import threading
+from time import sleep
+from unittest import TestCase
+from crawler.io.singleflight import SingleFlight
+from crawler.io.singleflight import normalize_url
+from crawler.crawler import GenericCrawler
+from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.exceptions import CannotGetUrlError
+
+
+log = logging.getLogger(__name__)
+
+
+class SlowCrawler(GenericCrawler):
+
+    fetched = []
+
+    def scrape(self, native_url, scraper_data=None):
+        return self.consumer.process(self.fetch_item_once(native_url, scraper_data=scraper_data))
+
+    def fetch_item(self, native_url, scraper_data=None):
+        SlowCrawler.fetched.append(native_url)
+        sleep(0.2)
+        if 'error' in native_url:
+            raise CannotGetUrlError("Failed to fetch url %s" % native_url)
+        return ScrapedRecord(is_complete=True, native_url=native_url)
+
+
+def run_concurrently(*calls):
+    """Run the given functions in parallel and return their results, or the
+    exceptions they raised"""
+    results = [None] * len(calls)
+
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except BaseException as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i, )) for i in range(len(calls))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class Tests(TestCase):
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('HTTPS://www.Tradera.com:443/item/1/2/'), 'https://www.tradera.com/item/1/2')
+        self.assertEqual(normalize_url('https://www.tradera.com/item/1/2#bids'), 'https://www.tradera.com/item/1/2')
+        self.assertEqual(normalize_url('https://www.tradera.com:8443/item?id=1'), 'https://www.tradera.com:8443/item?id=1')
+        self.assertEqual(normalize_url('http://a.com'), 'http://a.com/')
+
+
+    def test_coalesce(self):
+        f = SingleFlight()
+        calls = []
+
+        def gen(result):
+            def call():
+                calls.append(result)
+                sleep(0.2)
+                return result
+            return call
+
+        results = run_concurrently(
+            lambda: f.do('a', gen(1)),
+            lambda: f.do('a', gen(2)),
+            lambda: f.do('b', gen(3)),
+        )
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[2], 3)
+        self.assertEqual(f.get_stats(), {'calls': 3, 'coalesced': 1, 'in_flight': 0})
+
+        # Later calls run again
+        self.assertEqual(f.do('a', gen(4)), 4)
+
+
+    def test_scrapes_share_one_fetch(self):
+        SlowCrawler.fetched = []
+        consumers = [ItemConsumer('test', allow_flush=False) for i in range(3)]
+        crawlers = [SlowCrawler(source='test', consumer=c) for c in consumers]
+        run_concurrently(
+            lambda: crawlers[0].scrape('http://test/1'),
+            lambda: crawlers[1].scrape('http://test/1/'),
+            lambda: crawlers[2].scrape('http://test/1#top'),
+        )
+        self.assertEqual(len(SlowCrawler.fetched), 1)
+        for c in consumers:
+            self.assertEqual(len(c.objects), 1)
+
+        # Each scrape gets its own copy of the shared result
+        items = [c.objects[0] for c in consumers]
+        self.assertEqual(len(set(id(i) for i in items)), 3)
+        items[0].is_complete = False
+        self.assertTrue(items[1].is_complete)
+        self.assertEqual([i.native_url for i in items], ['http://test/1', 'http://test/1/', 'http://test/1#top'])
+
+        # Errors are shared too
+        SlowCrawler.fetched = []
+        results = run_concurrently(
+            lambda: crawlers[0].scrape('http://test/error'),
+            lambda: crawlers[1].scrape('http://test/error'),
+        )
+        self.assertEqual(len(SlowCrawler.fetched), 1)
+        for r in results:
+            self.assertIsInstance(r, CannotGetUrlError)
+
+        # Pages fetched live or from the cache are not shared
+        SlowCrawler.fetched = []
+        crawlers[1].use_cache = False
+        run_concurrently(
+            lambda: crawlers[0].scrape('http://test/2'),
+            lambda: crawlers[1].scrape('http://test/2'),
+        )
+        self.assertEqual(len(SlowCrawler.fetched), 2)
@@ -0,0 +1,51 @@
+import logging
+from time import sleep, time
+from unittest import TestCase
+from crawler.io.slack import SlackNotifier
+
+
+log = logging.getLogger(__name__)
+
+
+class Tests(TestCase):
+
+    def test_digest_coalesces_lines(self):
+        posted = []
+        n = SlackNotifier(interval=0.2, min_post_interval=0, max_digest_lines=3, post=lambda c, m: posted.append((c, m)))
+        for i in range(5):
+            n.notify_digest('urls', 'TRADERA: fetched urls', 'url%s' % i)
+        n.notify('scraper', 'Flushed 5 items')
+        sleep(0.5)
+
+        self.assertEqual(posted[0], ('scraper', 'Flushed 5 items'))
+        self.assertEqual(len(posted), 2)
+        channel, message = posted[1]
+        self.assertEqual(channel, 'urls')
+        self.assertEqual(
+            message,
+            'TRADERA: fetched urls (5 in the last 0.2sec)\nurl0\nurl1\nurl2\n... and 2 more',
+        )
+
+
+    def test_never_blocks_and_counts_drops(self):
+
+        def slow_post(channel, message):
+            sleep(1)
+
+        n = SlackNotifier(interval=10, max_queue=5, post=slow_post)
+        t0 = time()
+        for i in range(50):
+            n.notify('scraper', 'message %s' % i)
+        self.assertTrue(time() - t0 < 0.5)
+        self.assertTrue(n.count_dropped >= 40)
+
+
+    def test_rate_limit(self):
+        posted = []
+        n = SlackNotifier(interval=10, min_post_interval=0.1, post=lambda c, m: posted.append(time()))
+        for i in range(4):
+            n.notify('scraper', 'message %s' % i)
+        sleep(0.5)
+        self.assertEqual(len(posted), 4)
+        for t0, t1 in zip(posted, posted[1:]):
+            self.assertTrue(t1 - t0 >= 0.09)
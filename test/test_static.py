@@ -0,0 +1,85 @@
+import os
+import gzip
+import logging
+import threading
+from unittest import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from crawler.io.static import StaticFetcher
+from crawler.io.static import has_class
+from crawler.crawler import GenericCrawler
+from crawler.consumer import ItemConsumer
+
+
+log = logging.getLogger(__name__)
+
+
+def load_html(name):
+    path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'testaccept', 'data', name)
+    with open(path, 'r') as f:
+        return f.read()
+
+
+class MockSite(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = '<div class="a %s b">bob</div>' % self.path.lstrip('/')
+        body = gzip.compress(body.encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MockCrawler(GenericCrawler):
+
+    page_types = {
+        'listing': {'marker': 'item-card-figure', 'static': True},
+        'detail': {'marker': 'view-item', 'static': False},
+    }
+
+
+class Tests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), MockSite)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = 'http://127.0.0.1:%s' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+
+    def test_has_class(self):
+        html = load_html('tradera__ended__no_bid__shop.html')
+        self.assertTrue(has_class(html, 'view-item-ended-summary-label'))
+        self.assertTrue(has_class(html, 'view-item-image-gallery'))
+        self.assertTrue(has_class(html, 'view-item'))
+        self.assertFalse(has_class(html, 'item-card-figure'))
+        html = load_html('tradera__many_bids.html')
+        self.assertFalse(has_class(html, 'view-item-ended-summary-label'))
+
+
+    def test_static_fetcher(self):
+        f = StaticFetcher()
+        self.assertEqual(f.get(self.base_url + '/bob'), '<div class="a bob b">bob</div>')
+        self.assertIsNone(f.get(self.base_url + '/missing'))
+
+
+    def test_fetch_static__policy_and_marker(self):
+        c = MockCrawler(source='test', consumer=ItemConsumer('test'))
+        listing = c.get_page_types('listing')
+        detail = c.get_page_types('detail')
+        self.assertTrue(c.fetch_static(self.base_url + '/item-card-figure', listing))
+        self.assertIsNone(c.fetch_static(self.base_url + '/something-else', listing))
+        self.assertIsNone(c.fetch_static(self.base_url + '/view-item', detail))
@@ -0,0 +1,90 @@
+import json
+import logging
+import threading
+from unittest import TestCase
+from crawler.stream import stream_objects
+from crawler.consumer import ItemConsumer
+from crawler.records import ScrapedRecord
+from crawler.records import BDLItemRecord
+from crawler.exceptions import InternalServerError
+
+
+log = logging.getLogger(__name__)
+
+
+class MockScan():
+    """Process 'count' items, then optionally fail"""
+
+    def __init__(self, consumer, count, error=None):
+        self.consumer = consumer
+        self.count = count
+        self.error = error
+        self.processed = 0
+        self.resume = threading.Event()
+
+    def scan(self):
+        for i in range(self.count):
+            self.processed += 1
+            self.consumer.process(ScrapedRecord(
+                is_complete=False,
+                native_url='http://test/%s' % i,
+                bdlitem=BDLItemRecord(has_ended=True),
+            ))
+            if i == 0:
+                # Wait for the client to read the first item
+                self.resume.wait(5)
+        if self.error:
+            raise self.error
+
+
+class Tests(TestCase):
+
+    def test_stream_objects(self):
+        consumer = ItemConsumer('TEST', allow_flush=False)
+        m = MockScan(consumer, 3)
+        lines = stream_objects(consumer, m.scan)
+
+        # The first item is sent before the scan completes
+        self.assertEqual(json.loads(next(lines))['native_url'], 'http://test/0')
+        self.assertEqual(m.processed, 1)
+        m.resume.set()
+
+        lines = [json.loads(line) for line in lines]
+        self.assertEqual([o['native_url'] for o in lines[:-1]], ['http://test/1', 'http://test/2'])
+        self.assertEqual(lines[-1], {'summary': {'source': 'TEST', 'count': 3, 'skipped': 0, 'stopped': None}})
+
+        # Objects are streamed, not buffered
+        self.assertEqual(consumer.objects, [])
+
+
+    def test_stream_summary(self):
+        consumer = ItemConsumer('TEST', allow_flush=False, limit_count=2)
+        m = MockScan(consumer, 5)
+        m.resume.set()
+        lines = [json.loads(line) for line in stream_objects(consumer, m.scan)]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1]['summary']['count'], 2)
+        self.assertIn('limit count of 2', lines[-1]['summary']['stopped'])
+
+        consumer = ItemConsumer('TEST', allow_flush=False)
+        m = MockScan(consumer, 1, error=InternalServerError("boom"))
+        m.resume.set()
+        lines = [json.loads(line) for line in stream_objects(consumer, m.scan)]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[-1]['summary']['error'], 'INTERNAL_SERVER_ERROR')
+        self.assertIn('boom', lines[-1]['summary']['error_description'])
+
+
+    def test_client_goes_away(self):
+        consumer = ItemConsumer('TEST', allow_flush=False)
+        m = MockScan(consumer, 100)
+        lines = stream_objects(consumer, m.scan, max_pending=1)
+        next(lines)
+        lines.close()
+        m.resume.set()
+
+        # The crawl stops at its next object
+        for t in threading.enumerate():
+            if t.name == 'stream-TEST':
+                t.join(5)
+        self.assertLess(m.processed, 5)
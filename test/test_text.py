@@ -0,0 +1,97 @@
+import os
+import logging
+from unittest import TestCase
+from bs4 import BeautifulSoup
+from crawler.text import html_to_text
+from crawler.text import html2text_to_text
+from crawler.text import wrap_words
+from crawler.text import TextWriter
+from crawler.text import UnsupportedMarkup
+
+
+log = logging.getLogger(__name__)
+
+
+PATH_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'testaccept', 'data')
+
+
+class Tests(TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+
+
+    def assertSameAsHtml2text(self, html):
+        self.assertEqual(html_to_text(html), html2text_to_text(html), "Converting '%s'" % html)
+
+
+    def test_html_to_text(self):
+        tests = [
+            # html, text
+            ["", ""],
+            ["bob<br>bob", "bob\nbob"],
+            ["bob<bR/>bob", "bob\nbob"],
+            ["<strong>Objektsnr:</strong>\n 351090548 \n", "**Objektsnr:** 351090548"],
+            ["1 250&nbsp;kr", "1 250 kr"],
+            ["a &amp; b", "a & b"],
+            ["<li><strong>Objektsnr:</strong> 349772619\n    </li>", "* **Objektsnr:** 349772619"],
+        ]
+
+        for html, text in tests:
+            self.assertEqual(html_to_text(html), text, "Converting '%s'" % html)
+
+
+    def test_html_to_text__same_as_html2text(self):
+        tests = [
+            "x<strong> bold </strong>y",
+            "a<em>b</em>c",
+            "**<b>x</b>",
+            "<strong>a</strong>, b",
+            "<p>1. one</p><p>- two</p><div>+ three</div>",
+            "back\\slash \\* \\. \\_",
+            "word " * 40,
+            "- " + "word " * 40,
+            "a long-hyphenated-word and -- dashes " * 5,
+            "a | b " * 20,
+            "&lt;b&gt;not bold&lt;/b&gt; &rsquo;quoted&rsquo; &mdash; &lrm;x",
+            "<div><div>x</div></div>y<br/><br/><br/>z",
+            "<DIV class=\"a>b\">Upper</DIV>",
+            # Unsupported markup, converted by html2text
+            "text with <a href='x'>link</a>",
+            "<ul><li>a</li><li>b</li></ul>",
+            "1 <2 &foo",
+            "<!-- c -->x",
+        ]
+
+        for html in tests:
+            self.assertSameAsHtml2text(html)
+            self.assertSameAsHtml2text(BeautifulSoup('<div>%s</div>' % html, 'lxml').div)
+
+
+    def test_html_to_text__fixtures(self):
+        for name in os.listdir(PATH_DATA):
+            with open(os.path.join(PATH_DATA, name)) as f:
+                soup = BeautifulSoup(f.read(), 'lxml')
+            for tag in soup.find_all(class_=['content-text', 'view-item-footer-information-details-published', 'view-item-footer-information-details-itemid']):
+                self.assertSameAsHtml2text(tag)
+                self.assertSameAsHtml2text(str(tag))
+                self.assertSameAsHtml2text(tag.text)
+
+
+    def test_unsupported_markup(self):
+        for html in ["<a href='x'>link</a>", "<li><li>", "a & b", "a <3"]:
+            with self.assertRaises(UnsupportedMarkup):
+                TextWriter().feed_fragment(html)
+
+
+    def test_wrap_words(self):
+        from textwrap import wrap
+        tests = [
+            "word " * 40,
+            "x" * 100 + " a b " + "y" * 78 + " c",
+            ("a" * 38 + " ") * 6,
+            "b" * 78 + " b",
+        ]
+
+        for para in tests:
+            self.assertEqual(wrap_words(para), wrap(para, 78, break_long_words=False))
@@ -1,17 +1,33 @@
 import os
 import logging
 from pymacaron_core.swagger.apipool import ApiPool
+from pymacaron.config import get_config
 from unittest import TestCase
 from bs4 import BeautifulSoup
 from crawler.formats import get_custom_formats
 from crawler.sources.tradera import TraderaCrawler
+from crawler.sources.tradera import TRADERA_CATEGORIES
 from crawler.consumer import ItemConsumer
 from crawler.exceptions import ConsumerLimitReachedError
+from crawler.io import static
+from crawler.io import metrics
+from crawler.io.metrics import Metrics
 
 
 log = logging.getLogger(__name__)
 
 
+class StubFetcher():
+
+    def __init__(self, html):
+        self.html = html
+        self.urls = []
+
+    def fetch(self, url):
+        self.urls.append(url)
+        return 200, self.html
+
+
 class Tests(TestCase):
 
     def setUp(self):
@@ -27,6 +43,43 @@ class Tests(TestCase):
         TraderaCrawler(source='tradera', consumer=ItemConsumer('tradera'))
 
 
+    def test_get_url(self):
+        conf = get_config()
+        saved = static.fetcher, metrics.metrics, getattr(conf, 'slack_urls', None)
+        conf.slack_urls = 'test'
+        static.fetcher = StubFetcher('<div class="item-card-figure">bob</div>')
+        metrics.metrics = Metrics()
+        try:
+            c = TraderaCrawler(source='tradera', consumer=ItemConsumer('tradera'), use_cache=False)
+            url = 'https://www.tradera.com/category/1612?sortBy=AddedOn'
+            self.assertTrue(c.get_listing_page(url))
+            self.assertTrue(c.get_listing_page(url))
+            self.assertEqual(c.html, static.fetcher.html)
+            self.assertEqual(static.fetcher.urls, [url, url])
+            self.assertEqual(c.count_page, 2)
+            self.assertIn('crawler_pages_total{method="static",source="tradera"} 2', metrics.metrics.render())
+        finally:
+            static.fetcher, metrics.metrics, conf.slack_urls = saved
+
+
+    def test_scan__pre_loaded_html(self):
+        conf = get_config()
+        saved = static.fetcher, metrics.metrics, getattr(conf, 'slack_urls', None)
+        conf.slack_urls = 'test'
+        static.fetcher = StubFetcher('<div class="item-card-figure">bob</div>')
+        metrics.metrics = Metrics()
+        try:
+            c = TraderaCrawler(source='tradera', consumer=ItemConsumer('tradera', allow_flush=False), pre_loaded_html='<div class="item-card-figure">alice</div>', use_cache=False)
+            c.scan()
+            # The pre-loaded html stands for the first category's listing
+            # page, and only the other categories are fetched
+            first_url = c.gen_first_page_url(TRADERA_CATEGORIES[0])
+            self.assertNotIn(first_url, static.fetcher.urls)
+            self.assertEqual(len(static.fetcher.urls), len(TRADERA_CATEGORIES) - 1)
+        finally:
+            static.fetcher, metrics.metrics, conf.slack_urls = saved
+
+
     def test_scan_10_items(self):
         # Fetch the last 10 tradera announces and queue them up
         consumer = ItemConsumer('tradera', limit_count=10)
@@ -49,7 +102,7 @@ class Tests(TestCase):
         data['native_url'] = url
         c = TraderaCrawler(source='tradera', consumer=ItemConsumer('tradera'))
         item = c.scrape(url)
-        j = ApiPool.crawler.model_to_json(item)
+        j = item.to_json()
         self.assertEqual(j, data)
 
 
@@ -97,5 +150,5 @@ class Tests(TestCase):
             card = BeautifulSoup(card, 'lxml')
             c = TraderaCrawler(source='tradera', consumer=ItemConsumer('tradera'))
             i = c.card_to_listing_item(card)
-            j = ApiPool.crawler.model_to_json(i)
+            j = i.to_json()
             self.assertEqual(j, want)
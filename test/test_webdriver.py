@@ -0,0 +1,84 @@
+import logging
+import threading
+from unittest import TestCase
+from crawler.io.webdriver import WebdriverPool
+from crawler.exceptions import WebdriverPoolBusyError
+
+
+log = logging.getLogger(__name__)
+
+
+class MockDriver():
+
+    def __init__(self):
+        self.healthy = True
+        self.has_quit = False
+
+    def execute_script(self, script):
+        if not self.healthy:
+            raise Exception("Chrome is gone")
+        return 1
+
+    def quit(self):
+        self.has_quit = True
+
+
+class Tests(TestCase):
+
+    def test_checkout_reuses_warm_driver(self):
+        pool = WebdriverPool(size=2, max_rss_mb=None, factory=MockDriver)
+        d1 = pool.checkout()
+        pool.checkin(d1)
+        d2 = pool.checkout()
+        self.assertIs(d1, d2)
+        self.assertEqual(pool.count_created, 1)
+
+
+    def test_recycle_after_max_pages(self):
+        pool = WebdriverPool(size=1, max_pages=2, max_rss_mb=None, factory=MockDriver)
+        d1 = pool.checkout()
+        pool.checkin(d1)
+        d2 = pool.checkout()
+        pool.checkin(d2)
+        self.assertTrue(d1.has_quit)
+        d3 = pool.checkout()
+        self.assertIsNot(d1, d3)
+        self.assertEqual(pool.count_created, 2)
+        self.assertEqual(pool.count_recycled, 1)
+
+
+    def test_broken_and_unhealthy_drivers_are_replaced(self):
+        pool = WebdriverPool(size=1, max_rss_mb=None, factory=MockDriver)
+        d1 = pool.checkout()
+        pool.checkin(d1, broken=True)
+        self.assertTrue(d1.has_quit)
+
+        d2 = pool.checkout()
+        pool.checkin(d2)
+        d2.healthy = False
+        d3 = pool.checkout()
+        self.assertIsNot(d2, d3)
+        self.assertTrue(d2.has_quit)
+
+
+    def test_checkout_blocks_when_pool_exhausted(self):
+        pool = WebdriverPool(size=1, max_rss_mb=None, checkout_timeout=0.1, factory=MockDriver)
+        d1 = pool.checkout()
+        with self.assertRaises(WebdriverPoolBusyError):
+            pool.checkout()
+
+        pool.checkout_timeout = 5
+        threading.Timer(0.1, pool.checkin, [d1]).start()
+        self.assertIs(pool.checkout(), d1)
+
+
+    def test_no_chrome(self):
+
+        def fail():
+            raise Exception("chromedriver not found")
+
+        pool = WebdriverPool(size=1, factory=fail)
+        self.assertIsNone(pool.checkout())
+        self.assertFalse(pool.is_available())
+        with pool.driver() as d:
+            self.assertIsNone(d)